@@ -0,0 +1,10 @@
+"""
+Benchmarks for etl_tools against throwaway databases on a local PostgreSQL server
+
+Usage:
+  python -m benchmarks [--scales 1,10] [--benchmarks copy_schema,populate_time_dimensions] [--repetitions 3]
+                       [--results-file benchmark-results.jsonl] [--compare-with COMMIT]
+
+Requires mara-pipelines (with psycopg2) and the PostgreSQL client tools (psql, pg_dump) on the path. The connection
+to the server is taken from the command line or from the libpq environment variables (PGHOST, PGPORT, PGUSER, ..).
+"""
@@ -0,0 +1,80 @@
+"""Runs the benchmarks, see `benchmarks/__init__.py`"""
+
+import argparse
+import atexit
+import pathlib
+import sys
+import time
+import traceback
+
+from benchmarks import cases, data, environment, results
+
+if __name__ == '__main__':
+    benchmark_names = [benchmark.name for benchmark in cases.benchmarks]
+
+    parser = argparse.ArgumentParser(description='Times etl_tools operations on synthetic data of several sizes')
+    parser.add_argument('--scales', default='1,10', type=lambda s: [int(scale) for scale in s.split(',')],
+                        help=f'Comma separated data sizes (scale 1: {data.number_of_rows(1)} rows per table)')
+    parser.add_argument('--benchmarks', default=benchmark_names, type=lambda s: s.split(','),
+                        help='Comma separated benchmarks to run, default: all of ' + ', '.join(benchmark_names))
+    parser.add_argument('--repetitions', default=3, type=int, help='How often to run each benchmark per scale')
+    parser.add_argument('--results-file', default='benchmark-results.jsonl', type=pathlib.Path,
+                        help='Where to record the results')
+    parser.add_argument('--compare-with', help='The commit to compare with, default: the last other recorded one')
+    parser.add_argument('--host', help='The PostgreSQL server, default: from PGHOST')
+    parser.add_argument('--port', type=int, help='The port of the server, default: from PGPORT')
+    parser.add_argument('--user', help='A user that can create databases, default: from PGUSER')
+    parser.add_argument('--password', help='The password of the user, default: from PGPASSWORD')
+    parser.add_argument('--keep-databases', action='store_true', help='Do not drop the databases at the end')
+    parser.add_argument('--verbose', action='store_true', help='Print all output of the benchmarked pipelines')
+    args = parser.parse_args()
+
+    unknown_benchmarks = set(args.benchmarks) - set(benchmark_names)
+    if unknown_benchmarks:
+        parser.error('Unknown benchmarks: ' + ', '.join(sorted(unknown_benchmarks)))
+
+    commit = results.current_commit()
+    environment.configure(host=args.host, port=args.port, user=args.user, password=args.password)
+    environment.create_databases()
+    if not args.keep_databases:
+        # registered before running any pipeline, so that it runs after the exit handlers of mara_pipelines,
+        # which still close open runs in the mara db
+        atexit.register(environment.drop_databases)
+
+    all_succeeded = True
+    environment.initialize(verbose=args.verbose)
+    server_version = environment.server_version()
+    for scale in args.scales:
+        print(f'Creating benchmark data at scale {scale}', file=sys.stderr)
+        data.create_benchmark_data('source', scale)
+
+        for benchmark in cases.benchmarks:
+            if benchmark.name not in args.benchmarks:
+                continue
+            durations = []
+            succeeded = True
+            for repetition in range(args.repetitions):
+                try:
+                    benchmark.setup(scale, args.verbose)
+                    start_time = time.time()
+                    succeeded = benchmark.run(scale, args.verbose)
+                    duration = time.time() - start_time
+                except Exception:
+                    traceback.print_exc()
+                    succeeded = False
+                if not succeeded:
+                    break
+                durations.append(duration)
+
+            all_succeeded = all_succeeded and succeeded
+            result = results.record_result(args.results_file, commit, benchmark.name, scale, durations,
+                                           succeeded, server_version)
+            print(f'{benchmark.name:<40} {scale:>6} '
+                  + (f'{result["median"]:>9.2f}s' if succeeded else 'failed'), file=sys.stderr)
+
+    all_results = results.read_results(args.results_file)
+    other_commit = args.compare_with or results.previous_commit(all_results, commit)
+    if other_commit:
+        results.print_comparison(all_results, commit, other_commit)
+
+    sys.exit(0 if all_succeeded else 1)
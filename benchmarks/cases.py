@@ -0,0 +1,168 @@
+"""The benchmarked operations, each with a setup that is not timed"""
+
+import datetime
+import pathlib
+import tempfile
+import typing
+
+import mara_db.postgresql
+from mara_pipelines.pipelines import Pipeline
+
+from benchmarks import data
+from benchmarks.environment import run_pipeline
+from etl_tools import config
+from etl_tools.create_attributes_table import CreateAttributesTable
+from etl_tools.create_time_dimensions import time_dimensions_pipeline
+from etl_tools.load_euro_exchange_rates import euro_exchange_rates_pipeline
+from etl_tools.parallel_add_index import ParallelAddIndex
+from etl_tools.schema_copying import add_schema_copying_to_pipeline
+
+
+class Benchmark():
+    def __init__(self, name: str, description: str,
+                 run: typing.Callable[[int, bool], bool],
+                 setup: typing.Callable[[int, bool], None] = None) -> None:
+        """
+        An operation that is timed at several scales
+
+        Args:
+            name: A unique name of the benchmark, e.g. 'copy_schema'
+            description: What is measured
+            run: A function that runs the operation for a scale (and whether to print all output),
+                 returns True on success
+            setup: A function that prepares a run (not timed)
+        """
+        self.name = name
+        self.description = description
+        self.run = run
+        self.setup = setup or (lambda scale, verbose: None)
+
+
+def copy_schema(copy_method: str, **kwargs) -> typing.Callable[[int, bool], bool]:
+    """Copies the benchmark schema from the source db to the target db"""
+
+    def run(scale: int, verbose: bool) -> bool:
+        pipeline = Pipeline(id='benchmark_copy_schema', description='Copies the benchmark schema')
+        add_schema_copying_to_pipeline(pipeline, data.schema_name, source_db_alias='source', target_db_alias='target',
+                                       copy_method=copy_method, run_report=False, **kwargs)
+        return run_pipeline(pipeline, verbose=verbose)
+
+    return run
+
+
+def create_attributes_table(**kwargs) -> typing.Callable[[int, bool], bool]:
+    """Creates the attributes table of `benchmark.wide_text`"""
+
+    def run(scale: int, verbose: bool) -> bool:
+        pipeline = Pipeline(id='benchmark_create_attributes_table', description='Creates an attributes table')
+        pipeline.add(CreateAttributesTable(id='create_attributes_table', source_schema_name=data.schema_name,
+                                           source_table_name='wide_text', db_alias='source', run_report=False,
+                                           **kwargs))
+        return run_pipeline(pipeline, verbose=verbose)
+
+    return run
+
+
+fact_indexes = [{'column_names': ['customer_fk']},
+                {'column_names': ['day_fk'], 'method': 'brin'}]
+
+
+def drop_fact_indexes(scale: int, verbose: bool) -> None:
+    """Removes all indexes from the partitions of `benchmark.fact`"""
+    with mara_db.postgresql.postgres_cursor_context('source') as cursor:
+        cursor.execute(f'''
+SELECT indexrelid::REGCLASS::TEXT
+FROM pg_index
+JOIN pg_class ON pg_class.oid = indrelid
+JOIN pg_namespace ON pg_namespace.oid = relnamespace
+WHERE nspname = {'%s'} AND relname LIKE {'%s'}''', (data.schema_name, 'fact%'))
+        for index_name, in cursor.fetchall():
+            cursor.execute(f'DROP INDEX {index_name}')
+
+
+def add_fact_indexes(scale: int, verbose: bool) -> bool:
+    """Indexes all partitions of `benchmark.fact` with `util.add_index`"""
+    with mara_db.postgresql.postgres_cursor_context('source') as cursor:
+        for index in fact_indexes:
+            cursor.execute(f"SELECT util.add_index({'%s'}, 'fact', column_names := {'%s'}, method := {'%s'})",
+                           (data.schema_name, index['column_names'], index.get('method', 'btree')))
+    return True
+
+
+def add_fact_indexes_in_parallel(scale: int, verbose: bool) -> bool:
+    """Indexes all partitions of `benchmark.fact` with `ParallelAddIndex`"""
+    pipeline = Pipeline(id='benchmark_parallel_add_index', description='Indexes a partitioned table')
+    pipeline.add(ParallelAddIndex(id='add_indexes', schema_name=data.schema_name, table_name='fact',
+                                  indexes=fact_indexes, db_alias='source'))
+    return run_pipeline(pipeline, verbose=verbose)
+
+
+def time_dimensions_range(scale: int) -> (datetime.date, datetime.date):
+    """The days of the time dimensions at a scale (10 years per scale)"""
+    return datetime.date(2000, 1, 1), datetime.date(2000, 1, 1) + datetime.timedelta(days=3650 * scale)
+
+
+def create_time_dimension_tables(scale: int, verbose: bool) -> None:
+    """Re-creates the empty `time` schema (directly, as the pipeline skips unchanged sql files)"""
+    with mara_db.postgresql.postgres_cursor_context('source') as cursor:
+        cursor.execute('DROP SCHEMA IF EXISTS time CASCADE;')
+        cursor.execute((time_dimensions_pipeline().base_path() / 'create_tables.sql').read_text())
+
+
+def populate_time_dimensions(scale: int, verbose: bool) -> bool:
+    """Fills the day and duration tables with `time.populate_time_dimensions`"""
+    first_date, last_date = time_dimensions_range(scale)
+    with mara_db.postgresql.postgres_cursor_context('source') as cursor:
+        cursor.execute(f"SELECT time.populate_time_dimensions({'%s'}, {'%s'})", (first_date, last_date))
+    return True
+
+
+def exchange_rates_file(scale: int) -> pathlib.Path:
+    """A fixture zip with 1000 working days of exchange rates per scale, created on first use"""
+    file_name = pathlib.Path(tempfile.gettempdir()) / f'etl-tools-benchmark-exchange-rates-{scale}.zip'
+    if not file_name.exists():
+        data.create_exchange_rate_zip(file_name, number_of_days=1000 * scale)
+    return file_name
+
+
+def exchange_rates_step(setup_nodes: [str], node: str) -> (typing.Callable, typing.Callable):
+    """The setup and run functions for a node of the exchange rates pipeline, reading from the fixture zip"""
+
+    def setup(scale: int, verbose: bool) -> None:
+        config.euro_exchange_rates_url = lambda: str(exchange_rates_file(scale))
+        config.euro_exchange_rates_cache_file = lambda: None
+        for setup_node in setup_nodes:
+            assert run_pipeline(euro_exchange_rates_pipeline('source'), nodes=[setup_node], verbose=verbose)
+
+    def run(scale: int, verbose: bool) -> bool:
+        return run_pipeline(euro_exchange_rates_pipeline('source'), nodes=[node], verbose=verbose)
+
+    return setup, run
+
+
+load_exchange_rates_setup, load_exchange_rates = exchange_rates_step(
+    ['create_schema_and_table'], 'load_exchange_rate')
+postprocess_exchange_rates_setup, postprocess_exchange_rates = exchange_rates_step(
+    ['create_schema_and_table', 'load_exchange_rate'], 'postprocess_exchange_rate')
+
+benchmarks = [
+    Benchmark('copy_schema', 'ParallelCopySchema with psql between two dbs', copy_schema('psql')),
+    Benchmark('copy_schema_binary', 'ParallelCopySchema with in-process binary COPY streaming',
+              copy_schema('binary')),
+    Benchmark('copy_schema_split', 'ParallelCopySchema with all tables split, `benchmark.skewed` by its skewed key',
+              copy_schema('psql', split_tables_larger_than=1, split_columns={'skewed': 'key'})),
+    Benchmark('create_attributes_table', 'CreateAttributesTable with one scan per column',
+              create_attributes_table()),
+    Benchmark('create_attributes_table_single_scan', 'CreateAttributesTable with one scan per chunk of `id`',
+              create_attributes_table(single_scan=True, chunk_column='id')),
+    Benchmark('add_index_partitioned', 'util.add_index on all partitions of `benchmark.fact`',
+              add_fact_indexes, setup=drop_fact_indexes),
+    Benchmark('parallel_add_index_partitioned', 'ParallelAddIndex on all partitions of `benchmark.fact`',
+              add_fact_indexes_in_parallel, setup=drop_fact_indexes),
+    Benchmark('populate_time_dimensions', 'time.populate_time_dimensions for 10 years per scale',
+              populate_time_dimensions, setup=create_time_dimension_tables),
+    Benchmark('load_exchange_rates', 'Loading exchange rates from a fixture zip (1000 days per scale)',
+              load_exchange_rates, setup=load_exchange_rates_setup),
+    Benchmark('postprocess_exchange_rates', 'Filling the missing days of the loaded exchange rates',
+              postprocess_exchange_rates, setup=postprocess_exchange_rates_setup),
+]
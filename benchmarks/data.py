@@ -0,0 +1,150 @@
+"""Synthetic (and reproducible) benchmark data, generated server-side"""
+
+import csv
+import datetime
+import io
+import pathlib
+import random
+import zipfile
+
+import mara_db.postgresql
+
+schema_name = 'benchmark'
+
+
+def number_of_rows(scale: int) -> int:
+    """The number of rows of each benchmark table at a scale"""
+    return 100000 * scale
+
+
+def create_benchmark_data(db_alias: str, scale: int) -> None:
+    """
+    Re-creates the benchmark schema with all tables
+
+    All tables are plain heap tables (no cstore), so that no extensions beyond pg_trgm are needed.
+
+    Args:
+        db_alias: The db to create the tables in
+        scale: The data size, see `number_of_rows`
+    """
+    with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor:
+        cursor.execute(f'DROP SCHEMA IF EXISTS {schema_name} CASCADE; CREATE SCHEMA {schema_name};')
+    create_wide_text_table(db_alias, number_of_rows(scale))
+    create_skewed_table(db_alias, number_of_rows(scale))
+    create_partitioned_fact_table(db_alias, number_of_rows(scale))
+
+
+def create_wide_text_table(db_alias: str, number_of_rows: int, number_of_columns: int = 20) -> None:
+    """
+    Creates the table `benchmark.wide_text` with an id and many text columns of increasing cardinality
+    (10 distinct values in the first column, up to 10 ^ 5 in the last ones), some values are NULL
+
+    Args:
+        db_alias: The db to create the table in
+        number_of_rows: How many rows to generate
+        number_of_columns: How many text columns to generate
+    """
+    columns = ',\n       '.join(
+        f"CASE WHEN random() < 0.05 THEN NULL "
+        f"ELSE 'value ' || floor(random() * {10 ** min(5, 1 + i * 5 // number_of_columns)})::INTEGER END AS text_{i}"
+        for i in range(number_of_columns))
+    with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor:
+        cursor.execute(f'''
+SELECT setseed(0.1);
+
+CREATE TABLE {schema_name}.wide_text AS
+SELECT n AS id,
+       {columns}
+FROM generate_series(1, {number_of_rows}) n;
+
+ANALYZE {schema_name}.wide_text;''')
+
+
+def create_skewed_table(db_alias: str, number_of_rows: int) -> None:
+    """
+    Creates the table `benchmark.skewed` with a `key` column that follows a power law: a few keys (1, 2, 3 ..)
+    have a big share of all rows, most keys are rare
+
+    Args:
+        db_alias: The db to create the table in
+        number_of_rows: How many rows to generate
+    """
+    with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor:
+        cursor.execute(f'''
+SELECT setseed(0.2);
+
+CREATE TABLE {schema_name}.skewed AS
+SELECT n AS id,
+       least(floor(power(1 - random(), -2)), {number_of_rows})::BIGINT AS key,
+       round((random() * 1000)::NUMERIC, 2) AS amount,
+       md5(n::TEXT) AS payload
+FROM generate_series(1, {number_of_rows}) n;
+
+ANALYZE {schema_name}.skewed;''')
+
+
+def create_partitioned_fact_table(db_alias: str, number_of_rows: int, number_of_partitions: int = 8) -> None:
+    """
+    Creates the table `benchmark.fact` that is list partitioned by `partition_id`
+    (with `util.create_table_partitions`), with foreign keys of different cardinalities
+
+    Args:
+        db_alias: The db to create the table in
+        number_of_rows: How many rows to generate
+        number_of_partitions: How many partitions to create
+    """
+    with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor:
+        cursor.execute(f'''
+SELECT setseed(0.3);
+
+CREATE TABLE {schema_name}.fact (
+  fact_id      BIGINT           NOT NULL,
+  partition_id SMALLINT         NOT NULL,
+  day_fk       INTEGER          NOT NULL,
+  customer_fk  BIGINT           NOT NULL,
+  product_fk   INTEGER          NOT NULL,
+  amount       DOUBLE PRECISION NOT NULL
+) PARTITION BY LIST (partition_id);
+
+SELECT util.create_table_partitions('{schema_name}', 'fact', 'SELECT generate_series(0, {number_of_partitions - 1})');
+
+INSERT INTO {schema_name}.fact
+SELECT n,
+       n % {number_of_partitions},
+       to_char(DATE '2015-01-01' + (random() * 2000)::INTEGER, 'YYYYMMDD')::INTEGER,
+       floor(random() * {max(1, number_of_rows // 10)}),
+       floor(random() * 1000),
+       random() * 100
+FROM generate_series(1, {number_of_rows}) n;
+
+ANALYZE {schema_name}.fact;''')
+
+
+def create_exchange_rate_zip(file_name: pathlib.Path, number_of_days: int, number_of_currencies: int = 40) -> None:
+    """
+    Writes a zip file in the format of the ECB exchange rate history, with rates for all working days
+    up to yesterday (latest first) and some missing values
+
+    Args:
+        file_name: Where to write the zip file
+        number_of_days: How many working days to generate
+        number_of_currencies: How many currencies to generate
+    """
+    generator = random.Random(number_of_days)
+    currencies = [chr(65 + i // 26 % 26) + chr(65 + i % 26) + 'X' for i in range(number_of_currencies)]
+    rates = {currency: generator.uniform(0.5, 150) for currency in currencies}
+
+    csv_file = io.StringIO()
+    csv_writer = csv.writer(csv_file)
+    csv_writer.writerow(['Date'] + currencies + [''])
+    date = datetime.date.today()
+    for i in range(number_of_days):
+        date -= datetime.timedelta(days=3 if date.weekday() == 0 else 2 if date.weekday() == 6 else 1)
+        row = [date.isoformat()]
+        for currency in currencies:
+            rates[currency] *= generator.uniform(0.99, 1.01)
+            row.append('N/A' if generator.random() < 0.02 else f'{rates[currency]:.4f}')
+        csv_writer.writerow(row + [''])
+
+    with zipfile.ZipFile(file_name, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('eurofxref-hist.csv', csv_file.getvalue())
@@ -0,0 +1,102 @@
+"""Throwaway databases on a local PostgreSQL server for running benchmarks"""
+
+import sys
+
+import mara_db.auto_migration
+import mara_db.config
+import mara_db.dbs
+import mara_db.postgresql
+import mara_db.sqlalchemy_engine
+import mara_pipelines
+import mara_pipelines.config
+from mara_pipelines import execution
+from mara_pipelines.logging import pipeline_events
+from mara_pipelines.pipelines import Pipeline
+
+import etl_tools
+from etl_tools.initialize_utils import utils_pipeline
+
+# database aliases and the names of the databases that are created for them
+database_names = {'mara': 'etl_tools_benchmark_mara',
+                  'source': 'etl_tools_benchmark_source',
+                  'target': 'etl_tools_benchmark_target'}
+
+
+def configure(host: str = None, port: int = None, user: str = None, password: str = None) -> None:
+    """
+    Points mara to the benchmark databases ('source' is the default db alias)
+
+    Args:
+        host: The host of the PostgreSQL server, default: from the environment
+        port: The port of the PostgreSQL server, default: from the environment
+        user: The user to connect with, needs the permission to create databases
+        password: The password of the user
+    """
+    databases = {alias: mara_db.dbs.PostgreSQLDB(host=host, port=port, user=user, password=password,
+                                                 database=database_name)
+                 for alias, database_name in database_names.items()}
+    databases['postgres'] = mara_db.dbs.PostgreSQLDB(host=host, port=port, user=user, password=password,
+                                                     database='postgres')
+
+    mara_db.config.databases = lambda: databases
+    mara_pipelines.config.default_db_alias = lambda: 'source'
+    mara_pipelines.config.event_handlers = lambda: []
+
+
+def create_databases() -> None:
+    """(Re-)creates the benchmark databases"""
+    with mara_db.postgresql.postgres_cursor_context('postgres') as cursor:
+        cursor.connection.autocommit = True
+        for database_name in database_names.values():
+            cursor.execute(f'DROP DATABASE IF EXISTS {database_name}')
+            cursor.execute(f'CREATE DATABASE {database_name}')
+
+
+def drop_databases() -> None:
+    """Removes the benchmark databases"""
+    with mara_db.postgresql.postgres_cursor_context('postgres') as cursor:
+        cursor.connection.autocommit = True
+        for database_name in database_names.values():
+            cursor.execute(f'DROP DATABASE IF EXISTS {database_name}')
+
+
+def initialize(verbose: bool = False) -> None:
+    """Creates the tables of mara in the mara db and the util schema in the source and target db"""
+    engine = mara_db.sqlalchemy_engine.engine('mara')
+    mara_db.auto_migration.auto_migrate(engine, mara_pipelines.MARA_AUTOMIGRATE_SQLALCHEMY_MODELS()
+                                        + etl_tools.MARA_AUTOMIGRATE_SQLALCHEMY_MODELS())
+    engine.dispose()  # the mara db is dropped at the end
+
+    for db_alias in ['source', 'target']:
+        with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        mara_pipelines.config.default_db_alias = lambda: db_alias
+        assert run_pipeline(utils_pipeline(), verbose=verbose), f'Could not create the util schema in {db_alias}'
+    mara_pipelines.config.default_db_alias = lambda: 'source'
+
+
+def server_version() -> int:
+    """The version of the PostgreSQL server, e.g. 120004"""
+    with mara_db.postgresql.postgres_cursor_context('source') as cursor:
+        return cursor.connection.server_version
+
+
+def run_pipeline(pipeline: Pipeline, nodes: [str] = None, verbose: bool = False) -> bool:
+    """
+    Runs a pipeline (or some of its nodes), printing only errors unless `verbose` is set
+
+    Args:
+        pipeline: The pipeline to run
+        nodes: The ids of the nodes to run, default: all
+        verbose: Whether to print all output of the pipeline to stderr
+
+    Returns:
+        True when the run succeeded
+    """
+    succeeded = False
+    for event in execution.run_pipeline(pipeline, {pipeline.nodes[node_id] for node_id in nodes} if nodes else None):
+        if isinstance(event, pipeline_events.Output) and (verbose or event.is_error):
+            print(f'{" / ".join(event.node_path)}: {event.message}', file=sys.stderr)
+        elif isinstance(event, pipeline_events.RunFinished):
+            succeeded = event.succeeded
+    return succeeded
@@ -0,0 +1,82 @@
+"""Recording benchmark results per commit and comparing them between commits"""
+
+import datetime
+import json
+import pathlib
+import statistics
+import subprocess
+
+
+def current_commit() -> str:
+    """The abbreviated hash of the checked out commit ('-dirty' when tracked files are modified), or None"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+        modified = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], check=True,
+                                  stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if modified else '')
+
+
+def record_result(results_file: pathlib.Path, commit: str, benchmark: str, scale: int, durations: [float],
+                  succeeded: bool, server_version: int) -> dict:
+    """
+    Appends the result of a benchmark to the results file (one json object per line)
+
+    Args:
+        results_file: Where to keep the results
+        commit: The commit that was benchmarked
+        benchmark: The name of the benchmark
+        scale: The data size
+        durations: The run times of all repetitions in seconds
+        succeeded: Whether all repetitions succeeded
+        server_version: The version of the PostgreSQL server
+
+    Returns:
+        The recorded result
+    """
+    result = {'commit': commit, 'time': datetime.datetime.now().isoformat(timespec='seconds'),
+              'benchmark': benchmark, 'scale': scale, 'durations': [round(duration, 3) for duration in durations],
+              'median': round(statistics.median(durations), 3) if durations else None,
+              'succeeded': succeeded, 'server_version': server_version}
+    with results_file.open('a') as f:
+        f.write(json.dumps(result) + '\n')
+    return result
+
+
+def read_results(results_file: pathlib.Path) -> [dict]:
+    """All recorded results, oldest first"""
+    if not results_file.exists():
+        return []
+    with results_file.open() as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def previous_commit(results: [dict], commit: str) -> str:
+    """The last commit other than `commit` with recorded results"""
+    for result in reversed(results):
+        if result['commit'] != commit:
+            return result['commit']
+
+
+def print_comparison(results: [dict], commit: str, other_commit: str) -> None:
+    """
+    Prints the latest successful median run times of all benchmarks of a commit next to those of another commit
+
+    Args:
+        results: All recorded results
+        commit: The commit to compare, e.g. the current one
+        other_commit: The commit to compare with
+    """
+    def latest_medians(commit_: str) -> {(str, int): float}:
+        return {(result['benchmark'], result['scale']): result['median']
+                for result in results if result['commit'] == commit_ and result['succeeded']}
+
+    medians, other_medians = latest_medians(commit), latest_medians(other_commit)
+    print(f'\n{"benchmark":<40} {"scale":>6} {str(commit):>14} {str(other_commit):>14} {"change":>8}')
+    for (benchmark, scale), median in medians.items():
+        other_median = other_medians.get((benchmark, scale))
+        change = f'{(median - other_median) / other_median:+.1%}' if other_median else ''
+        print(f'{benchmark:<40} {scale:>6} {median:>13.2f}s '
+              + (f'{other_median:>13.2f}s' if other_median is not None else f'{"":>14}') + f' {change:>8}')
@@ -2,3 +2,8 @@
 def MARA_CONFIG_MODULES():
     from etl_tools import config
     return [config]
+
+
+def MARA_AUTOMIGRATE_SQLALCHEMY_MODELS():
+    from etl_tools import job_history
+    return [job_history.JobRun, job_history.JobRunDetail, job_history.JobLockWait]
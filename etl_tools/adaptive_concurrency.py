@@ -0,0 +1,189 @@
+"""Adapting the number of parallel tasks of a parallel task to the throughput and load of the involved databases"""
+
+import functools
+import multiprocessing
+import time
+import traceback
+
+import mara_db.postgresql
+from mara_pipelines.logging import logger
+
+
+@functools.total_ordering
+class AdaptiveConcurrency():
+    def __init__(self, label: str, min_number_of_parallel_tasks: int, max_number_of_parallel_tasks: int,
+                 target_db_alias: str, target_schema_name: str, other_db_aliases: [str] = None,
+                 sampling_interval: float = 10, max_waiting_fraction: float = 0.5) -> None:
+        """
+        A maximum number of parallel tasks that changes while the tasks run.
+
+        Meant to be set as `max_number_of_parallel_tasks` of the sub pipeline of a parallel task. The executor of
+        mara-pipelines (3.0.0) only checks that this limit is truthy and then compares it with `running < limit`
+        whenever it looks for the next task to run, so it behaves like an int in comparisons (and where an int is
+        required, via `__index__`). Reading it never blocks the executor: on first use, a separate process starts to
+        re-compute the limit every `sampling_interval` seconds (and keeps it in shared memory) from
+        - the throughput: the growth of all tables (including indexes) in `target_schema_name` in bytes and rows
+          (rows of committed transactions only) per second,
+        - the load: the fraction of active sessions in the target and other dbs that wait for locks (not for IO,
+          which is what most sessions of a copy do).
+
+        When too many sessions wait or when the throughput does not change, then the limit is decreased.
+        Otherwise the limit is moved one step at a time, in the same direction as long as the throughput increases
+        and in the other direction when it decreases. Each decision is logged. The sampling process stops when the
+        limit was not read for a sampling interval (when no task of the pipeline waits to be run).
+
+        Args:
+            label: A name for the log messages, e.g. the id of the parallel task
+            min_number_of_parallel_tasks: The lower bound for the limit
+            max_number_of_parallel_tasks: The upper bound for the limit
+            target_db_alias: The db that is written to
+            target_schema_name: The schema in the target db whose growth is measured
+            other_db_aliases: Other dbs whose load is considered (e.g. the source db of a copy)
+            sampling_interval: How many seconds to wait at least between two decisions
+            max_waiting_fraction: Decrease the limit when more than this fraction of active sessions wait
+        """
+        assert 1 <= min_number_of_parallel_tasks <= max_number_of_parallel_tasks, \
+            'Invalid bounds for the number of parallel tasks'
+        self.label = label
+        self.min_number_of_parallel_tasks = min_number_of_parallel_tasks
+        self.max_number_of_parallel_tasks = max_number_of_parallel_tasks
+        self.target_db_alias = target_db_alias
+        self.target_schema_name = target_schema_name
+        self.other_db_aliases = [db_alias for db_alias in other_db_aliases or [] if db_alias != target_db_alias]
+        self.sampling_interval = sampling_interval
+        self.max_waiting_fraction = max_waiting_fraction
+
+        # shared with the sampling process, which is forked like the task processes (no locks are needed
+        # for reading and writing single numbers)
+        multiprocessing_context = multiprocessing.get_context('fork')
+        self._limit = multiprocessing_context.RawValue('i', (min_number_of_parallel_tasks
+                                                             + max_number_of_parallel_tasks + 1) // 2)
+        self._last_read = multiprocessing_context.RawValue('d', 0)
+        self._sampling_process = None
+
+        self.direction = 1
+        self.last_sample = None  # (time, bytes, rows)
+        self.last_throughput = None
+
+    @property
+    def limit(self) -> int:
+        return self._limit.value
+
+    @limit.setter
+    def limit(self, limit: int) -> None:
+        self._limit.value = limit
+
+    def current_limit(self) -> int:
+        """The current maximum number of parallel tasks (as last computed by the sampling process)"""
+        self._last_read.value = time.time()
+        if not self._sampling_process or not self._sampling_process.is_alive():
+            self._sampling_process = multiprocessing.get_context('fork').Process(
+                target=self._sample, name=f'{self.label}: adaptive concurrency', daemon=True)
+            self._sampling_process.start()
+        return self.limit
+
+    def _sample(self) -> None:
+        """Re-computes the limit every sampling interval for as long as it is read"""
+        while True:
+            try:
+                self._decide()
+            except Exception:
+                # keep the current limit, the tasks themselves should not suffer from failed measurements
+                logger.log(f'{self.label}: could not measure throughput\n{traceback.format_exc()}',
+                           format=logger.Format.VERBATIM, is_error=True)
+            time.sleep(self.sampling_interval)
+            if time.time() - self._last_read.value > self.sampling_interval:
+                # the throughput in between says nothing about the limit, a new process starts from a new sample
+                return
+
+    def _decide(self) -> None:
+        number_of_bytes, number_of_rows, active, waiting = self._measure()
+        now = time.time()
+        if not self.last_sample:
+            self.last_sample = (now, number_of_bytes, number_of_rows)
+            logger.log(f'{self.label}: measuring throughput with {self.limit} parallel tasks '
+                       f'(between {self.min_number_of_parallel_tasks} and {self.max_number_of_parallel_tasks})',
+                       format=logger.Format.ITALICS)
+            return
+
+        last_time, last_bytes, last_rows = self.last_sample
+        throughput = max(0, number_of_bytes - last_bytes) / (now - last_time)
+        rows_per_second = max(0, number_of_rows - last_rows) / (now - last_time)
+        self.last_sample = (now, number_of_bytes, number_of_rows)
+
+        if active and waiting / active > self.max_waiting_fraction:
+            self.direction = -1
+            reason = 'too many waiting sessions'
+        elif self.last_throughput is None:
+            reason = 'probing'
+        elif throughput > self.last_throughput * 1.05:
+            reason = 'throughput increased'
+        elif throughput < self.last_throughput * 0.95:
+            self.direction = -self.direction
+            reason = 'throughput decreased'
+        else:
+            # prefer less load when more tasks don't help
+            self.direction = -1
+            reason = 'throughput unchanged'
+
+        new_limit = min(self.max_number_of_parallel_tasks,
+                        max(self.min_number_of_parallel_tasks, self.limit + self.direction))
+        if new_limit == self.limit:
+            # at a bound, probe in the other direction next time
+            self.direction = -self.direction
+
+        logger.log(f'{self.label}: {throughput / 1000000:.1f} MB/s, {rows_per_second:.0f} rows/s, '
+                   f'{waiting} of {active} active sessions waiting, {reason}: '
+                   f'{self.limit} → {new_limit} parallel tasks', format=logger.Format.ITALICS)
+        self.limit = new_limit
+        self.last_throughput = throughput
+
+    def _measure(self) -> (int, int, int, int):
+        """The size and number of inserted rows of the target schema, and the number of active & waiting sessions"""
+        activity_query = '''
+SELECT count(*),
+       count(*) FILTER (WHERE wait_event_type IN ('LWLock', 'Lock', 'BufferPin'))
+FROM pg_stat_activity
+WHERE datname = current_database() AND state = 'active' AND pid <> pg_backend_pid()'''
+
+        with mara_db.postgresql.postgres_cursor_context(self.target_db_alias) as cursor:
+            cursor.execute(f'''
+SELECT (SELECT coalesce(sum(pg_total_relation_size(pg_class.oid)), 0)
+        FROM pg_class
+        JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+        WHERE nspname = {'%s'} AND relkind IN ('r', 'm')),
+       (SELECT coalesce(sum(n_tup_ins), 0) FROM pg_stat_user_tables WHERE schemaname = {'%s'})''',
+                           (self.target_schema_name, self.target_schema_name))
+            number_of_bytes, number_of_rows = cursor.fetchone()
+            cursor.execute(activity_query)
+            active, waiting = cursor.fetchone()
+
+        for db_alias in self.other_db_aliases:
+            with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor:
+                cursor.execute(activity_query)
+                other_active, other_waiting = cursor.fetchone()
+                active += other_active
+                waiting += other_waiting
+
+        return int(number_of_bytes), int(number_of_rows), active, waiting
+
+    # `running < limit` in the executor falls back to `limit > running`, the other comparisons follow from these
+    def __eq__(self, other) -> bool:
+        return self.current_limit() == other if isinstance(other, int) else self is other
+
+    def __lt__(self, other: int) -> bool:
+        return self.current_limit() < other
+
+    __hash__ = object.__hash__
+
+    def __bool__(self) -> bool:
+        return True
+
+    def __index__(self) -> int:
+        return self.current_limit()
+
+    __int__ = __index__
+
+    def __repr__(self) -> str:
+        return (f'<AdaptiveConcurrency {self.limit} '
+                f'({self.min_number_of_parallel_tasks}-{self.max_number_of_parallel_tasks})>')
@@ -0,0 +1,195 @@
+"""Planning of balanced chunks for parallel processing of tables with skewed columns"""
+
+import re
+import typing
+
+import mara_db.postgresql
+import mara_pipelines.config
+
+from etl_tools import config
+
+
+class ChunkPlan():
+    def __init__(self, conditions: [str], fractions: [float], hash_max_fraction: float) -> None:
+        """
+        Balanced chunks of a table
+
+        Args:
+            conditions: For each chunk, an SQL condition that selects its rows
+            fractions: For each chunk, the estimated share of the rows of the table
+            hash_max_fraction: The estimated share of rows of the biggest chunk when chunking by `util.compute_chunk`
+        """
+        self.conditions = conditions
+        self.fractions = fractions
+        self.hash_max_fraction = hash_max_fraction
+
+    @property
+    def imbalance(self) -> float:
+        """How much bigger the biggest chunk is than a perfectly balanced chunk (1.0 = perfect balance)"""
+        return max(self.fractions, default=0) * len(self.fractions)
+
+    @property
+    def hash_imbalance(self) -> float:
+        """The imbalance of chunking the same column by `util.compute_chunk` into the same number of chunks"""
+        return self.hash_max_fraction * len(self.fractions)
+
+    def __repr__(self) -> str:
+        return (f'<ChunkPlan {len(self.conditions)} chunks, imbalance {self.imbalance:.2f} '
+                f'(instead of {self.hash_imbalance:.2f} with compute_chunk)>')
+
+
+def plan_chunks(schema_name: str, table_name: str, column_name: str, number_of_chunks: int = None,
+                db_alias: str = None, sample_percent: float = 1) -> ChunkPlan:
+    """
+    Splits a table into chunks of similar size based on the distribution of values in a column.
+
+    Values that make up more than the size of a chunk ("heavy hitters", including NULL) get a chunk of their own,
+    the remaining values are split into ranges of similar size. The distribution is taken from the column
+    statistics (`pg_stats`) or, when there is no histogram for the column, from a `TABLESAMPLE SYSTEM` sample.
+
+    Args:
+        schema_name: The schema of the table
+        table_name: The table to split
+        column_name: The column to split the table by
+        number_of_chunks: How many chunks to create at most, default: `config.number_of_chunks()`
+        db_alias: The database of the table, default: the default db alias
+        sample_percent: How many percent of the table to read when there are no statistics
+
+    Returns:
+        The conditions for each chunk and an estimate of their balance
+    """
+    number_of_chunks = number_of_chunks or config.number_of_chunks()
+    db_alias = db_alias or mara_pipelines.config.default_db_alias()
+
+    with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor:  # type: psycopg2.extensions.cursor
+        cursor.execute(f'''
+SELECT format_type(atttypid, atttypmod)
+FROM pg_attribute
+WHERE attrelid = '{schema_name}.{table_name}'::REGCLASS AND attname = {'%s'}''', (column_name,))
+        column_type = cursor.fetchone()[0]
+
+        cursor.execute(f'''
+SELECT null_frac, most_common_vals::TEXT::TEXT[], most_common_freqs, histogram_bounds::TEXT::TEXT[]
+FROM pg_stats
+WHERE schemaname = {'%s'} AND tablename = {'%s'} AND attname = {'%s'}''', (schema_name, table_name, column_name))
+        statistics = cursor.fetchone()
+
+        if statistics and statistics[3]:
+            null_fraction, values, frequencies, histogram_bounds = statistics
+            value_frequencies = list(zip(values or [], frequencies or []))
+            # bounds of ranges with the same number of rows (MCVs excluded), together with the MCVs in the
+            # order of the column type, so that MCVs that are not heavy hitters count for the range they fall into
+            histogram_fraction = 1 - null_fraction - sum(frequencies or [])
+            value_distribution = [(bound, histogram_fraction / (len(histogram_bounds) - 1))
+                                  for bound in histogram_bounds[1:]] + value_frequencies
+            cursor.execute(f'''
+SELECT value::TEXT, fraction
+FROM unnest({'%s'}::TEXT[]::{column_type}[], {'%s'}::FLOAT[]) t(value, fraction)
+ORDER BY t.value''', ([value for value, fraction in value_distribution],
+                    [fraction for value, fraction in value_distribution]))
+            value_distribution = cursor.fetchall()
+        else:
+            # sorted by the column (not by its text representation, which is only used for building conditions)
+            cursor.execute(f'''
+SELECT t."{column_name}"::TEXT, count(*)
+FROM {schema_name}.{table_name} t TABLESAMPLE SYSTEM ({sample_percent})
+GROUP BY t."{column_name}"
+ORDER BY t."{column_name}"''')
+            rows = cursor.fetchall()
+            total = sum(count for value, count in rows) or 1
+            null_fraction = sum(count for value, count in rows if value is None) / total
+            value_distribution = [(value, count / total) for value, count in rows if value is not None]
+            value_frequencies = value_distribution
+
+    return _chunk_plan(column_name, column_type, null_fraction, value_distribution, value_frequencies,
+                       number_of_chunks)
+
+
+def _chunk_plan(column_name: str, column_type: str, null_fraction: float, value_distribution: [(str, float)],
+                value_frequencies: [(str, float)], number_of_chunks: int) -> ChunkPlan:
+    """
+    Splits the distribution of a column into chunks
+
+    Args:
+        column_name: The column to split by
+        column_type: The type of the column, for casting the bounds of ranges
+        null_fraction: The share of NULL values
+        value_distribution: Values (as text) in the order of the column type, each with the share of rows that it
+                            stands for (up to the previous value for histogram bounds)
+        value_frequencies: Values (as text) with the share of rows with exactly that value, for finding heavy hitters
+        number_of_chunks: How many chunks to create at most
+    """
+    chunk_size = 1 / number_of_chunks
+    heavy_hitters = [(value, frequency) for value, frequency in value_frequencies if frequency >= chunk_size]
+    heavy_values = {value for value, frequency in heavy_hitters}
+
+    def literal(value: str) -> str:
+        if re.match(r'^[\w .:+-]*$', value):
+            return f"'{value}'::{column_type}"
+        # avoid any quoting issues
+        return f"convert_from(decode('{value.encode().hex()}', 'hex'), 'UTF8')::{column_type}"
+
+    conditions, fractions = [], []
+    if null_fraction >= chunk_size:
+        conditions.append(f'"{column_name}" IS NULL')
+        fractions.append(null_fraction)
+    for value, frequency in heavy_hitters:
+        conditions.append(f'"{column_name}" = {literal(value)}')
+        fractions.append(frequency)
+
+    # split the remaining values into ranges of similar size
+    remaining_distribution = [(value, fraction) for value, fraction in value_distribution
+                              if value not in heavy_values]
+    remaining_fraction = sum(fraction for value, fraction in remaining_distribution)
+    number_of_ranges = max(1, number_of_chunks - len(conditions))
+    bounds, range_fractions, current_fraction = [], [0], 0
+    for value, fraction in remaining_distribution:
+        if current_fraction >= remaining_fraction / number_of_ranges * (len(bounds) + 1) \
+                and len(bounds) < number_of_ranges - 1:
+            bounds.append(value)
+            range_fractions.append(0)
+        current_fraction += fraction
+        range_fractions[-1] += fraction
+
+    excluded_values = (f' AND "{column_name}" NOT IN ({", ".join(literal(value) for value in sorted(heavy_values))})'
+                       if heavy_values else '')
+    for i in range(len(bounds) + 1):
+        range_conditions = ([f'"{column_name}" >= {literal(bounds[i - 1])}'] if i > 0 else []) \
+                           + ([f'"{column_name}" < {literal(bounds[i])}'] if i < len(bounds) else [])
+        condition = ' AND '.join(range_conditions) or 'TRUE'
+        if null_fraction < chunk_size and i == 0:
+            # rows with NULL values go into the first range
+            condition = f'({condition}{excluded_values} OR "{column_name}" IS NULL)'
+            range_fractions[i] += null_fraction
+        else:
+            condition = f'{condition}{excluded_values}'
+        conditions.append(condition)
+        fractions.append(range_fractions[i])
+
+    # with compute_chunk, the biggest value (or NULL) ends up in one chunk together with an average share of the rest
+    biggest_fraction = max([null_fraction] + [frequency for value, frequency in value_frequencies])
+    hash_max_fraction = biggest_fraction + (1 - biggest_fraction) / number_of_chunks
+
+    return ChunkPlan(conditions=conditions, fractions=fractions, hash_max_fraction=hash_max_fraction)
+
+
+def chunk_parameter_function(schema_name: str, table_name: str, column_name: str, number_of_chunks: int = None,
+                             db_alias: str = None, sample_percent: float = 1) -> typing.Callable:
+    """
+    Returns a parameter function for parallel tasks that returns the conditions of balanced chunks of a table,
+    see `plan_chunks`.
+
+    Example:
+        ParallelExecuteSQL(id='process_orders', ..
+            sql_statement='INSERT INTO foo.order_tmp SELECT .. FROM bar.order WHERE @chunk_condition@',
+            parameter_function=chunk_planner.chunk_parameter_function('bar', 'order', 'merchant_id'),
+            parameter_placeholders=['@chunk_condition@'])
+    """
+
+    def parameter_function() -> [(str,)]:
+        plan = plan_chunks(schema_name, table_name, column_name, number_of_chunks=number_of_chunks,
+                           db_alias=db_alias, sample_percent=sample_percent)
+        # the comment makes the conditions (and the task ids derived from them) unique
+        return [(f'/* chunk {i} */ {condition}',) for i, condition in enumerate(plan.conditions)]
+
+    return parameter_function
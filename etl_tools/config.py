@@ -16,3 +16,26 @@ def last_date_in_time_dimensions() -> datetime.date:
 def number_of_chunks() -> int:
     """Big tables and computations are split into this many chunks"""
     return 7
+
+
+def euro_exchange_rates_url() -> str:
+    """The url (or local path) of the zip file with the history of Euro exchange rates from the ECB"""
+    return 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip'
+
+
+def euro_exchange_rates_cache_file() -> str:
+    """When set, downloads of the Euro exchange rates are kept in this file and only repeated when they changed"""
+    return None
+
+
+def euro_exchange_rates_refresh_interval() -> float:
+    """
+    For how many seconds the in-memory exchange rates of `load_euro_exchange_rates.convert` are used
+    before checking again whether `euro_fx.exchange_rate` changed
+    """
+    return 60
+
+
+def schema_check_cache_file() -> str:
+    """When set, the results of scanning pipeline directories for schema names are kept in this file between runs"""
+    return None
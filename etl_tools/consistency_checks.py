@@ -0,0 +1,283 @@
+"""Running many consistency checks with as few table scans as possible and reporting all failures at once"""
+
+import abc
+import concurrent.futures
+import operator
+import time
+import traceback
+
+import mara_db.postgresql
+import mara_pipelines.config
+from mara_pipelines.logging import logger
+from mara_pipelines.pipelines import Command
+from mara_page import _, html
+
+
+class Aggregate():
+    def __init__(self, table_name: str, expression: str, condition: str = None) -> None:
+        """
+        A value computed over a table, e.g. `Aggregate('dim.order', 'count(*)', 'order_date > now()')`.
+
+        All aggregates on the same table are computed in one query, those with a condition as
+        `<expression> FILTER (WHERE <condition>)`.
+
+        Args:
+            table_name: The table (or view) to compute the value from, including schema
+            expression: An aggregate expression, a single aggregate function call when there is a condition
+            condition: An optional filter for the rows of the table
+        """
+        self.table_name = table_name
+        self.expression = expression
+        self.condition = condition
+
+    def __str__(self) -> str:
+        return (f'SELECT {self.expression} FROM {self.table_name}'
+                + (f' WHERE {self.condition}' if self.condition else ''))
+
+    def select_expression(self) -> str:
+        """The expression in a query over all rows of the table"""
+        return self.expression + (f' FILTER (WHERE {self.condition})' if self.condition else '')
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Aggregate) and str(self) == str(other)
+
+    def __hash__(self) -> int:
+        return hash(('aggregate', str(self)))
+
+
+class Assertion(abc.ABC):
+    """Base class for declarative consistency checks"""
+
+    def __init__(self, description: str) -> None:
+        self.description = description
+
+    def values(self) -> ['Aggregate|str|float']:
+        """The aggregates, scalar queries and constants the assertion needs"""
+        return []
+
+    @abc.abstractmethod
+    def failure(self, results: {object: object}) -> str:
+        """Returns a description of what is wrong (or None when the assertion holds) given the computed values"""
+
+
+class AssertRelation(Assertion):
+    relations = {'=': operator.eq, '!=': operator.ne, '<>': operator.ne, '<': operator.lt, '<=': operator.le,
+                 '>': operator.gt, '>=': operator.ge}
+
+    def __init__(self, description: str, value1: 'Aggregate|str|float', value2: 'Aggregate|str|float',
+                 relation: str = '=') -> None:
+        """
+        Checks that two values satisfy a relation, like `util.assert_relation`
+
+        Args:
+            description: What is checked
+            value1: An `Aggregate`, a query that returns a single number, or a number
+            value2: An `Aggregate`, a query that returns a single number, or a number
+            relation: One of '=', '!=', '<>', '<', '<=', '>', '>='
+        """
+        assert relation in self.relations, f'Unknown relation "{relation}"'
+        super().__init__(description)
+        self.value1 = value1
+        self.value2 = value2
+        self.relation = relation
+
+    def values(self):
+        return [self.value1, self.value2]
+
+    def failure(self, results):
+        result1, result2 = results[self.value1], results[self.value2]
+        if result1 is None or result2 is None or not self.relations[self.relation](result1, result2):
+            return (f'assertion failed: {result1} {self.relation} {result2}\n'
+                    f'{result1}: ({self.value1})\n{result2}: ({self.value2})')
+
+
+class AssertAlmostEqual(Assertion):
+    def __init__(self, description: str, value1: 'Aggregate|str|float', value2: 'Aggregate|str|float',
+                 percentage: float) -> None:
+        """
+        Checks that the second value differs at most by a fraction from the first one, like `util.assert_almost_equal`
+
+        Args:
+            description: What is checked
+            value1: An `Aggregate`, a query that returns a single number, or a number
+            value2: An `Aggregate`, a query that returns a single number, or a number
+            percentage: The maximum allowed relative difference, e.g. 0.01 for 1%
+        """
+        super().__init__(description)
+        self.value1 = value1
+        self.value2 = value2
+        self.percentage = percentage
+
+    def values(self):
+        return [self.value1, self.value2]
+
+    def failure(self, results):
+        result1, result2 = results[self.value1], results[self.value2]
+        if result1 is None or result2 is None \
+                or (result1 != 0 and not abs((float(result2) - float(result1)) / float(result1)) < self.percentage):
+            return (f'assertion failed: abs(({result2} - {result1}) / {result1}) < {self.percentage}\n'
+                    f'{result1}: ({self.value1})\n{result2}: ({self.value2})')
+
+
+class AssertNotFound(Assertion):
+    def __init__(self, description: str, query: str) -> None:
+        """
+        Checks that a query which returns all rows that are inconsistent returns nothing, like `util.assert_not_found`
+
+        Args:
+            description: What is checked
+            query: A query that returns the failing rows
+        """
+        super().__init__(description)
+        self.query = query
+
+    def values(self):
+        return [_RowsQuery(self.query)]
+
+    def failure(self, results):
+        rows = results[_RowsQuery(self.query)]
+        if rows:
+            return 'assertion failed for:\n' + '\n'.join(', '.join(f'{key} = {value}' for key, value in row.items())
+                                                       for row in rows)
+
+
+class Assert(Assertion):
+    def __init__(self, description: str, query: str) -> None:
+        """
+        Checks that a query returns true, like `util.assert`
+
+        Args:
+            description: What is checked
+            query: A query that returns a single boolean value
+        """
+        super().__init__(description)
+        self.query = query
+
+    def values(self):
+        return [self.query]
+
+    def failure(self, results):
+        if results[self.query] is not True:
+            return f'assertion failed:\n{self.query}'
+
+
+class _RowsQuery(str):
+    """A query whose (first 20) rows are fetched instead of a single value"""
+
+    def __hash__(self):
+        return hash(('rows', str(self)))
+
+    def __eq__(self, other):
+        return isinstance(other, _RowsQuery) and str(self) == str(other)
+
+
+class RunConsistencyChecks(Command):
+    def __init__(self, assertions: [Assertion], db_alias: str = None,
+                 max_number_of_parallel_queries: int = None) -> None:
+        """
+        Runs a list of consistency checks and reports all failing checks at once.
+
+        Aggregates on the same table are computed in a single query (conditions become `FILTER` clauses),
+        the queries run in parallel on several connections.
+
+        Example:
+            RunConsistencyChecks([
+                AssertRelation('Orders have items',
+                               Aggregate('dim.order', 'count(*)'),
+                               Aggregate('dim.order_item', 'count(DISTINCT order_fk)')),
+                AssertAlmostEqual('Revenue matches',
+                                  Aggregate('dim.order', 'sum(revenue)'),
+                                  Aggregate('dim.order_item', 'sum(revenue)'), percentage=0.001),
+                AssertNotFound('No orders from the future', 'SELECT order_id FROM dim.order WHERE order_date > now()')
+            ])
+
+        Args:
+            assertions: The checks to run
+            db_alias: The database to run the checks in
+            max_number_of_parallel_queries: How many queries to run in parallel at most
+        """
+        super().__init__()
+        self.assertions = assertions
+        self._db_alias = db_alias
+        self.max_number_of_parallel_queries = max_number_of_parallel_queries
+
+    @property
+    def db_alias(self):
+        return self._db_alias or mara_pipelines.config.default_db_alias()
+
+    def queries(self) -> [(str, [object])]:
+        """All queries to run, each with the values that it computes"""
+        aggregates_per_table = {}
+        queries = []
+        for assertion in self.assertions:
+            for value in assertion.values():
+                if isinstance(value, Aggregate):
+                    aggregates = aggregates_per_table.setdefault(value.table_name, [])
+                    if value not in aggregates:
+                        aggregates.append(value)
+                elif isinstance(value, _RowsQuery):
+                    queries.append((f"SELECT * FROM ({value.strip().rstrip(';')}) q LIMIT 20", [value]))
+                elif isinstance(value, str):
+                    queries.append((value, [value]))
+
+        for table_name, aggregates in aggregates_per_table.items():
+            queries.append((f'SELECT ' + ',\n       '.join(aggregate.select_expression() for aggregate in aggregates)
+                            + f'\nFROM {table_name}', aggregates))
+
+        # run each distinct query only once
+        return list({query: values for query, values in queries}.items())
+
+    def run(self) -> bool:
+        results = {}
+        errors = []
+
+        def run_query(query: str, values: [object]) -> None:
+            with mara_db.postgresql.postgres_cursor_context(self.db_alias) as cursor:
+                cursor.execute(query)
+                if isinstance(values[0], _RowsQuery):
+                    column_names = [column.name for column in cursor.description]
+                    results[values[0]] = [dict(zip(column_names, row)) for row in cursor.fetchall()]
+                else:
+                    for value, result in zip(values, cursor.fetchone()):
+                        results[value] = result
+
+        queries = self.queries()
+        start_time = time.time()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_number_of_parallel_queries
+                            or mara_pipelines.config.max_number_of_parallel_tasks()) as executor:
+            futures = {executor.submit(run_query, query, values): query for query, values in queries}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    errors.append(futures[future])
+                    logger.log(f'{futures[future]}\n\n{traceback.format_exc()}', format=logger.Format.VERBATIM,
+                               is_error=True)
+
+        number_of_failures = 0
+        for assertion in self.assertions:
+            # constants are their own result
+            for value in assertion.values():
+                if not isinstance(value, (Aggregate, str)):
+                    results[value] = value
+            if any(value not in results for value in assertion.values()):
+                number_of_failures += 1
+                logger.log(f'{assertion.description}\ncould not be checked', format=logger.Format.VERBATIM,
+                           is_error=True)
+                continue
+            failure = assertion.failure(results)
+            if failure:
+                number_of_failures += 1
+                logger.log(f'{assertion.description}\n{failure}', format=logger.Format.VERBATIM, is_error=True)
+
+        logger.log(f'{len(self.assertions) - number_of_failures} of {len(self.assertions)} checks succeeded '
+                   f'({len(queries)} queries in {time.time() - start_time:.1f} seconds)',
+                   format=logger.Format.ITALICS)
+        return number_of_failures == 0 and not errors
+
+    def html_doc_items(self) -> [(str, str)]:
+        return [('db', _.tt[self.db_alias]),
+                ('assertions', _.ul[[_.li[assertion.description] for assertion in self.assertions]]),
+                ('queries', html.highlight_syntax('\n\n'.join(query + ';' for query, values in self.queries()),
+                                                  'sql'))]
@@ -0,0 +1,187 @@
+"""In-process streaming of binary COPY data from one PostgreSQL database to another"""
+
+import queue
+import threading
+import time
+import traceback
+
+import mara_db.postgresql
+from mara_pipelines.logging import logger
+from mara_pipelines.pipelines import Command
+from mara_page import _
+
+
+class _BoundedPipe():
+    def __init__(self, block_size: int, max_number_of_blocks: int) -> None:
+        """
+        A file-like object that passes data from a `COPY .. TO STDOUT` to a `COPY .. FROM STDIN` in another thread.
+
+        Writes are collected into blocks of `block_size` bytes, at most `max_number_of_blocks` blocks are buffered.
+
+        Args:
+            block_size: The size of the blocks that are handed over to the reader
+            max_number_of_blocks: How many blocks to buffer before the writer blocks
+        """
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=max_number_of_blocks)
+        self.current_block = bytearray()
+        self.number_of_bytes = 0
+        self.writer_exception = None
+        self.reader_aborted = False
+
+    def write(self, data: bytes) -> None:
+        self.current_block += data
+        self.number_of_bytes += len(data)
+        if len(self.current_block) >= self.block_size:
+            self._put(bytes(self.current_block))
+            self.current_block = bytearray()
+
+    def close_writer(self, exception: Exception = None) -> None:
+        """Called by the writing thread when there is no more data (or when the source failed)"""
+        self.writer_exception = exception
+        if self.current_block and not exception:
+            self._put(bytes(self.current_block))
+        self._put(None)
+
+    def read(self, size: int = -1) -> bytes:
+        if self.reader_aborted:
+            return b''
+        block = self.blocks.get()
+        if block is None:
+            self.reader_aborted = True
+            if self.writer_exception:
+                raise self.writer_exception
+            return b''
+        return block
+
+    def abort_reader(self) -> None:
+        """Called when the reading side failed so that the writer does not block forever"""
+        self.reader_aborted = True
+
+    def _put(self, block: bytes) -> None:
+        while True:
+            if self.reader_aborted:
+                if block is None:
+                    return
+                raise InterruptedError('COPY FROM STDIN was aborted')
+            try:
+                self.blocks.put(block, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+
+def copy_binary(source_db_alias: str, target_db_alias: str, source: str, target_table: str,
+                block_size: int = 1024 * 1024, max_number_of_blocks: int = 16, freeze: bool = False,
+                sql_before: str = None, sql_after: str = None) -> (int, int):
+    """
+    Streams `COPY .. (FORMAT binary)` from a source db to a target db using one psycopg2 connection each
+
+    Source and target columns need to have exactly the same types (as it is the case for copied schemas).
+
+    Args:
+        source_db_alias: The alias of the PostgreSQL database to copy from
+        target_db_alias: The alias of the PostgreSQL database to copy to
+        source: A table name or a query in parenthesis, e.g. `(SELECT * FROM foo.bar WHERE baz)`
+        target_table: The table to copy into
+        block_size: The size of the blocks (in bytes) that are passed from the source to the target connection
+        max_number_of_blocks: How many blocks to buffer at most
+        freeze: When true, the target table is truncated and loaded with `COPY .. FREEZE` in the same transaction
+        sql_before: Statements that are run on the target db before the copy, in the same transaction
+        sql_after: Statements that are run on the target db after the copy, in the same transaction
+
+    Returns:
+        The number of copied rows and bytes
+    """
+    pipe = _BoundedPipe(block_size=block_size, max_number_of_blocks=max_number_of_blocks)
+
+    def copy_to_pipe():
+        try:
+            with mara_db.postgresql.postgres_cursor_context(source_db_alias) as cursor:
+                cursor.copy_expert(f'COPY {source} TO STDOUT (FORMAT binary)', pipe)
+        except Exception as e:
+            pipe.close_writer(exception=e)
+        else:
+            pipe.close_writer()
+
+    source_thread = threading.Thread(target=copy_to_pipe, name='copy-to-pipe', daemon=True)
+    source_thread.start()
+    try:
+        with mara_db.postgresql.postgres_cursor_context(target_db_alias) as cursor:
+            if freeze:
+                cursor.execute(f'TRUNCATE {target_table}')
+            if sql_before:
+                cursor.execute(sql_before)
+            cursor.copy_expert(f'COPY {target_table} FROM STDIN (FORMAT binary{", FREEZE" if freeze else ""})',
+                               pipe, size=block_size)
+            number_of_rows = cursor.rowcount
+            if sql_after:
+                cursor.execute(sql_after)
+    finally:
+        pipe.abort_reader()
+        source_thread.join()
+
+    if pipe.writer_exception:
+        raise pipe.writer_exception
+
+    return number_of_rows, pipe.number_of_bytes
+
+
+class StreamBinaryCopy(Command):
+    def __init__(self, source_db_alias: str, target_db_alias: str, source: str, target_table: str,
+                 block_size: int = 1024 * 1024, max_number_of_blocks: int = 16, freeze: bool = False,
+                 sql_before: str = None, sql_after: str = None) -> None:
+        """
+        Copies data between two PostgreSQL databases in binary format, without client processes
+
+        Args:
+            source_db_alias: The alias of the PostgreSQL database to copy from
+            target_db_alias: The alias of the PostgreSQL database to copy to
+            source: A table name or a query in parenthesis, e.g. `(SELECT * FROM foo.bar WHERE baz)`
+            target_table: The table to copy into
+            block_size: The size of the blocks (in bytes) that are passed from the source to the target connection
+            max_number_of_blocks: How many blocks to buffer at most
+            freeze: When true, the target table is truncated and loaded with `COPY .. FREEZE` in the same transaction
+            sql_before: Statements that are run on the target db before the copy, in the same transaction
+            sql_after: Statements that are run on the target db after the copy, in the same transaction
+        """
+        super().__init__()
+        self.source_db_alias = source_db_alias
+        self.target_db_alias = target_db_alias
+        self.source = source
+        self.target_table = target_table
+        self.block_size = block_size
+        self.max_number_of_blocks = max_number_of_blocks
+        self.freeze = freeze
+        self.sql_before = sql_before
+        self.sql_after = sql_after
+        self.number_of_rows = None
+
+    def run(self) -> bool:
+        logger.log(f'COPY {self.source} TO {self.target_table} (FORMAT binary)', format=logger.Format.ITALICS)
+        start_time = time.time()
+        try:
+            number_of_rows, number_of_bytes = copy_binary(
+                self.source_db_alias, self.target_db_alias, self.source, self.target_table,
+                block_size=self.block_size, max_number_of_blocks=self.max_number_of_blocks, freeze=self.freeze,
+                sql_before=self.sql_before, sql_after=self.sql_after)
+        except Exception:
+            logger.log(traceback.format_exc(), format=logger.Format.VERBATIM, is_error=True)
+            return False
+
+        self.number_of_rows = number_of_rows
+        duration = max(time.time() - start_time, 0.001)
+        logger.log(f'{number_of_rows} rows, {number_of_bytes / 1000000:.1f} MB in {duration:.1f} seconds '
+                   f'({number_of_bytes / 1000000 / duration:.1f} MB/s)', format=logger.Format.ITALICS)
+        return True
+
+    def html_doc_items(self) -> [(str, str)]:
+        return [('source db', _.tt[self.source_db_alias]),
+                ('source', _.tt[self.source]),
+                ('target db', _.tt[self.target_db_alias]),
+                ('target table', _.tt[self.target_table]),
+                ('block size', _.tt[self.block_size]),
+                ('max number of blocks', _.tt[self.max_number_of_blocks]),
+                ('freeze', _.tt[repr(self.freeze)]),
+                ('sql before', _.pre[self.sql_before or '']),
+                ('sql after', _.pre[self.sql_after or ''])]
@@ -1,21 +1,28 @@
 """Parallel creation of an attribute lookup table for another table (e.g. for auto-completion)"""
 
-import math
+import uuid
 
 import mara_pipelines.config
 import mara_pipelines.config
 import mara_db.postgresql
-import more_itertools
 from mara_pipelines.commands.sql import ExecuteSQL
-from mara_pipelines.pipelines import Pipeline, ParallelTask, Task
+from mara_pipelines.pipelines import Pipeline, ParallelTask, Task, Command
 from mara_page import _
 
+from etl_tools import job_history, utils
+from etl_tools.adaptive_concurrency import AdaptiveConcurrency
+
 
 class CreateAttributesTable(ParallelTask):
     def __init__(self, id: str, source_schema_name: str, source_table_name: str,
                  db_alias: str = None,
                  attributes_table_suffix: str = '_attributes',
-                 max_number_of_parallel_tasks: int = None) -> None:
+                 max_number_of_parallel_tasks: int = None, min_number_of_parallel_tasks: int = None,
+                 single_scan: bool = False, chunk_column: str = None,
+                 incremental: bool = False, changed_chunks_query: str = None,
+                 top_k: {str: int} = None, sample_percent: {str: float} = None,
+                 max_distinct_values: int = None, distinct_values_estimate: str = 'pg_stats',
+                 run_report: bool = True) -> None:
         """
         Creates an indexed lookup table for providing fast auto-completion on the values of a table
 
@@ -42,6 +49,30 @@ class CreateAttributesTable(ParallelTask):
             db_alias: The database alias for the source and attributes table
             attributes_table_suffix: This suffix will be appended to the source table name
             max_number_of_parallel_tasks: How many child tasks to run at most
+            min_number_of_parallel_tasks: When set, then the number of parallel child tasks is adapted to the
+                                          throughput and load of the db, between this and
+                                          `max_number_of_parallel_tasks` (see `etl_tools.adaptive_concurrency`)
+            single_scan: When true, then the values of all columns are collected in one pass over the source
+                         table instead of one pass per column
+            chunk_column: In single scan mode, split the scan into `number_of_chunks` parallel passes by
+                          `util.compute_chunk` on this column. The per chunk counts are merged afterwards.
+            incremental: When true, then the counts per chunk are kept between runs and the attributes table is
+                         updated in place (implies `single_scan`, requires `chunk_column`)
+            changed_chunks_query: In incremental mode, a query that returns the chunks that changed since the last
+                                  run, e.g. 'SELECT chunk FROM foo.bar_changed_chunks'. Default: all chunks
+                                  (and all chunks when the columns changed or the last run did not finish)
+            top_k: Per column, how many of the most frequent values to keep at most, e.g. `{'comment': 1000}`
+            sample_percent: Per column, count values only in a `TABLESAMPLE SYSTEM` sample of this many percent
+                            of the source table and scale the row counts accordingly (not in single scan mode)
+            max_distinct_values: Skip columns with more (estimated) distinct values than this
+            distinct_values_estimate: How to estimate the number of distinct values of a column, 'pg_stats'
+                                      (from the statistics of the source table, columns without statistics are not
+                                      skipped) or 'hll' (one scan of the source table, requires the hll extension)
+            run_report: Whether to log rows, bytes, durations, throughput, lock wait and queueing times per column
+                        (and scan) and the critical path as JSON at the end (see `etl_tools.job_history.run_report`)
+
+        The columns are distributed over tasks by the durations of their computation in previous runs
+        (see `etl_tools.job_history`), with an estimate from the table size for new columns.
         """
         super().__init__(id,
                          description=f'Creates an attributes lookup table on {source_schema_name}.{source_table_name}.',
@@ -51,10 +82,39 @@ class CreateAttributesTable(ParallelTask):
         self.source_table_name = source_table_name
         self.attributes_table_suffix = attributes_table_suffix
         self.db_alias = db_alias or mara_pipelines.config.default_db_alias()
+        assert not incremental or chunk_column, 'incremental mode requires a chunk column'
+        assert not (single_scan or incremental) or not sample_percent, 'sampling is not possible in single scan mode'
+        assert not (single_scan or incremental) or chunk_column or not top_k, \
+            'top k values in single scan mode require a chunk column'
+        assert distinct_values_estimate in ('pg_stats', 'hll'), \
+            f'Unknown distinct values estimate "{distinct_values_estimate}"'
+
+        self.min_number_of_parallel_tasks = min_number_of_parallel_tasks
+        self.single_scan = single_scan or incremental
+        self.chunk_column = chunk_column
+        self.incremental = incremental
+        self.changed_chunks_query = changed_chunks_query
+        self.top_k = top_k or {}
+        self.sample_percent = sample_percent or {}
+        self.max_distinct_values = max_distinct_values
+        self.distinct_values_estimate = distinct_values_estimate
+        self.run_report = run_report
+        self._run_id = None
+        self._report_jobs = {}
 
     def add_parallel_tasks(self, sub_pipeline: Pipeline) -> None:
         attributes_table_name = f'{self.source_schema_name}.{self.source_table_name}{self.attributes_table_suffix}'
 
+        if self.min_number_of_parallel_tasks:
+            sub_pipeline.max_number_of_parallel_tasks = AdaptiveConcurrency(
+                label=self.id, min_number_of_parallel_tasks=self.min_number_of_parallel_tasks,
+                max_number_of_parallel_tasks=(self.max_number_of_parallel_tasks
+                                              or mara_pipelines.config.max_number_of_parallel_tasks()),
+                target_db_alias=self.db_alias, target_schema_name=self.source_schema_name)
+
+        self._run_id = f'{self._job_id()}{uuid.uuid4().hex}' if self.run_report else None
+        self._report_jobs = {}
+
         ddl = f'''
 DROP TABLE IF EXISTS {attributes_table_name};
 
@@ -65,7 +125,7 @@ CREATE TABLE {attributes_table_name} (
 ) PARTITION BY LIST (attribute);
 '''
 
-        commands = []
+        commands = {}
 
         with mara_db.postgresql.postgres_cursor_context(self.db_alias) as cursor:  # type: psycopg2.extensions.cursor
             cursor.execute(f'''
@@ -85,38 +145,305 @@ FROM information_schema.columns
       AND (data_type IN ('text', 'varchar') OR enums.typname IS NOT NULL);
 ''', (self.source_schema_name, self.source_table_name))
 
+            column_names = [column_name for column_name, in cursor.fetchall()]
+
+            if self.max_distinct_values is not None and column_names:
+                number_of_distinct_values = self._number_of_distinct_values(cursor, column_names)
+                column_names = [column_name for column_name in column_names
+                                if number_of_distinct_values.get(column_name, 0) <= self.max_distinct_values]
+
+            cursor.execute(f"SELECT pg_relation_size('{self.source_schema_name}.{self.source_table_name}') / 1000000.0")
+            table_size = float(cursor.fetchone()[0])
+
             i = 0
 
-            for column_name, in cursor.fetchall():
+            for column_name in column_names:
                 i += 1
                 ddl += f"""
 CREATE TABLE {attributes_table_name}_{i} PARTITION OF {attributes_table_name} FOR VALUES IN ('{column_name}');
 """
-                commands.append(
-                    ExecuteSQL(sql_statement=f'''
-INSERT INTO {attributes_table_name}_{i} 
-SELECT '{column_name}', "{column_name}", count(*)
-FROM {self.source_schema_name}.{self.source_table_name}
-WHERE "{column_name}" IS NOT NULL
-GROUP BY "{column_name}"
-ORDER BY "{column_name}";
-
+                commands[self._job_id(column_name)] = self._record_job_run(
+                    self._job_id(column_name), 'attribute', column_name, table_size,
+                    ExecuteSQL(sql_statement=self._column_statement(attributes_table_name, i, column_name)
+                                             + f'''
 CREATE INDEX {self.source_table_name}_{self.attributes_table_suffix}_{i}__value 
    ON {attributes_table_name}_{i} USING GIN (value gin_trgm_ops);
-''', echo_queries=False))
+''', echo_queries=False), relation_name=f'{attributes_table_name}_{i}')
 
-        sub_pipeline.add_initial(
-            Task(id='create_table', description='Creates the attributes table',
-                 commands=[ExecuteSQL(sql_statement=ddl, echo_queries=False)]))
+        update_in_place = False
+        if self.single_scan and column_names:
+            if self.incremental:
+                update_in_place, chunks = utils.chunks_to_compute(
+                    self.db_alias, f'{attributes_table_name}__chunks', self._definition_hash(column_names),
+                    self.changed_chunks_query)
+            else:
+                chunks = [chunk for chunk, in utils.chunk_parameter_function()]
+            commands, scan_tasks, ddl = self._single_scan(attributes_table_name, column_names, table_size,
+                                                          ddl='' if update_in_place else ddl, chunks=chunks,
+                                                          update_in_place=update_in_place)
+        else:
+            scan_tasks = []
 
-        chunk_size = math.ceil(len(commands) / (2 * mara_pipelines.config.max_number_of_parallel_tasks()))
-        for n, chunk in enumerate(more_itertools.chunked(commands, chunk_size)):
+        if ddl:
+            sub_pipeline.add_initial(
+                Task(id='create_table', description='Creates the attributes table',
+                     commands=[ExecuteSQL(sql_statement=ddl, echo_queries=False)]))
+        if self.single_scan and self.chunk_column and not scan_tasks:
+            return  # no changed chunks
+        if update_in_place:
+            sub_pipeline.add_initial(
+                Task(id='invalidate_chunks_table', description='Marks the attribute counts per chunk as incomplete',
+                     commands=[ExecuteSQL(
+                         sql_statement=utils.invalidate_chunks_table_statement(f'{attributes_table_name}__chunks'),
+                         echo_queries=False, db_alias=self.db_alias)]))
+        for scan_task in scan_tasks:
+            sub_pipeline.add(scan_task)
+
+        durations = job_history.estimate_durations({job_id: table_size for job_id in commands.keys()},
+                                                   job_id_prefix=self._job_id())
+        for n, job_ids in enumerate(job_history.pack(
+                durations, number_of_bins=2 * mara_pipelines.config.max_number_of_parallel_tasks())):
             task = Task(id=str(n), description='Process a portion of the attributes')
-            task.add_commands(chunk)
-            sub_pipeline.add(task)
+            task.add_commands([commands[job_id] for job_id in job_ids])
+            sub_pipeline.add(task, upstreams=scan_tasks)
+
+        if self._run_id:
+            job_history.sample_lock_waits(self._run_id, sub_pipeline, self.path(), self.db_alias)
+            other_nodes = [node for node in sub_pipeline.nodes.values()
+                           if node not in (sub_pipeline.initial_node, sub_pipeline.final_node)]
+            sub_pipeline.add(
+                Task(id='report', description='Logs throughput metrics and the critical path of the computation',
+                     commands=[job_history.LogRunReport(
+                         run_id=self._run_id, jobs=self._report_jobs,
+                         upstream_tasks={node.id: [upstream.id for upstream in node.upstreams]
+                                         for node in other_nodes},
+                         db_alias=self.db_alias)]),
+                upstreams=other_nodes)
+
+        if self.single_scan and self.chunk_column and column_names and self.incremental:
+            sub_pipeline.add_final(
+                Task(id='validate_chunks_table', description='Marks the attribute counts per chunk as complete',
+                     commands=[ExecuteSQL(sql_statement=utils.validate_chunks_table_statement(
+                         f'{attributes_table_name}__chunks', self._definition_hash(column_names)),
+                         echo_queries=False, db_alias=self.db_alias)]))
+        elif self.single_scan and self.chunk_column and column_names:
+            sub_pipeline.add_final(
+                Task(id='drop_chunks_table', description='Removes the table with the attribute counts per chunk',
+                     commands=[ExecuteSQL(sql_statement=f'DROP TABLE {attributes_table_name}__chunks;',
+                                          echo_queries=False)]))
+
+    def _single_scan(self, attributes_table_name: str, column_names: [str], table_size: float, ddl: str,
+                     chunks: [int] = None, update_in_place: bool = False) -> ({str: Command}, [Task], str):
+        """
+        Creates the tasks for reading all columns in one pass per chunk of the source table.
+
+        Args:
+            attributes_table_name: The name of the attributes table including schema
+            column_names: The columns of the source table to read
+            table_size: The size of the source table in MB
+            ddl: The statement for creating the attributes table, empty when the tables already exist
+            chunks: The chunks to (re-)compute
+            update_in_place: When true, then the attributes table is updated instead of filled from scratch
+
+        Returns:
+            The per column commands (merging counts of chunks & creating indexes), the scan tasks and the ddl
+        """
+        source_table_name = f'{self.source_schema_name}.{self.source_table_name}'
+        values = ',\n    '.join(f"""('{column_name}', t."{column_name}"::TEXT)""" for column_name in column_names)
+
+        def scan_statement(target_table_name: str, chunk: int = None) -> str:
+            if chunk is None:
+                return f'''
+INSERT INTO {target_table_name} (attribute, value, row_count)
+SELECT attribute, value, count(*)
+FROM {source_table_name} t
+CROSS JOIN LATERAL (VALUES
+    {values}) attributes (attribute, value)
+WHERE value IS NOT NULL
+GROUP BY attribute, value
+ORDER BY attribute, value;
+'''
+            return utils.chunk_statement(target_table_name, chunk, f'''
+INSERT INTO {target_table_name} (chunk, attribute, value, row_count)
+SELECT {chunk}, attribute, value, count(*)
+FROM {source_table_name} t
+CROSS JOIN LATERAL (VALUES
+    {values}) attributes (attribute, value)
+WHERE value IS NOT NULL
+      AND util.compute_chunk(t."{self.chunk_column}") = {chunk}
+GROUP BY attribute, value;
+''', update_in_place)
+
+        commands = {}
+        if self.chunk_column:
+            if ddl:
+                ddl += f'''
+DROP TABLE IF EXISTS {attributes_table_name}__chunks;
+
+CREATE TABLE {attributes_table_name}__chunks (
+    chunk     SMALLINT NOT NULL,
+    attribute TEXT NOT NULL, 
+    value     TEXT NOT NULL, 
+    row_count BIGINT NOT NULL
+) PARTITION BY LIST (attribute);
+'''
+            scan_tasks = [Task(id=f'scan_chunk_{chunk}',
+                               description=f'Counts the values of all attributes in chunk {chunk}',
+                               commands=[self._record_job_run(
+                                   self._scan_job_id(chunk), 'scan', f'chunk {chunk}', table_size / len(chunks),
+                                   ExecuteSQL(sql_statement=scan_statement(f'{attributes_table_name}__chunks', chunk),
+                                              echo_queries=False))])
+                          for chunk in chunks]
+        else:
+            scan_tasks = [Task(id='scan', description='Counts the values of all attributes',
+                               commands=[self._record_job_run(
+                                   self._scan_job_id(), 'scan', 'all chunks', table_size,
+                                   ExecuteSQL(sql_statement=scan_statement(attributes_table_name),
+                                              echo_queries=False))])]
+
+        for i, column_name in enumerate(column_names, start=1):
+            index_name = f'{self.source_table_name}_{self.attributes_table_suffix}_{i}__value'
+            statement = ''
+            if self.chunk_column and ddl:
+                ddl += f"""
+CREATE {utils.chunks_table_persistence(self.incremental)}TABLE {attributes_table_name}__chunks_{i} 
+   PARTITION OF {attributes_table_name}__chunks FOR VALUES IN ('{column_name}');
+""" + (f"""
+CREATE INDEX {self.source_table_name}_{self.attributes_table_suffix}_chunks_{i}__chunk
+   ON {attributes_table_name}__chunks_{i} (chunk);
+""" if self.incremental else '')
+
+            if update_in_place:
+                # the trigram index is only re-created when values were added or removed
+                statement += f'''
+DO $$
+BEGIN
+  CREATE TEMPORARY TABLE attribute_counts ON COMMIT DROP AS
+    SELECT value, sum(row_count) AS row_count
+    FROM {attributes_table_name}__chunks_{i}
+    GROUP BY value
+    {self._top_k_clause(column_name)};
+
+  IF EXISTS (SELECT 1
+             FROM {attributes_table_name}_{i} a
+             FULL JOIN attribute_counts c USING (value)
+             WHERE a.value IS NULL OR c.value IS NULL) THEN
+    DROP INDEX {self.source_schema_name}.{index_name};
+
+    DELETE FROM {attributes_table_name}_{i} a
+    WHERE NOT exists(SELECT 1 FROM attribute_counts c WHERE c.value = a.value);
+
+    INSERT INTO {attributes_table_name}_{i}
+    SELECT '{column_name}', value, row_count
+    FROM attribute_counts c
+    WHERE NOT exists(SELECT 1 FROM {attributes_table_name}_{i} a WHERE a.value = c.value)
+    ORDER BY value;
+
+    CREATE INDEX {index_name} ON {attributes_table_name}_{i} USING GIN (value gin_trgm_ops);
+  END IF;
+
+  UPDATE {attributes_table_name}_{i} a
+  SET row_count = c.row_count
+  FROM attribute_counts c
+  WHERE c.value = a.value AND c.row_count <> a.row_count;
+END
+$$;
+'''
+            else:
+                if self.chunk_column:
+                    statement += f'''
+INSERT INTO {attributes_table_name}_{i} 
+SELECT attribute, value, row_count
+FROM (SELECT attribute, value, sum(row_count) AS row_count
+      FROM {attributes_table_name}__chunks_{i}
+      GROUP BY attribute, value
+      {self._top_k_clause(column_name)}) counts
+ORDER BY value;
+'''
+                statement += f'''
+CREATE INDEX {index_name} 
+   ON {attributes_table_name}_{i} USING GIN (value gin_trgm_ops);
+'''
+            commands[self._job_id(column_name)] = self._record_job_run(
+                self._job_id(column_name), 'attribute', column_name, table_size,
+                ExecuteSQL(sql_statement=statement, echo_queries=False),
+                relation_name=f'{attributes_table_name}_{i}')
+
+        return commands, scan_tasks, ddl
+
+    def _column_statement(self, attributes_table_name: str, i: int, column_name: str) -> str:
+        """A statement that fills the attributes partition of a single column"""
+        sample_percent = self.sample_percent.get(column_name)
+        source_table_name = f'{self.source_schema_name}.{self.source_table_name}' \
+                            + (f' TABLESAMPLE SYSTEM ({sample_percent})' if sample_percent else '')
+        return f'''
+INSERT INTO {attributes_table_name}_{i} 
+SELECT attribute, value, row_count
+FROM (SELECT '{column_name}' AS attribute, "{column_name}" AS value, 
+             {f'round(count(*) * {100.0 / sample_percent})::BIGINT' if sample_percent else 'count(*)'} AS row_count
+      FROM {source_table_name}
+      WHERE "{column_name}" IS NOT NULL
+      GROUP BY "{column_name}"
+      {self._top_k_clause(column_name)}) counts
+ORDER BY value;
+'''
+
+    def _top_k_clause(self, column_name: str) -> str:
+        """An ORDER BY & LIMIT clause for keeping only the most frequent values of a column"""
+        return f'ORDER BY row_count DESC LIMIT {self.top_k[column_name]}' if column_name in self.top_k else ''
+
+    def _number_of_distinct_values(self, cursor: object, column_names: [str]) -> {str: float}:
+        """Estimates the number of distinct values of columns of the source table"""
+        if self.distinct_values_estimate == 'hll':
+            cursor.execute('SELECT ' + ',\n       '.join(
+                f'hll_cardinality(hll_add_agg(hll_hash_text("{column_name}"::TEXT)))' for column_name in column_names)
+                           + f'\nFROM {self.source_schema_name}.{self.source_table_name}')
+            return {column_name: number or 0 for column_name, number in zip(column_names, cursor.fetchone())}
+        else:
+            cursor.execute(f'''
+SELECT attname, CASE WHEN n_distinct < 0 THEN -n_distinct * greatest(reltuples, 0) ELSE n_distinct END
+FROM pg_stats
+JOIN pg_class ON pg_class.oid = to_regclass(quote_ident(schemaname) || '.' || quote_ident(tablename))
+WHERE schemaname = {'%s'} AND tablename = {'%s'}''', (self.source_schema_name, self.source_table_name))
+            return dict(cursor.fetchall())
+
+    def _definition_hash(self, column_names: [str]) -> str:
+        """Identifies everything that the attribute counts per chunk (and the partitions) depend on"""
+        return utils.definition_hash(self.source_schema_name, self.source_table_name, self.attributes_table_suffix,
+                                     column_names, self.chunk_column)
+
+    def _job_id(self, column_name: str = '') -> str:
+        """The id under which the duration of computing the attributes of a column is recorded"""
+        return f'create_attributes_table:{self.source_schema_name}.{self.source_table_name}:{column_name}'
+
+    def _scan_job_id(self, chunk: int = None) -> str:
+        """The id under which the duration of a scan (of a chunk) of the source table is recorded"""
+        return (f'create_attributes_table_scan:{self.source_schema_name}.{self.source_table_name}:'
+                + (str(chunk) if chunk is not None else ''))
+
+    def _record_job_run(self, job_id: str, kind: str, name: str, size: float, command: Command,
+                        relation_name: str = None) -> job_history.RecordJobRun:
+        """Wraps a command so that its duration is recorded (and reported at the end of the computation)"""
+        if self._run_id:
+            self._report_jobs[job_id] = (kind, name, relation_name)
+        return job_history.RecordJobRun(job_id=job_id, size=size, command=command, run_id=self._run_id)
 
     def html_doc_items(self) -> [(str, str)]:
         return [('db', _.tt[self.db_alias]),
                 ('source schema', _.tt[self.source_schema_name]),
                 ('source table', _.tt[self.source_table_name]),
-                ('attributes table suffix', _.tt[self.attributes_table_suffix])]
+                ('attributes table suffix', _.tt[self.attributes_table_suffix]),
+                ('single scan', _.tt[repr(self.single_scan)]),
+                ('chunk column', _.tt[self.chunk_column or '']),
+                ('incremental', _.tt[repr(self.incremental)]),
+                ('changed chunks query', _.pre[self.changed_chunks_query or '']),
+                ('top k', _.tt[repr(self.top_k)] if self.top_k else ''),
+                ('sample percent', _.tt[repr(self.sample_percent)] if self.sample_percent else ''),
+                ('max distinct values', _.tt[self.max_distinct_values if self.max_distinct_values is not None else '']),
+                ('distinct values estimate', _.tt[self.distinct_values_estimate]),
+                ('number of parallel tasks',
+                 _.tt[f'adaptive, {self.min_number_of_parallel_tasks} - '
+                      f'{self.max_number_of_parallel_tasks or mara_pipelines.config.max_number_of_parallel_tasks()}'
+                      if self.min_number_of_parallel_tasks else str(self.max_number_of_parallel_tasks or '')]),
+                ('run report', _.tt[repr(self.run_report)]),
+                ('recorded runs', job_history.html_job_runs(self._job_id()))]
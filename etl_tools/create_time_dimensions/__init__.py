@@ -4,24 +4,41 @@ from mara_pipelines.commands.sql import ExecuteSQL
 from mara_pipelines.pipelines import Pipeline, Task
 from etl_tools import config
 
-pipeline = Pipeline(
-    id="create_time_dimensions",
-    description="Creates a day and a duration dimension table",
-    labels={"Schema": "time"},
-    base_path=pathlib.Path(__file__).parent)
-
-pipeline.add(
-    Task(id="create_tables",
-         description="Re-creates the day and duration table and their schema",
-         commands=[
-             ExecuteSQL(sql_file_name='create_tables.sql', echo_queries=False,
-                        file_dependencies=['create_tables.sql'])
-         ]))
-
-pipeline.add(
-    Task(id="populate_time_dimensions", description="fills the time dimensions for a configured time range",
-         commands=[
-             ExecuteSQL(sql_statement=lambda: "SELECT time.populate_time_dimensions('"
-                                              + config.first_date_in_time_dimensions().isoformat() + "'::DATE, '"
-                                              + config.last_date_in_time_dimensions().isoformat() + "'::DATE);")]),
-    upstreams=['create_tables'])
+
+def time_dimensions_pipeline(incremental: bool = False) -> Pipeline:
+    """
+    Creates a pipeline that creates and populates the `time` schema
+
+    Args:
+        incremental: When true, then the tables are kept when `create_tables.sql` changes (instead of re-creating
+                     the schema). In both modes, only days and durations that are not there yet are added.
+    """
+    pipeline = Pipeline(
+        id="create_time_dimensions",
+        description="Creates a day and a duration dimension table",
+        labels={"Schema": "time"},
+        base_path=pathlib.Path(__file__).parent)
+
+    pipeline.add(
+        Task(id="create_tables",
+             description="Creates the day and duration table and their schema" if incremental
+             else "Re-creates the day and duration table and their schema",
+             commands=([] if incremental else [
+                 ExecuteSQL(sql_statement='DROP SCHEMA IF EXISTS time CASCADE;',
+                            file_dependencies=['create_tables.sql'])]) + [
+                 ExecuteSQL(sql_file_name='create_tables.sql', echo_queries=False,
+                            file_dependencies=['create_tables.sql'])
+             ]))
+
+    pipeline.add(
+        Task(id="populate_time_dimensions", description="fills the time dimensions for a configured time range",
+             commands=[
+                 ExecuteSQL(sql_statement=lambda: "SELECT time.populate_time_dimensions('"
+                                                  + config.first_date_in_time_dimensions().isoformat() + "'::DATE, '"
+                                                  + config.last_date_in_time_dimensions().isoformat() + "'::DATE);")]),
+        upstreams=['create_tables'])
+
+    return pipeline
+
+
+pipeline = time_dimensions_pipeline()
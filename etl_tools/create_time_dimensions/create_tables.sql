@@ -1,8 +1,8 @@
-DROP SCHEMA IF EXISTS time CASCADE;
-CREATE SCHEMA time;
+-- only creates what does not exist yet, so that the time dimensions can be populated incrementally
+CREATE SCHEMA IF NOT EXISTS time;
 
 
-CREATE TABLE time.day (
+CREATE TABLE IF NOT EXISTS time.day (
   day_id           INTEGER PRIMARY KEY,
   day_name         TEXT     NOT NULL UNIQUE,
   year_id          SMALLINT NOT NULL,
@@ -28,10 +28,11 @@ SELECT util.add_index('time', 'day', column_names := ARRAY ['month_id']);
 SELECT util.add_index('time', 'day', column_names := ARRAY ['week_id']);
 SELECT util.add_index('time', 'day', column_names := ARRAY ['day_of_week_id']);
 SELECT util.add_index('time', 'day', column_names := ARRAY ['day_of_month_id']);
+SELECT util.add_index('time', 'day', column_names := ARRAY ['_date'], unique_ := TRUE);
 
 
-CREATE TABLE time.duration (
-  duration_id      INTEGER  NOT NULL,
+CREATE TABLE IF NOT EXISTS time.duration (
+  duration_id      INTEGER  PRIMARY KEY,
   days             SMALLINT NOT NULL,
   days_name        TEXT     NOT NULL,
   weeks            SMALLINT NOT NULL,
@@ -48,7 +49,6 @@ CREATE TABLE time.duration (
   years_name       TEXT     NOT NULL
 );
 
-SELECT util.add_pk('time', 'duration');
 SELECT util.add_index('time', 'duration', column_names := ARRAY ['days']);
 SELECT util.add_index('time', 'duration', column_names := ARRAY ['weeks']);
 SELECT util.add_index('time', 'duration', column_names := ARRAY ['four_weeks']);
@@ -58,7 +58,7 @@ SELECT util.add_index('time', 'duration', column_names := ARRAY ['half_years']);
 SELECT util.add_index('time', 'duration', column_names := ARRAY ['years']);
 
 
-CREATE TABLE time.hour_of_day (
+CREATE TABLE IF NOT EXISTS time.hour_of_day (
   hour_of_day_id   SMALLINT PRIMARY KEY,
   hour_of_day_name TEXT NOT NULL UNIQUE
 );
@@ -67,11 +67,13 @@ INSERT INTO time.hour_of_day
   SELECT
     h AS hour_of_day_id,
     h || '-' || h + 1
-  FROM generate_series(0, 23) h;
+  FROM generate_series(0, 23) h
+ON CONFLICT DO NOTHING;
 
 --
 -- compute all date values from start_date to now,
 -- compute all durations for the date range
+-- (only days and durations outside of the already populated range are generated)
 --
 CREATE OR REPLACE FUNCTION time.populate_time_dimensions(start_date DATE, end_date DATE)
   RETURNS VOID AS $$
@@ -95,9 +97,15 @@ INSERT INTO time.day
     to_char(d, 'DD') :: SMALLINT      AS day_of_month_id,
     d                                 AS _date
 
-  FROM generate_series($1 :: TIMESTAMP - INTERVAL '1 Day', $2 :: TIMESTAMP, '1 day') AS d
-    LEFT JOIN time.day ON day._date = d
-  WHERE day.day_id IS NULL;
+  FROM (SELECT min(_date) AS min_date, max(_date) AS max_date FROM time.day) populated
+    CROSS JOIN LATERAL (
+      SELECT generate_series($1 :: TIMESTAMP - INTERVAL '1 Day',
+                             least($2 :: TIMESTAMP, populated.min_date - INTERVAL '1 Day'), '1 day')
+      UNION ALL
+      SELECT generate_series(greatest($1 :: TIMESTAMP - INTERVAL '1 Day', populated.max_date + INTERVAL '1 Day'),
+                             $2 :: TIMESTAMP, '1 day')
+      WHERE populated.max_date IS NOT NULL) AS days (d)
+ON CONFLICT DO NOTHING;
 
 
 INSERT INTO time.duration
@@ -118,7 +126,8 @@ INSERT INTO time.duration
     floor((n - 360) / 360)                                          AS years,
     '-' || -n + n % 360 || ' to -' || -n + 359 + n % 360 || ' days' AS years_name
 
-  FROM generate_series($1 - current_date, 0, 1) AS n
+  FROM generate_series($1 - current_date,
+                       least(0, (SELECT min(duration_id) FROM time.duration WHERE duration_id <> -30000)), 1) AS n
 ON CONFLICT DO NOTHING;
 
 
@@ -140,7 +149,8 @@ INSERT INTO time.duration
     floor(n / 360)                                     AS years,
     n - n % 360 || '-' || n + 359 - n % 360 || ' days' AS years_name
 
-  FROM generate_series(0, current_date - $1 + 2, 1) AS n
+  FROM generate_series(greatest(0, (SELECT max(duration_id) + 1 FROM time.duration)),
+                       current_date - $1 + 2, 1) AS n
 ON CONFLICT DO NOTHING;
 
 
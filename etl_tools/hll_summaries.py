@@ -0,0 +1,166 @@
+"""Distinct count summaries from HyperLogLog sketches that are computed per chunk and merged"""
+
+import mara_pipelines.config
+from mara_pipelines.commands.sql import ExecuteSQL
+from mara_pipelines.pipelines import Pipeline, ParallelTask, Task
+from mara_page import _, html
+
+from etl_tools import utils
+
+
+class CreateHLLSummary(ParallelTask):
+    def __init__(self, id: str, source_schema_name: str, source_table_name: str, summary_table_name: str,
+                 group_by: {str: str}, distinct_columns: {str: str}, chunk_column: str,
+                 condition: str = None, db_alias: str = None,
+                 incremental: bool = False, changed_chunks_query: str = None,
+                 max_number_of_parallel_tasks: int = None) -> None:
+        """
+        Creates a table with HyperLogLog sketches of distinct values per group, for fast (approximate)
+        distinct counts over big tables.
+
+        The sketches are computed in parallel per chunk of `util.compute_chunk(<chunk_column>)` of the source
+        table and kept in `<summary_table_name>__chunks`. They are then merged into the summary table, which has
+        one row per group. As sketches are mergeable, distinct counts for any combination of groups are computed
+        with the `SUM(HLL)` aggregate from `initialize_utils/hll.sql`:
+
+        Example:
+            CreateHLLSummary(id='create_order_summary', source_schema_name='dim_next', source_table_name='order',
+                             summary_table_name='dim_next.order_summary',
+                             group_by={'day': 'order_date::DATE', 'channel': 'channel'},
+                             distinct_columns={'customers': 'customer_id', 'products': 'product_id'},
+                             chunk_column='order_id')
+
+            SELECT day, SUM(customers) AS number_of_customers
+            FROM dim.order_summary
+            WHERE day >= '2020-01-01'
+            GROUP BY day;
+
+        Args:
+            id: The id of the task
+            source_schema_name: The schema of the source table, e.g. 'dim_next'
+            source_table_name: The table to summarize, e.g. 'order'
+            summary_table_name: The summary table, including schema
+            group_by: For each group column of the summary table, an expression on the source table
+            distinct_columns: For each sketch column of the summary table, the expression whose distinct values
+                              are counted
+            chunk_column: The column of the source table that is used for splitting the work with `compute_chunk`
+            condition: An optional filter for the rows of the source table
+            db_alias: The database of the source and summary table
+            incremental: When true, then the sketches per chunk are kept between runs and only the chunks returned
+                         by `changed_chunks_query` are computed again (all chunks when the definition changed
+                         or the last run did not finish)
+            changed_chunks_query: In incremental mode, a query that returns the chunks that changed since the last
+                                  run, e.g. 'SELECT chunk FROM dim_next.order_changed_chunks'. Default: all chunks
+            max_number_of_parallel_tasks: How many chunks to compute in parallel at most
+
+        Requires the hll extension (`initialize_utils.utils_pipeline(with_hll=True)`).
+        """
+        super().__init__(id=id, description=f'Creates distinct count summaries of {source_schema_name}.'
+                                            f'{source_table_name} in {summary_table_name}',
+                         max_number_of_parallel_tasks=max_number_of_parallel_tasks)
+        assert group_by and distinct_columns, 'group columns and distinct columns are required'
+        self.source_schema_name = source_schema_name
+        self.source_table_name = source_table_name
+        self.summary_table_name = summary_table_name
+        self.group_by = group_by
+        self.distinct_columns = distinct_columns
+        self.chunk_column = chunk_column
+        self.condition = condition
+        self.db_alias = db_alias or mara_pipelines.config.default_db_alias()
+        self.incremental = incremental
+        self.changed_chunks_query = changed_chunks_query
+
+    def add_parallel_tasks(self, sub_pipeline: Pipeline) -> None:
+        chunks_table_name = f'{self.summary_table_name}__chunks'
+        if self.incremental:
+            update_in_place, chunks = utils.chunks_to_compute(self.db_alias, chunks_table_name,
+                                                              self._definition_hash(), self.changed_chunks_query)
+            if not chunks:
+                return  # no changed chunks
+        else:
+            update_in_place, chunks = False, [chunk for chunk, in utils.chunk_parameter_function()]
+
+        if update_in_place:
+            sub_pipeline.add_initial(
+                Task(id='invalidate_chunks_table', description='Marks the sketches per chunk as incomplete',
+                     commands=[ExecuteSQL(sql_statement=utils.invalidate_chunks_table_statement(chunks_table_name),
+                                          echo_queries=False, db_alias=self.db_alias)]))
+        else:
+            sub_pipeline.add_initial(
+                Task(id='create_chunks_table', description='Creates the table with the sketches per chunk',
+                     commands=[ExecuteSQL(sql_statement=f'''
+DROP TABLE IF EXISTS {chunks_table_name};
+
+CREATE {utils.chunks_table_persistence(self.incremental)}TABLE {chunks_table_name} AS
+SELECT NULL :: SMALLINT AS chunk,
+       {self._group_columns(with_expressions=True)},
+       {', '.join(f'hll_empty() AS "{column_name}"' for column_name in self.distinct_columns)}
+FROM {self.source_schema_name}.{self.source_table_name} t
+WITH NO DATA;
+''' + (f'''
+CREATE INDEX {self.summary_table_name.split('.')[-1]}__chunks__chunk ON {chunks_table_name} (chunk);
+''' if self.incremental else ''), echo_queries=False, db_alias=self.db_alias)]))
+
+        chunk_tasks = []
+        for chunk in chunks:
+            chunk_task = Task(id=f'chunk_{chunk}', description=f'Computes the sketches of chunk {chunk}',
+                              commands=[ExecuteSQL(sql_statement=self._chunk_statement(chunk, update_in_place),
+                                                   echo_queries=False, db_alias=self.db_alias)])
+            sub_pipeline.add(chunk_task)
+            chunk_tasks.append(chunk_task)
+
+        # the summary table is replaced in one transaction so that queries never see a partial summary
+        sub_pipeline.add(
+            Task(id='merge_chunks', description='Merges the sketches of all chunks into the summary table',
+                 commands=[ExecuteSQL(sql_statement=f'''
+DROP TABLE IF EXISTS {self.summary_table_name}__next;
+
+CREATE TABLE {self.summary_table_name}__next AS
+SELECT {self._group_columns()},
+       {', '.join(f'hll_union_agg("{column_name}") AS "{column_name}"' for column_name in self.distinct_columns)}
+FROM {chunks_table_name}
+GROUP BY {self._group_columns()};
+
+BEGIN;
+DROP TABLE IF EXISTS {self.summary_table_name};
+ALTER TABLE {self.summary_table_name}__next RENAME TO {self.summary_table_name.split('.')[-1]};
+COMMIT;
+''' + (utils.validate_chunks_table_statement(chunks_table_name, self._definition_hash()) if self.incremental
+       else f'DROP TABLE {chunks_table_name};'), echo_queries=False, db_alias=self.db_alias)]),
+            upstreams=chunk_tasks)
+
+    def _group_columns(self, with_expressions: bool = False) -> str:
+        """The group columns of the summary table (computed from the source table when `with_expressions`)"""
+        return ', '.join(f'{expression} AS "{column_name}"' if with_expressions else f'"{column_name}"'
+                         for column_name, expression in self.group_by.items())
+
+    def _chunk_statement(self, chunk: int, update_in_place: bool) -> str:
+        """A statement that (re-)computes the sketches of a chunk"""
+        return utils.chunk_statement(f'{self.summary_table_name}__chunks', chunk, f'''
+INSERT INTO {self.summary_table_name}__chunks
+SELECT {chunk},
+       {self._group_columns(with_expressions=True)},
+       {', '.join(f'hll_add_agg(hll_hash_text(({expression}) :: TEXT)) AS "{column_name}"'
+                  for column_name, expression in self.distinct_columns.items())}
+FROM {self.source_schema_name}.{self.source_table_name} t
+WHERE util.compute_chunk(t."{self.chunk_column}") = {chunk}''' \
+                    + (f'\n      AND ({self.condition})' if self.condition else '') + f'''
+GROUP BY {', '.join(str(n) for n in range(2, len(self.group_by) + 2))};
+''', update_in_place)
+
+    def _definition_hash(self) -> str:
+        """Identifies everything that the sketches per chunk depend on"""
+        return utils.definition_hash(self.source_schema_name, self.source_table_name, self.group_by,
+                                     self.distinct_columns, self.chunk_column, self.condition)
+
+    def html_doc_items(self) -> [(str, str)]:
+        return [('db', _.tt[self.db_alias]),
+                ('source table', _.tt[f'{self.source_schema_name}.{self.source_table_name}']),
+                ('summary table', _.tt[self.summary_table_name]),
+                ('group by', _.tt[repr(self.group_by)]),
+                ('distinct columns', _.tt[repr(self.distinct_columns)]),
+                ('chunk column', _.tt[self.chunk_column]),
+                ('condition', _.tt[self.condition or '']),
+                ('incremental', _.tt[repr(self.incremental)]),
+                ('changed chunks query', _.pre[self.changed_chunks_query or '']),
+                ('chunk statement', html.highlight_syntax(self._chunk_statement(0, self.incremental), 'sql'))]
@@ -4,16 +4,15 @@
 CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
 
-/** creates a table optimized for the auto-completion of data set attributes */
+/** creates a table optimized for the auto-completion of data set attributes, reads the data set table only once */
 CREATE OR REPLACE FUNCTION util.create_data_set_attributes_table(schema_name_ TEXT, table_name_ TEXT)
   RETURNS VOID AS $$
-DECLARE column_name_ TEXT;
+DECLARE attribute_values_ TEXT;
 BEGIN
   EXECUTE 'DROP TABLE IF EXISTS ' || schema_name_ || '.' || table_name_ || '_attributes';
   EXECUTE 'CREATE TABLE ' || schema_name_ || '.' || table_name_ ||
           '_attributes (attribute TEXT NOT NULL, value TEXT NOT NULL, row_count BIGINT);';
 
-  FOR column_name_ IN
   WITH enums AS (
       SELECT DISTINCT
         typname,
@@ -22,20 +21,21 @@ BEGIN
         JOIN pg_enum ON pg_type.oid = pg_enum.enumtypid
         JOIN pg_namespace ON pg_type.typnamespace = pg_namespace.oid
   )
-  SELECT column_name
+  SELECT string_agg('(' || quote_literal(column_name) || ', t.' || quote_ident(column_name) || '::TEXT)', ', '
+                    ORDER BY ordinal_position)
+  INTO attribute_values_
   FROM information_schema.columns
     LEFT JOIN enums ON udt_schema = enums.nspname AND udt_name = enums.typname
   WHERE table_schema = schema_name_
         AND table_name = table_name_
-        AND (data_type IN ('text', 'varchar') OR enums.typname IS NOT NULL)
+        AND (data_type IN ('text', 'varchar') OR enums.typname IS NOT NULL);
 
-  LOOP
+  IF attribute_values_ IS NOT NULL THEN
     EXECUTE 'INSERT INTO ' || schema_name_ || '.' || table_name_ || '_attributes ' ||
-            'SELECT ''' || column_name_ || ''', "' || column_name_ ||
-            '", count(*) FROM ' || schema_name_ || '.' || table_name_ ||
-            ' WHERE "' || column_name_ || '" IS NOT NULL GROUP BY "' || column_name_
-            || '" ORDER BY "' || column_name_ || '"';
-  END LOOP;
+            'SELECT attribute, value, count(*) FROM ' || schema_name_ || '.' || table_name_ || ' t ' ||
+            'CROSS JOIN LATERAL (VALUES ' || attribute_values_ || ') attributes (attribute, value) ' ||
+            'WHERE value IS NOT NULL GROUP BY attribute, value ORDER BY attribute, value';
+  END IF;
 
   EXECUTE 'CREATE INDEX ' || table_name_ || '_attributes__attribute ON ' ||
           schema_name_ || '.' || table_name_ || '_attributes (attribute)';
@@ -0,0 +1,479 @@
+"""Recording the durations of jobs (table copies, index builds, ..) for planning later runs and for run reports"""
+
+import hashlib
+import datetime
+import json
+import multiprocessing
+import os
+import re
+import time
+import traceback
+
+import sqlalchemy
+from sqlalchemy.ext.declarative import declarative_base
+
+import mara_db.postgresql
+from mara_pipelines.logging import logger
+from mara_pipelines.pipelines import Command, Pipeline, Task
+from mara_page import _
+
+Base = declarative_base()
+
+
+class JobRun(Base):
+    """The duration of the last successful run of a job"""
+    __tablename__ = 'etl_tools_job_run'
+
+    job_id = sqlalchemy.Column(sqlalchemy.TEXT, primary_key=True)
+    size = sqlalchemy.Column(sqlalchemy.FLOAT)
+    duration = sqlalchemy.Column(sqlalchemy.FLOAT, nullable=False)
+    end_time = sqlalchemy.Column(sqlalchemy.TIMESTAMP(timezone=True), nullable=False)
+
+
+class JobRunDetail(Base):
+    """Start and end of each job (or piece of a job) in recent runs of parallel tasks, for run reports"""
+    __tablename__ = 'etl_tools_job_run_detail'
+
+    id = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True, autoincrement=True)
+    run_id = sqlalchemy.Column(sqlalchemy.TEXT, nullable=False, index=True)
+    job_id = sqlalchemy.Column(sqlalchemy.TEXT, nullable=False)
+    task_id = sqlalchemy.Column(sqlalchemy.TEXT)
+    start_time = sqlalchemy.Column(sqlalchemy.TIMESTAMP(timezone=True), nullable=False)
+    end_time = sqlalchemy.Column(sqlalchemy.TIMESTAMP(timezone=True), nullable=False)
+    rows = sqlalchemy.Column(sqlalchemy.BIGINT)
+
+
+class JobLockWait(Base):
+    """How long the sessions of a job waited for locks in a recent run of a parallel task, for run reports"""
+    __tablename__ = 'etl_tools_job_lock_wait'
+
+    run_id = sqlalchemy.Column(sqlalchemy.TEXT, primary_key=True)
+    job_id = sqlalchemy.Column(sqlalchemy.TEXT, primary_key=True)
+    lock_wait = sqlalchemy.Column(sqlalchemy.FLOAT, nullable=False)
+    end_time = sqlalchemy.Column(sqlalchemy.TIMESTAMP(timezone=True), nullable=False)
+
+
+def record_job_run(job_id: str, size: float, duration: float) -> None:
+    """
+    Records the duration of a successful job run
+
+    Args:
+        job_id: A unique identifier of the job, e.g. 'copy:foo.bar'
+        size: The size of the processed data (in MB) at the time of the run
+        duration: The run time in seconds
+    """
+    with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
+        cursor.execute(f'''
+INSERT INTO etl_tools_job_run (job_id, size, duration, end_time)
+VALUES ({'%s, %s, %s'}, now())
+ON CONFLICT (job_id)
+DO UPDATE SET size = EXCLUDED.size, duration = EXCLUDED.duration, end_time = EXCLUDED.end_time
+''', (job_id, size, duration))
+
+
+def record_job_run_detail(run_id: str, job_id: str, task_id: str, start_time: float, end_time: float,
+                          rows: int = None) -> None:
+    """
+    Records when a job ran as part of a run of a parallel task
+
+    Args:
+        run_id: A unique identifier of the run of the parallel task
+        job_id: The identifier of the job, e.g. 'copy:foo.bar'
+        task_id: The id of the task that ran the job
+        start_time: When the job started (unix timestamp)
+        end_time: When the job finished (unix timestamp)
+        rows: How many rows the job copied or inserted, when known
+    """
+    with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
+        cursor.execute(f'''
+INSERT INTO etl_tools_job_run_detail (run_id, job_id, task_id, start_time, end_time, rows)
+VALUES ({'%s, %s, %s'}, to_timestamp({'%s'}), to_timestamp({'%s'}), {'%s'})''',
+                       (run_id, job_id, task_id, start_time, end_time, rows))
+
+
+def number_of_rows(command: Command, result) -> int:
+    """
+    The number of rows that a finished command copied or inserted: the `number_of_rows` of the command
+    (e.g. of `StreamBinaryCopy`), or else the first `COPY <n>` or `INSERT 0 <n>` line in the psql output that
+    `Command.run` returns. Later lines are ignored, they come from statements such as checkpoints.
+
+    Args:
+        command: The command
+        result: What the `run` method of the command returned
+
+    Returns:
+        The number of rows or None when unknown
+    """
+    if getattr(command, 'number_of_rows', None) is not None:
+        return command.number_of_rows
+    if isinstance(result, list):
+        for line in result:
+            match = re.fullmatch(r'(?:COPY|INSERT \d+) (\d+)', line.strip())
+            if match:
+                return int(match.group(1))
+    return None
+
+
+def job_runs(job_id_prefix: str) -> {str: (float, float)}:
+    """
+    Returns the recorded runs of all jobs that start with a prefix
+
+    Args:
+        job_id_prefix: e.g. 'copy:foo.'
+
+    Returns:
+        A mapping of job ids to tuples of size and duration
+    """
+    with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
+        cursor.execute("SELECT to_regclass('etl_tools_job_run') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return {}
+        cursor.execute(f"""
+SELECT job_id, size, duration
+FROM etl_tools_job_run
+WHERE left(job_id, length({'%s'})) = {'%s'}""", (job_id_prefix, job_id_prefix))
+        return {job_id: (size, duration) for job_id, size, duration in cursor.fetchall()}
+
+
+def estimate_durations(sizes: {str: float}, job_id_prefix: str) -> {str: float}:
+    """
+    Estimates the run times of jobs from their recorded durations, scaled by how much their size changed.
+
+    Jobs without history are estimated from their size, using the average time per MB of the
+    other jobs with the same prefix (or 1 second per MB when there is no history at all).
+
+    Args:
+        sizes: A mapping of job ids to the current size of the processed data (in MB)
+        job_id_prefix: The common prefix of the job ids, e.g. 'copy:foo.'
+
+    Returns:
+        A mapping of job ids to estimated durations in seconds
+    """
+    history = job_runs(job_id_prefix)
+
+    recorded_size = sum(size or 0 for size, duration in history.values())
+    recorded_duration = sum(duration for size, duration in history.values() if size)
+    seconds_per_mb = recorded_duration / recorded_size if recorded_size and recorded_duration else 1
+
+    durations = {}
+    for job_id, size in sizes.items():
+        if job_id in history:
+            previous_size, duration = history[job_id]
+            durations[job_id] = duration * (size / previous_size if size and previous_size else 1)
+        else:
+            durations[job_id] = (size or 0) * seconds_per_mb
+    return durations
+
+
+def pack(durations: {str: float}, number_of_bins: int) -> [[str]]:
+    """
+    Distributes jobs over a number of bins so that the longest bin is as short as possible
+    (longest processing time first)
+
+    Args:
+        durations: A mapping of job ids (or any other keys) to estimated durations
+        number_of_bins: How many bins to fill
+
+    Returns:
+        The keys for each bin, longest bins first, longest jobs first within a bin. Empty bins are omitted.
+    """
+    bins = [[] for i in range(number_of_bins)]
+    bin_durations = [0] * number_of_bins
+    for key, duration in sorted(durations.items(), key=lambda item: item[1], reverse=True):
+        shortest_bin_index = min(range(number_of_bins), key=bin_durations.__getitem__)
+        bin_durations[shortest_bin_index] += duration
+        bins[shortest_bin_index].append(key)
+    return [keys for duration, keys in sorted(zip(bin_durations, bins), key=lambda item: item[0], reverse=True)
+            if keys]
+
+
+class RecordJobRun(Command):
+    def __init__(self, job_id: str, size: float, command: Command,
+                 run_id: str = None, record_history: bool = True) -> None:
+        """
+        Runs a command and records its duration for the planning of later runs
+
+        Args:
+            job_id: A unique identifier of the job, e.g. 'copy:foo.bar'
+            size: The size of the processed data (in MB)
+            command: The command to run
+            run_id: When set, then also the start and end of the job are recorded for the report of this run and
+                    the database sessions of the job are tagged for `sample_lock_waits`
+            record_history: When false, then the job is only recorded for the report of the run, not for planning
+        """
+        super().__init__()
+        self.job_id = job_id
+        self.size = size
+        self.command = command
+        self.run_id = run_id
+        self.record_history = record_history
+
+    def run(self) -> bool:
+        self.command.parent = self.parent
+        start_time = time.time()
+        if self.run_id:
+            # inherited by psql and used by psycopg2, commands of a task run one after another in the same process
+            application_name = os.environ.get('PGAPPNAME')
+            os.environ['PGAPPNAME'] = job_application_name(self.run_id, self.job_id)
+        try:
+            result = self.command.run()
+        finally:
+            if self.run_id:
+                if application_name is None:
+                    os.environ.pop('PGAPPNAME', None)
+                else:
+                    os.environ['PGAPPNAME'] = application_name
+        if not result:
+            return False
+        end_time = time.time()
+        try:
+            if self.record_history:
+                record_job_run(self.job_id, self.size, end_time - start_time)
+            if self.run_id:
+                record_job_run_detail(self.run_id, self.job_id, self.parent.id if self.parent else None,
+                                      start_time, end_time, number_of_rows(self.command, result))
+        except Exception:
+            # the history is best effort, the job itself succeeded
+            logger.log(f'Could not record the run of {self.job_id}\n{traceback.format_exc()}',
+                       format=logger.Format.VERBATIM, is_error=True)
+        return True
+
+    def shell_command(self):
+        return self.command.shell_command()
+
+    def html_doc_items(self) -> [(str, str)]:
+        return [('job', _.tt[self.job_id]),
+                ('size', _.tt[f'{self.size:.1f} MB' if self.size is not None else ''])] \
+               + self.command.html_doc_items()
+
+
+def html_job_runs(job_id_prefix: str):
+    """Renders the recorded job runs with a prefix as a table, longest jobs first"""
+    try:
+        history = job_runs(job_id_prefix)
+    except Exception as e:
+        # the documentation of a pipeline should render also when the mara db is not reachable
+        return _.i[f'Could not read the recorded runs: {e}']
+    if not history:
+        return _.i['No recorded runs']
+    return _.table(class_='table table-sm')[
+        _.thead[_.tr[_.th['Job'], _.th['Size'], _.th['Duration']]],
+        _.tbody[[_.tr[_.td[_.tt[job_id[len(job_id_prefix):]]],
+                      _.td[f'{size:.1f} MB' if size is not None else ''],
+                      _.td[f'{duration:.1f} s']]
+                 for job_id, (size, duration) in sorted(history.items(), key=lambda item: item[1][1], reverse=True)]]]
+
+
+def job_application_name(run_id: str, job_id: str) -> str:
+    """The `application_name` of the database sessions of a job in a run (short enough to not be truncated)"""
+    return 'etl_tools ' + hashlib.md5(f'{run_id} {job_id}'.encode()).hexdigest()[:16]
+
+
+def sample_lock_waits(run_id: str, pipeline: Pipeline, node_path: [str], db_alias: str,
+                      interval: float = 1) -> None:
+    """
+    Measures how long the jobs of a run wait for locks, for the report of the run.
+
+    A forked process (not a thread of the calling process, which forks the task processes) checks once per interval
+    which of the `RecordJobRun` jobs of the pipeline have a session (identified by `job_application_name`) that waits
+    for a lock, and adds the interval to their lock wait time in `etl_tools_job_lock_wait`. A job is counted once per
+    check, however many pieces it has. The process stops when all jobs are recorded as finished, when the run log
+    shows the pipeline as finished (also when it failed), when the calling process is gone or after an error.
+
+    Args:
+        run_id: The identifier of the run
+        pipeline: The (sub) pipeline with the jobs
+        node_path: The path of the pipeline once it runs (of the parallel task that it replaces)
+        db_alias: The db in which the jobs run
+        interval: How many seconds to wait between two checks
+    """
+    jobs = [command for node in pipeline.nodes.values() if isinstance(node, Task)
+            for command in node.commands if isinstance(command, RecordJobRun) and command.run_id == run_id]
+    if jobs:
+        multiprocessing.get_context('fork').Process(
+            target=_sample_lock_waits, daemon=True, name='sample-lock-waits',
+            args=(run_id, {job_application_name(run_id, job.job_id): job.job_id for job in jobs}, len(jobs),
+                  node_path, datetime.datetime.now(datetime.timezone.utc), os.getpid(), db_alias, interval)).start()
+
+
+def _sample_lock_waits(run_id: str, job_ids: {str: str}, number_of_jobs: int, node_path: [str],
+                       start_time: datetime.datetime, parent_pid: int, db_alias: str, interval: float) -> None:
+    """The loop of the process of `sample_lock_waits`"""
+    try:
+        with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor, \
+                mara_db.postgresql.postgres_cursor_context('mara') as mara_cursor:
+            # a new snapshot of pg_stat_activity for each check
+            cursor.connection.autocommit = True
+            mara_cursor.connection.autocommit = True
+            while os.getppid() == parent_pid:
+                time.sleep(interval)
+                cursor.execute(f"""
+SELECT DISTINCT application_name
+FROM pg_stat_activity
+WHERE wait_event_type = 'Lock' AND application_name = ANY({'%s'})""", (list(job_ids.keys()),))
+                waiting_job_ids = [job_ids[application_name] for application_name, in cursor.fetchall()]
+                if waiting_job_ids:
+                    mara_cursor.execute(f'''
+INSERT INTO etl_tools_job_lock_wait (run_id, job_id, lock_wait, end_time)
+SELECT {'%s'}, job_id, {'%s'}, now()
+FROM unnest({'%s'} :: TEXT[]) job_id
+ON CONFLICT (run_id, job_id)
+DO UPDATE SET lock_wait = etl_tools_job_lock_wait.lock_wait + EXCLUDED.lock_wait, end_time = EXCLUDED.end_time
+''', (run_id, interval, waiting_job_ids))
+
+                mara_cursor.execute(f"""
+SELECT (SELECT count(*) FROM etl_tools_job_run_detail WHERE run_id = {'%s'}) >= {'%s'}
+       OR EXISTS(SELECT FROM data_integration_node_run
+                 WHERE node_path = {'%s'} AND start_time >= {'%s'} AND end_time IS NOT NULL)""",
+                                    (run_id, number_of_jobs, node_path, start_time))
+                if mara_cursor.fetchone()[0]:
+                    return
+    except Exception:
+        # the measurement is best effort, the jobs themselves should not be affected
+        logger.log(f'Could not sample lock waits\n{traceback.format_exc()}', format=logger.Format.VERBATIM,
+                   is_error=True)
+
+
+def run_report(run_id: str, jobs: {str: (str, str, str)}, upstream_tasks: {str: [str]}, db_alias: str) -> dict:
+    """
+    Summarizes the recorded jobs of a run of a parallel task
+
+    Args:
+        run_id: The identifier of the run
+        jobs: For each job id, the kind of the job (e.g. 'copy'), a readable name and the relation that it
+              creates or fills (or None)
+        upstream_tasks: For each task id, the ids of the tasks that it depends on
+        db_alias: The db of the relations, for sizes and the row counts of indexes
+
+    Returns:
+        Per job rows (as counted by the copies), bytes, durations (sum over all pieces), throughput, lock wait time
+        and how long the job was queued behind other jobs after its upstream tasks finished, the totals per kind of
+        job and the critical path, i.e. the chain of jobs that determined the wall clock time of the run (all times
+        in seconds, start and end times relative to the start of the first job)
+    """
+    with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
+        cursor.execute(f'''
+SELECT job_id, task_id, extract(EPOCH FROM start_time), extract(EPOCH FROM end_time), rows
+FROM etl_tools_job_run_detail
+WHERE run_id = {'%s'}
+ORDER BY start_time''', (run_id,))
+        details, job_rows = [], {}
+        for job_id, task_id, start_time, end_time, rows in cursor.fetchall():
+            details.append((job_id, task_id, float(start_time), float(end_time)))
+            if rows is not None:
+                job_rows[job_id] = job_rows.get(job_id, 0) + rows
+        cursor.execute(f"SELECT job_id, lock_wait FROM etl_tools_job_lock_wait WHERE run_id = {'%s'}", (run_id,))
+        lock_waits = dict(cursor.fetchall())
+    if not details:
+        return {'run_id': run_id, 'jobs': [], 'kinds': {}, 'critical_path': []}
+
+    relation_names = [relation_name for kind, name, relation_name in jobs.values() if relation_name]
+    with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor:
+        cursor.execute(f'''
+SELECT relation_name,
+       -- exact after an index build, rows of tables come from the recorded jobs
+       CASE WHEN relkind = 'i' THEN reltuples :: BIGINT END,
+       pg_table_size(pg_class.oid)
+FROM unnest({'%s'} :: TEXT[]) relation_name
+JOIN pg_class ON pg_class.oid = to_regclass(relation_name)''', (relation_names,))
+        relation_sizes = {relation_name: (rows, bytes) for relation_name, rows, bytes in cursor.fetchall()}
+
+    # all tasks that need to finish before a task can start
+    def all_upstream_tasks(task_id: str, result: set) -> set:
+        for upstream_task_id in upstream_tasks.get(task_id, []):
+            if upstream_task_id not in result:
+                result.add(upstream_task_id)
+                all_upstream_tasks(upstream_task_id, result)
+        return result
+
+    upstreams = {task_id: all_upstream_tasks(task_id, set()) for task_id in {detail[1] for detail in details}}
+    run_start = min(start_time for job_id, task_id, start_time, end_time in details)
+    run_end = max(end_time for job_id, task_id, start_time, end_time in details)
+
+    report_jobs = []
+    for job_id in dict.fromkeys(detail[0] for detail in details):
+        job_details = [detail for detail in details if detail[0] == job_id]
+        kind, name, relation_name = jobs.get(job_id, ('', job_id, None))
+        first_job_id, first_task_id, first_start_time, first_end_time = job_details[0]
+        ready_time = max([end_time for other_job_id, task_id, start_time, end_time in details
+                          if task_id in upstreams[first_task_id]], default=run_start)
+        duration = sum(end_time - start_time for job_id, task_id, start_time, end_time in job_details)
+        rows, bytes = relation_sizes.get(relation_name, (None, None))
+        rows = job_rows.get(job_id, rows)
+        report_jobs.append({
+            'job': name, 'kind': kind, 'pieces': len(job_details),
+            'start': round(first_start_time - run_start, 1),
+            'end': round(max(detail[3] for detail in job_details) - run_start, 1),
+            'duration': round(duration, 1),
+            'queued': round(max(0, first_start_time - ready_time), 1),
+            'lock_wait': round(lock_waits.get(job_id, 0), 1),
+            'rows': rows, 'bytes': bytes,
+            'rows_per_second': round(rows / duration) if rows is not None and duration else None,
+            'mb_per_second': round(bytes / 1000000 / duration, 2) if bytes is not None and duration else None})
+
+    kinds = {}
+    for job in report_jobs:
+        totals = kinds.setdefault(job['kind'], {'jobs': 0, 'duration': 0, 'start': job['start'], 'end': job['end']})
+        totals['jobs'] += 1
+        totals['duration'] = round(totals['duration'] + job['duration'], 1)
+        totals['start'] = min(totals['start'], job['start'])
+        totals['end'] = max(totals['end'], job['end'])
+
+    # walk back from the last job: each job waited for the latest job that finished before it
+    # in the same task or in an upstream task
+    critical_path = []
+    detail = max(details, key=lambda detail: detail[3])
+    while detail:
+        critical_path.insert(0, detail)
+        job_id, task_id, start_time, end_time = detail
+        detail = max([other for other in details
+                      if other[3] <= start_time and (other[1] == task_id or other[1] in upstreams[task_id])],
+                     key=lambda other: other[3], default=None)
+
+    return {'run_id': run_id,
+            'wall_clock_time': round(run_end - run_start, 1),
+            'jobs': sorted(report_jobs, key=lambda job: job['duration'], reverse=True),
+            'kinds': kinds,
+            'critical_path': [{'job': jobs.get(job_id, ('', job_id, None))[1],
+                               'kind': jobs.get(job_id, ('', job_id, None))[0],
+                               'task': task_id,
+                               'start': round(start_time - run_start, 1),
+                               'end': round(end_time - run_start, 1)}
+                              for job_id, task_id, start_time, end_time in critical_path]}
+
+
+class LogRunReport(Command):
+    def __init__(self, run_id: str, jobs: {str: (str, str, str)}, upstream_tasks: {str: [str]},
+                 db_alias: str) -> None:
+        """
+        Logs the report of a run of a parallel task as JSON (see `run_report`) and removes old run details
+
+        Args:
+            run_id: The identifier of the run
+            jobs: For each job id, the kind of the job, a readable name and the relation that it fills (or None)
+            upstream_tasks: For each task id, the ids of the tasks that it depends on
+            db_alias: The db of the relations
+        """
+        super().__init__()
+        self.run_id = run_id
+        self.jobs = jobs
+        self.upstream_tasks = upstream_tasks
+        self.db_alias = db_alias
+
+    def run(self) -> bool:
+        try:
+            report = run_report(self.run_id, self.jobs, self.upstream_tasks, self.db_alias)
+            logger.log(json.dumps(report, indent=2), format=logger.Format.VERBATIM)
+            with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
+                cursor.execute("DELETE FROM etl_tools_job_run_detail WHERE end_time < now() - INTERVAL '7 days'")
+                cursor.execute("DELETE FROM etl_tools_job_lock_wait WHERE end_time < now() - INTERVAL '7 days'")
+        except Exception:
+            # a missing report should not fail the pipeline
+            logger.log(f'Could not create run report\n{traceback.format_exc()}', format=logger.Format.VERBATIM,
+                       is_error=True)
+        return True
+
+    def html_doc_items(self) -> [(str, str)]:
+        return [('run id', _.tt[self.run_id]),
+                ('db', _.tt[self.db_alias]),
+                ('jobs', _.tt[str(len(self.jobs))])]
@@ -1,35 +1,61 @@
 import pathlib
-import os
+import shlex
+import sys
 
-from mara_pipelines.commands.files import ReadScriptOutput
+import mara_db.shell
+from mara_pipelines.commands.bash import RunBash
 from mara_pipelines.commands.sql import ExecuteSQL
 from mara_pipelines.pipelines import Pipeline, Task
+from etl_tools import config
+from etl_tools.load_euro_exchange_rates.exchange_rate_lookup import ExchangeRates, exchange_rates, convert
 
 
-def euro_exchange_rates_pipeline(db_alias: str):
+def euro_exchange_rates_pipeline(db_alias: str, incremental: bool = False):
+    """
+    Creates a pipeline that loads daily Euro exchange rates from the European central bank
+
+    Args:
+        db_alias: The database to load the exchange rates into
+        incremental: When true, then only exchange rates that were published after the last load are added
+                     (instead of re-creating the `euro_fx` schema)
+    """
     pipeline = Pipeline(
         id="load_euro_exchange_rates",
         description="Loads daily Euro exchange rates since 1999 from the European central bank",
         base_path=pathlib.Path(__file__).parent)
 
+    def load_command():
+        command = f'{shlex.quote(sys.executable)} {shlex.quote(str(pipeline.base_path() / "load_exchange_rate.py"))}'
+        command += f' --url={shlex.quote(config.euro_exchange_rates_url())}'
+        if config.euro_exchange_rates_cache_file():
+            command += f' --cache-file={shlex.quote(str(config.euro_exchange_rates_cache_file()))}'
+        if incremental:
+            query = 'SELECT max(max_published_date) FROM euro_fx.exchange_rate_load_state'
+            command += f' --after-date="$(echo {shlex.quote(query)} \\\n' \
+                       + '    | ' + mara_db.shell.copy_to_stdout_command(db_alias) + ')"'
+        return command + ' \\\n  | ' + mara_db.shell.copy_from_stdin_command(
+            db_alias, target_table='euro_fx.exchange_rate_new' if incremental else 'euro_fx.exchange_rate')
+
     pipeline.add(
         Task(id="create_schema_and_table",
-             description="Re-creates currency exchange rate schema",
+             description="Creates the currency exchange rate schema" if incremental
+             else "Re-creates currency exchange rate schema",
              commands=[
-                 ExecuteSQL(sql_file_name='create_schema_and_table.sql', echo_queries=False)
+                 ExecuteSQL(sql_file_name='create_schema_and_table_if_not_exists.sql' if incremental
+                            else 'create_schema_and_table.sql', echo_queries=False, db_alias=db_alias)
              ]))
 
     pipeline.add(
         Task(id='load_exchange_rate', description='Loads exchange rates from the European central bank',
-             commands=[ReadScriptOutput(file_name='load_exchange_rate.py', target_table='euro_fx.exchange_rate',
-                       db_alias=db_alias)]),
+             commands=[RunBash(command=load_command)]),
         upstreams=['create_schema_and_table'])
 
     pipeline.add(
         Task(id="postprocess_exchange_rate",
              description="Adds values for missing days",
              commands=[
-                 ExecuteSQL(sql_file_name='postprocess_exchange_rate.sql', echo_queries=False)
+                 ExecuteSQL(sql_file_name='postprocess_exchange_rate_incremental.sql' if incremental
+                            else 'postprocess_exchange_rate.sql', echo_queries=False, db_alias=db_alias)
              ]),
         upstreams=['load_exchange_rate'])
 
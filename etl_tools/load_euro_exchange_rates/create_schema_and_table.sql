@@ -8,4 +8,8 @@ CREATE TABLE euro_fx.exchange_rate (
   currency      TEXT             NOT NULL,
   exchange_rate DOUBLE PRECISION NOT NULL,
   date          DATE             NOT NULL
-);
\ No newline at end of file
+);
+
+CREATE TABLE euro_fx.exchange_rate_load_state (
+  max_published_date DATE
+);
@@ -0,0 +1,16 @@
+CREATE SCHEMA IF NOT EXISTS euro_fx;
+
+CREATE TABLE IF NOT EXISTS euro_fx.exchange_rate (
+  currency      TEXT             NOT NULL,
+  exchange_rate DOUBLE PRECISION NOT NULL,
+  date          DATE             NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS euro_fx.exchange_rate_load_state (
+  max_published_date DATE
+);
+
+-- exchange rates published after the last load
+DROP TABLE IF EXISTS euro_fx.exchange_rate_new;
+
+CREATE TABLE euro_fx.exchange_rate_new (LIKE euro_fx.exchange_rate);
@@ -0,0 +1,141 @@
+"""Fast in-memory lookup of the (gap-filled) Euro exchange rates in `euro_fx.exchange_rate`"""
+
+import array
+import datetime
+import math
+import threading
+import time
+
+import mara_db.postgresql
+import mara_pipelines.config
+from etl_tools import config
+
+try:
+    import numpy
+except ImportError:  # numpy is optional (`pip install mara-etl-tools[numpy]`), conversions are done in pure python then
+    numpy = None
+
+
+class ExchangeRates():
+    def __init__(self, first_date: datetime.date, rates: {str: object}, max_date: datetime.date) -> None:
+        """
+        Exchange rates of all currencies as one array of rates per currency, indexed by the number of days
+        since `first_date` (`nan` for days without exchange rate)
+
+        Args:
+            first_date: The date of the first element of each array
+            rates: A mapping of currencies to numpy arrays (or `array.array` objects when numpy is not installed)
+            max_date: The last date in `euro_fx.exchange_rate` when the rates were read
+        """
+        self.first_date = first_date
+        self.rates = rates
+        self.max_date = max_date
+
+    def rate(self, currency: str, date: datetime.date) -> float:
+        """How much of a currency one Euro was worth on a day, `nan` when unknown"""
+        rates = self.rates.get(currency)
+        if rates is None:  # also when `euro_fx.exchange_rate` is empty (and `first_date` is None)
+            return math.nan
+        offset = (date - self.first_date).days
+        if offset < 0 or offset >= len(rates):
+            return math.nan
+        return float(rates[offset])
+
+    def convert(self, amounts: [float], currencies: [str], dates: [datetime.date]):
+        """
+        Converts amounts in different currencies to Euro
+
+        Args:
+            amounts: The amounts to convert
+            currencies: The currency of each amount, e.g. 'USD'
+            dates: The day of each amount
+
+        Returns:
+            The amounts in Euro as a numpy array (a list when numpy is not installed),
+            `nan` for unknown currencies and days without exchange rates
+        """
+        if numpy is None:
+            return [amount / self.rate(currency, date) for amount, currency, date in zip(amounts, currencies, dates)]
+
+        amounts = numpy.asarray(amounts, dtype=numpy.float64)
+        currencies = numpy.asarray(currencies)
+        offsets = (numpy.asarray(dates, dtype='datetime64[D]')
+                   - numpy.datetime64(self.first_date, 'D')).astype(numpy.int64)
+
+        result = numpy.full(len(amounts), numpy.nan)
+        for currency in numpy.unique(currencies):
+            rates = self.rates.get(str(currency))
+            if rates is None:
+                continue
+            positions = numpy.flatnonzero((currencies == currency) & (offsets >= 0) & (offsets < len(rates)))
+            result[positions] = amounts[positions] / rates[offsets[positions]]
+        return result
+
+
+_exchange_rates = {}
+_checked_at = {}  # when the max date of the exchange rates of a db was last compared (monotonic time)
+_lock = threading.Lock()
+
+
+def exchange_rates(db_alias: str = None) -> ExchangeRates:
+    """
+    Returns the exchange rates from `euro_fx.exchange_rate`.
+    They are read once per process and read again when the max date in the table changed, which is checked
+    at most once per `euro_exchange_rates_refresh_interval`.
+
+    Args:
+        db_alias: The database that contains the `euro_fx` schema, default: the default db alias
+    """
+    db_alias = db_alias or mara_pipelines.config.default_db_alias()
+
+    with _lock:
+        if (db_alias in _exchange_rates
+                and time.monotonic() - _checked_at[db_alias] < config.euro_exchange_rates_refresh_interval()):
+            return _exchange_rates[db_alias]
+        return _read_exchange_rates(db_alias)
+
+
+def _read_exchange_rates(db_alias: str) -> ExchangeRates:
+    """Reads the exchange rates of a db again when its max date changed (called with `_lock` held)"""
+    with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor:
+        cursor.execute('SELECT min(date), max(date) FROM euro_fx.exchange_rate')
+        first_date, max_date = cursor.fetchone()
+
+        if db_alias in _exchange_rates and _exchange_rates[db_alias].max_date == max_date:
+            _checked_at[db_alias] = time.monotonic()
+            return _exchange_rates[db_alias]
+
+        number_of_days = (max_date - first_date).days + 1 if max_date else 0
+        rates = {}
+        cursor.execute(f'''
+SELECT currency, date - {'%s'}, exchange_rate
+FROM euro_fx.exchange_rate''', (first_date,))
+        for currency, offset, exchange_rate in cursor:
+            if currency not in rates:
+                rates[currency] = (numpy.full(number_of_days, numpy.nan) if numpy is not None
+                                   else array.array('d', [math.nan]) * number_of_days)
+            rates[currency][offset] = exchange_rate
+
+        _exchange_rates[db_alias] = ExchangeRates(first_date=first_date, rates=rates, max_date=max_date)
+        _checked_at[db_alias] = time.monotonic()
+        return _exchange_rates[db_alias]
+
+
+def convert(amounts: [float], currencies: [str], dates: [datetime.date], db_alias: str = None):
+    """
+    Converts amounts in different currencies to Euro using the exchange rates of the respective days
+
+    Example:
+        convert([10.0, 20.0], ['USD', 'GBP'], [datetime.date(2020, 1, 2), datetime.date(2020, 1, 3)])
+
+    Args:
+        amounts: The amounts to convert
+        currencies: The currency of each amount, e.g. 'USD'
+        dates: The day of each amount
+        db_alias: The database that contains the `euro_fx` schema, default: the default db alias
+
+    Returns:
+        The amounts in Euro as a numpy array (a list when numpy is not installed),
+        `nan` for unknown currencies and days without exchange rates
+    """
+    return exchange_rates(db_alias).convert(amounts, currencies, dates)
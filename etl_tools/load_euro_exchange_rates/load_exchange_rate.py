@@ -1,24 +1,108 @@
+"""
+Writes Euro exchange rates from the European central bank as tab separated currency, exchange rate and date to stdout
+
+Usage:
+  python load_exchange_rate.py [--url URL] [--cache-file FILE] [--after-date YYYY-MM-DD]
+"""
+
+import argparse
 import csv
+import datetime
+import email.utils
+import io
+import os
+import shutil
 import sys
+import tempfile
+import urllib.error
 import urllib.request
 import zipfile
-from io import BytesIO, StringIO
 
 ZIP_FILE_URL = "https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip"
 ZIP_FILE_ARCHIVE_NAME = 'eurofxref-hist.csv'
 CSV_DATE_KEY = 'Date'
 
-zipfile = zipfile.ZipFile(BytesIO(urllib.request.urlopen(ZIP_FILE_URL).read()))
-input_stream = StringIO(zipfile.read(ZIP_FILE_ARCHIVE_NAME).decode('utf-8'))
-csv_reader = csv.DictReader(input_stream, delimiter=',')
 
-csv_writer = csv.writer(sys.stdout, delimiter="\t")
+def open_zip_file(url: str, cache_file: str = None):
+    """
+    Returns a binary file object with the content of the zip file at `url`.
+
+    When `url` is a local path, then that file is opened. Otherwise the file is downloaded (streamed to disk).
+    When `cache_file` is given, then the download is stored there and only repeated when the remote file changed.
+    """
+    if os.path.exists(url):
+        return open(url, 'rb')
+
+    request = urllib.request.Request(url)
+    if cache_file and os.path.exists(cache_file):
+        request.add_header('If-Modified-Since', email.utils.formatdate(os.path.getmtime(cache_file), usegmt=True))
+
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:  # not modified
+            return open(cache_file, 'rb')
+        raise
+
+    with response:
+        if cache_file:
+            # download to a new file next to the cache file, so that parallel runs don't write into the same file
+            with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(os.path.abspath(cache_file)),
+                                             prefix=os.path.basename(cache_file) + '.', delete=False) as f:
+                try:
+                    shutil.copyfileobj(response, f)
+                except BaseException:
+                    os.remove(f.name)
+                    raise
+            os.replace(f.name, cache_file)
+            if response.headers.get('Last-Modified'):
+                # make the next If-Modified-Since refer to the server's time of modification
+                last_modified = email.utils.parsedate_to_datetime(response.headers['Last-Modified']).timestamp()
+                os.utime(cache_file, (last_modified, last_modified))
+            return open(cache_file, 'rb')
+        else:
+            f = tempfile.TemporaryFile()
+            shutil.copyfileobj(response, f)
+            f.seek(0)
+            return f
+
+
+def parse_date(date: str) -> datetime.date:
+    return datetime.datetime.strptime(date, '%Y-%m-%d').date()
+
+
+def exchange_rates(zip_file, after_date: datetime.date = None):
+    """
+    Reads the exchange rates from the archive row by row
+
+    Yields:
+        Tuples of currency, exchange rate and date (as string)
+    """
+    with zipfile.ZipFile(zip_file) as archive, archive.open(ZIP_FILE_ARCHIVE_NAME) as member:
+        csv_reader = csv.DictReader(io.TextIOWrapper(member, encoding='utf-8'), delimiter=',')
+        for row in csv_reader:
+            # the file is sorted by date, latest first
+            if after_date and parse_date(row[CSV_DATE_KEY]) <= after_date:
+                break
+            for currency in row.keys():
+                # all currency codes have length 3
+                if len(currency) != 3:
+                    continue
+                if row[currency] == 'N/A':
+                    continue
+                yield currency, row[currency], row[CSV_DATE_KEY]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes Euro exchange rates from the European central bank to stdout')
+    parser.add_argument('--url', default=ZIP_FILE_URL, help='The url or local path of the history zip file')
+    parser.add_argument('--cache-file', help='Where to keep the downloaded zip file between runs')
+    parser.add_argument('--after-date', type=lambda s: parse_date(s) if s else None,
+                        help='Only write exchange rates after this date (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    csv_writer = csv.writer(sys.stdout, delimiter="\t")
 
-for row in csv_reader:
-    for currency in row.keys():
-        # all currency codes have length 3
-        if len(currency) != 3:
-            continue
-        if row[currency] == 'N/A':
-            continue
-        csv_writer.writerow([currency, row[currency], row[CSV_DATE_KEY]])
+    with open_zip_file(args.url, args.cache_file) as zip_file:
+        for currency, exchange_rate, date in exchange_rates(zip_file, args.after_date):
+            csv_writer.writerow([currency, exchange_rate, date])
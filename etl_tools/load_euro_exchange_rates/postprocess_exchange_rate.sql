@@ -1,6 +1,11 @@
 -- ECB exchange rates are given at the end of the day and only for bank working days.
 -- Make sure there are exchange rates are there for every date and currency
 
+-- Remember the last date with published exchange rates for incremental loads
+INSERT INTO euro_fx.exchange_rate_load_state
+  SELECT max(date)
+  FROM euro_fx.exchange_rate;
+
 INSERT INTO euro_fx.exchange_rate
 
   WITH all_days_and_currencies AS (
@@ -0,0 +1,66 @@
+-- Adds exchange rates that were published after the last load and fills missing days only after the
+-- last published date of the previous load. Exchange rates for days after that date were taken over from the
+-- last published date and are replaced.
+
+CREATE TEMPORARY TABLE previous_load_state AS
+  SELECT max(max_published_date) AS max_published_date
+  FROM euro_fx.exchange_rate_load_state;
+
+DELETE FROM euro_fx.exchange_rate
+WHERE date > (SELECT coalesce(max_published_date, '-infinity') FROM previous_load_state);
+
+INSERT INTO euro_fx.exchange_rate
+  SELECT *
+  FROM euro_fx.exchange_rate_new
+  ORDER BY currency, date;
+
+CREATE INDEX IF NOT EXISTS exchange_rate__currency_date
+  ON euro_fx.exchange_rate (currency, date) WITH ( FILLFACTOR = 100 );
+
+-- ECB exchange rates are given at the end of the day and only for bank working days.
+-- For every currency and day without an exchange rate, take the last known exchange rate
+INSERT INTO euro_fx.exchange_rate
+  SELECT
+    currency,
+    last_known_exchange_rate.exchange_rate,
+    day :: DATE AS date
+  FROM
+    generate_series((SELECT coalesce(max_published_date + 1, (SELECT min(date) FROM euro_fx.exchange_rate_new))
+                     FROM previous_load_state),
+                    current_timestamp,
+                    '1 day' :: INTERVAL) day
+    CROSS JOIN (SELECT DISTINCT currency
+                FROM euro_fx.exchange_rate
+                WHERE currency <> 'EUR') currency
+    CROSS JOIN LATERAL (SELECT exchange_rate
+                        FROM euro_fx.exchange_rate
+                        WHERE exchange_rate.currency = currency.currency AND exchange_rate.date <= day :: DATE
+                        ORDER BY date DESC
+                        LIMIT 1) last_known_exchange_rate
+  WHERE NOT exists(SELECT 1
+                   FROM euro_fx.exchange_rate
+                   WHERE exchange_rate.currency = currency.currency AND exchange_rate.date = day :: DATE)
+  ORDER BY currency, date;
+
+-- Insert an exchange rate of 1 for 'EUR' to simplify subsequent joins
+INSERT INTO euro_fx.exchange_rate
+  SELECT
+    'EUR' AS currency,
+    1     AS exchange_rate,
+    date
+  FROM (
+         SELECT DISTINCT date
+         FROM euro_fx.exchange_rate
+         WHERE date > (SELECT coalesce(max_published_date, '-infinity') FROM previous_load_state)
+       ) t
+  ORDER BY date;
+
+TRUNCATE euro_fx.exchange_rate_load_state;
+
+INSERT INTO euro_fx.exchange_rate_load_state
+  SELECT greatest((SELECT max_published_date FROM previous_load_state),
+                  (SELECT max(date) FROM euro_fx.exchange_rate_new));
+
+DROP TABLE euro_fx.exchange_rate_new;
+
+ANALYZE euro_fx.exchange_rate;
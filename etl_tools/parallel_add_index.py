@@ -0,0 +1,131 @@
+"""Parallel creation of indexes on all partitions of a (partitioned) table"""
+
+import mara_db.postgresql
+import mara_pipelines.config
+from mara_pipelines.commands.sql import ExecuteSQL
+from mara_pipelines.pipelines import Pipeline, ParallelTask, Task
+from mara_page import _
+
+from etl_tools import job_history
+
+
+class ParallelAddIndex(ParallelTask):
+    def __init__(self, id: str, schema_name: str, table_name: str,
+                 indexes: [{str: object}] = None,
+                 add_indexes_on_all_fks: bool = False, fk_method: str = 'brin', excluded_fk_columns: [str] = None,
+                 db_alias: str = None, max_number_of_parallel_tasks: int = None) -> None:
+        """
+        Creates indexes on all partitions (inherited tables) of a table in parallel.
+
+        Does the same as calling `util.add_index` (and `util.add_indexes_on_all_fks`) on the table, but the
+        builds on the individual partitions are distributed over several tasks, balanced by partition size
+        (or the durations of previous runs, see `etl_tools.job_history`).
+
+        Example:
+            ParallelAddIndex(id='index_order', schema_name='dim_next', table_name='order',
+                             indexes=[{'column_names': ['order_id'], 'unique_': True},
+                                      {'column_names': ['customer_fk', 'order_date'], 'method': 'btree'}],
+                             add_indexes_on_all_fks=True)
+
+        Args:
+            id: The id of the task
+            schema_name: The schema of the table
+            table_name: The table to index
+            indexes: For each index, the arguments for `util.add_index` (except schema, table and partition id)
+            add_indexes_on_all_fks: When true, then also add an index on each column that ends with '_fk'
+            fk_method: The index method for the indexes on `_fk` columns
+            excluded_fk_columns: `_fk` columns that should not be indexed
+            db_alias: The database of the table
+            max_number_of_parallel_tasks: How many indexes to build in parallel at most
+        """
+        super().__init__(id=id, description=f'Adds indexes to all partitions of {schema_name}.{table_name}',
+                         max_number_of_parallel_tasks=max_number_of_parallel_tasks)
+        self.schema_name = schema_name
+        self.table_name = table_name
+        self.indexes = indexes or []
+        self.add_indexes_on_all_fks = add_indexes_on_all_fks
+        self.fk_method = fk_method
+        self.excluded_fk_columns = excluded_fk_columns or []
+        self.db_alias = db_alias or mara_pipelines.config.default_db_alias()
+
+    def add_parallel_tasks(self, sub_pipeline: Pipeline) -> None:
+        indexes = list(self.indexes)
+
+        with mara_db.postgresql.postgres_cursor_context(self.db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            if self.add_indexes_on_all_fks:
+                cursor.execute(f"SELECT util.get_columns({'%s'}, {'%s'}, '%%_fk')",
+                               (self.schema_name, self.table_name))
+                for column_name, in cursor.fetchall():
+                    if column_name not in self.excluded_fk_columns:
+                        indexes.append({'column_names': [column_name], 'method': self.fk_method})
+
+            # the tables without inherited tables, as util.add_index recurses down to those
+            cursor.execute(f'''
+WITH RECURSIVE inherited_table AS (
+  SELECT pg_class.oid, relname
+  FROM pg_class
+  JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+  WHERE nspname = {'%s'} AND relname = {'%s'}
+  UNION
+  SELECT pg_class.oid, pg_class.relname
+  FROM inherited_table
+  JOIN pg_inherits ON inhparent = inherited_table.oid
+  JOIN pg_class ON pg_class.oid = inhrelid
+  JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+  WHERE nspname = {'%s'}
+)
+SELECT relname, pg_relation_size(oid) / 1000000.0
+FROM inherited_table
+WHERE NOT exists(SELECT 1 FROM pg_inherits WHERE inhparent = inherited_table.oid)''',
+                           (self.schema_name, self.table_name, self.schema_name))
+            partition_sizes = {relname: float(size) for relname, size in cursor.fetchall()}
+
+        commands, sizes = {}, {}
+        for partition_name, size in partition_sizes.items():
+            for index in indexes:
+                job_id = self._job_id(f'{partition_name}:{_index_key(index)}')
+                sizes[job_id] = size
+                commands[job_id] = job_history.RecordJobRun(
+                    job_id=job_id, size=size,
+                    command=ExecuteSQL(sql_statement=self._add_index_statement(partition_name, index),
+                                       db_alias=self.db_alias))
+
+        durations = job_history.estimate_durations(sizes, job_id_prefix=self._job_id())
+        number_of_tasks = self.max_number_of_parallel_tasks or mara_pipelines.config.max_number_of_parallel_tasks()
+        for n, job_ids in enumerate(job_history.pack(durations, number_of_bins=number_of_tasks)):
+            sub_pipeline.add(Task(id=f'add_indexes_{n}', description='Adds a portion of the indexes',
+                                  commands=[commands[job_id] for job_id in job_ids]))
+
+    def _add_index_statement(self, table_name: str, index: {str: object}) -> str:
+        """A call of `util.add_index` for a single table"""
+
+        def literal(value: object) -> str:
+            if isinstance(value, bool):
+                return 'TRUE' if value else 'FALSE'
+            elif isinstance(value, (list, tuple)):
+                return 'ARRAY [' + ', '.join(literal(item) for item in value) + ']'
+            else:
+                return "'" + str(value).replace("'", "''") + "'"
+
+        return (f"SELECT util.add_index('{self.schema_name}', '{table_name}'"
+                + ''.join(f', {name} := {literal(value)}' for name, value in index.items()) + ');')
+
+    def _job_id(self, name: str = '') -> str:
+        """The id under which the duration of building an index on a partition is recorded"""
+        return f'add_index:{self.schema_name}.{self.table_name}:{name}'
+
+    def html_doc_items(self) -> [(str, str)]:
+        return [('db', _.tt[self.db_alias]),
+                ('schema', _.tt[self.schema_name]),
+                ('table', _.tt[self.table_name]),
+                ('indexes', _.pre['\n'.join(self._add_index_statement(self.table_name, index)
+                                            for index in self.indexes)]),
+                ('add indexes on all fks', _.tt[repr(self.add_indexes_on_all_fks)]),
+                ('fk method', _.tt[self.fk_method]),
+                ('excluded fk columns', _.tt[', '.join(self.excluded_fk_columns)]),
+                ('recorded runs', job_history.html_job_runs(self._job_id()))]
+
+
+def _index_key(index: {str: object}) -> str:
+    """A readable identifier of an index definition"""
+    return ','.join(f'{name}={value}' for name, value in sorted(index.items()))
@@ -1,36 +1,53 @@
+import fnmatch
+import json
+import os
+import pathlib
+import re
+import tempfile
+import threading
+import typing
+
 from mara_pipelines import pipelines
 
+from etl_tools import config
+
+_excluded_file_patterns = ['__init__.py', '*.md', '*.pyc']
+
 
 class AbortOnSchemaMisuse(pipelines.Command):
-    def __init__(self, schema_name: str) -> None:
+    def __init__(self, schema_name: str, other_schema_names: [str] = None) -> None:
         """
         Checks that a pipeline does not use the specified schema in any files
 
-        Under the hood, it uses egrep to scan the directory for "schema_name\." .
-        It excludes '__init__.py' and *.md files.
+        Scans the directory of the pipeline for "schema_name\." in-process (see `scan_directories`).
+        It excludes '__init__.py', *.md and *.pyc files.
 
         Args:
             schema_name: str, the schema name which should not be used
+            other_schema_names: The schemas of other checks that are matched in the same pass, so that the scan
+                                results of `add_schema_misuse_check_as_first_command_in_initial_task` are re-used
         """
         self.schema_name = schema_name
         self.pattern = f'{schema_name}\.'
+        self.other_schema_names = other_schema_names or []
 
     def run(self):
-        from mara_pipelines import shell
         from mara_pipelines.logging import logger
-        pipeline_base_directory = self.parent.parent.base_path()
-        excludes = ' --exclude=__init__.py --exclude=\*.md --exclude=\*.pyc'
-        # cd'ing && grepping in . allows us to show short filenames
-        # The "(...) || true" will ensure that we do not get any output if nothing is found
-        shell_command = f'(cd "{pipeline_base_directory}" && egrep --recursive {excludes} "{self.pattern}" .) || true'
-        lines_or_bool = shell.run_shell_command(shell_command)
-        if lines_or_bool is True:
+        pipeline_base_directory = pathlib.Path(self.parent.parent.base_path()).resolve()
+        matches = scan_directories(directories=[pipeline_base_directory],
+                                   schema_names=[self.schema_name] + self.other_schema_names)
+
+        # same output as `cd pipeline_base_directory && egrep --recursive "schema_name\." .`
+        lines = [f'./{os.path.relpath(file_path, pipeline_base_directory)}:{line}'
+                 for file_path, matches_per_schema in sorted(matches.items())
+                 if file_path.startswith(str(pipeline_base_directory) + os.sep)
+                 for line in matches_per_schema.get(self.schema_name, [])]
+        if not lines:
             return True
         else:
-            # The || true makes sure we will not get any False
             logger.log(f"Please don\'t use the pattern '{self.pattern}' in this pipeline. Matching lines:",
                        format=logger.Format.ITALICS)
-            lines = '\n'.join(lines_or_bool)
+            lines = '\n'.join(lines)
             logger.log(f"{lines}", format=logger.Format.ITALICS)
             return False
 
@@ -39,12 +56,17 @@ class AbortOnSchemaMisuse(pipelines.Command):
         from html import escape
         return [
             ('schema_name', _.pre[escape(self.schema_name)]),
-            ('egrep pattern', _.pre[escape(self.pattern)]),
+            ('pattern', _.pre[escape(self.pattern)]),
         ]
 
 
 def add_schema_misuse_check_as_first_command_in_initial_task(pipeline: pipelines.Pipeline):
-    """Adds a check to any pipeline with a schema that this schema is not used in any files"""
+    """
+    Adds a check to any pipeline with a schema that this schema is not used in any files.
+
+    The directories of all these pipelines are scanned for all schemas together once, here. The checks run in
+    processes that are forked from this one and inherit the results, so that they only re-read files that changed.
+    """
 
     def _find_all_pipelines(pipeline: pipelines.Pipeline, all_found_pipelines):
         for node in pipeline.nodes.values():
@@ -54,6 +76,9 @@ def add_schema_misuse_check_as_first_command_in_initial_task(pipeline: pipelines
 
     all_pipelines = [pipeline]
     _find_all_pipelines(pipeline, all_pipelines)
+    schema_names = sorted({p.labels['Schema'] for p in all_pipelines if 'Schema' in p.labels})
+    scan_directories(directories=[p.base_path() for p in all_pipelines if 'Schema' in p.labels],
+                     schema_names=schema_names)
     for p in all_pipelines:
         if 'Schema' in p.labels:
             schema = p.labels['Schema']
@@ -63,4 +88,105 @@ def add_schema_misuse_check_as_first_command_in_initial_task(pipeline: pipelines
             else:
                 p.initial_node.description += f' + {description}'
             assert isinstance(p.initial_node, pipelines.Task)
-            p.initial_node.add_command(AbortOnSchemaMisuse(schema), prepend=True)
+            p.initial_node.add_command(AbortOnSchemaMisuse(schema, other_schema_names=schema_names), prepend=True)
+
+
+_lock = threading.Lock()
+_cache = {}
+
+
+def scan_directories(directories: [pathlib.Path], schema_names: [str]) -> {str: {str: [str]}}:
+    """
+    Finds all lines that contain "schema_name." for any of the schema names in the files of some directories
+
+    All schema names are matched in one pass over each file. The results are kept per file together with its
+    modification time and size (in this process and in `config.schema_check_cache_file()` when set), so that
+    unchanged files are not read again when the same schema names are looked for.
+
+    Args:
+        directories: The directories to scan (recursively)
+        schema_names: The schemas to look for
+
+    Returns:
+        For each file with matches, the matching lines per schema name
+    """
+    schema_names = sorted(set(schema_names))
+    directories = {pathlib.Path(directory).resolve() for directory in directories}
+    # nested directories are scanned as part of their parent
+    directories = sorted(directory for directory in directories
+                         if not any(parent in directories for parent in directory.parents))
+    # the lookahead also finds overlapping occurrences like "next." in "dim_next."
+    regex = re.compile('(?=(' + '|'.join(re.escape(schema_name) for schema_name
+                                         in sorted(schema_names, key=len, reverse=True)) + r')\.)')
+
+    with _lock:
+        cached_files = _read_cache(schema_names)
+        files = {}
+        for directory in directories:
+            for root, directory_names, file_names in os.walk(directory):
+                directory_names.sort()
+                for file_name in sorted(file_names):
+                    if any(fnmatch.fnmatch(file_name, pattern) for pattern in _excluded_file_patterns):
+                        continue
+                    file_path = os.path.join(root, file_name)
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        continue
+                    cached_file = cached_files.get(file_path)
+                    if cached_file and cached_file[0] == stat.st_mtime_ns and cached_file[1] == stat.st_size:
+                        files[file_path] = cached_file
+                    else:
+                        files[file_path] = [stat.st_mtime_ns, stat.st_size, _scan_file(file_path, regex)]
+
+        # keep the results for files in other directories
+        all_files = {file_path: cached_file for file_path, cached_file in cached_files.items()
+                     if not any(file_path.startswith(str(directory) + os.sep) for directory in directories)}
+        all_files.update(files)
+        if all_files != cached_files:
+            _write_cache(schema_names, all_files)
+
+    return {file_path: matches for file_path, (mtime, size, matches) in files.items() if matches}
+
+
+def _scan_file(file_path: str, regex: typing.Pattern) -> {str: [str]}:
+    """The lines of a file that match the regex, per matched schema name"""
+    try:
+        with open(file_path, 'rb') as file:
+            content = file.read().decode('utf-8', errors='replace')
+    except OSError:
+        return {}
+
+    matches = {}
+    if regex.search(content):
+        for line in content.splitlines():
+            for schema_name in sorted({match.group(1) for match in regex.finditer(line)}):
+                matches.setdefault(schema_name, []).append(line)
+    return matches
+
+
+def _read_cache(schema_names: [str]) -> {str: list}:
+    """The scan results of a previous run (in this process or from the cache file) for the same schemas"""
+    cache_file = config.schema_check_cache_file()
+    if cache_file:
+        try:
+            with open(cache_file) as file:
+                _cache.update(json.load(file))
+        except (OSError, ValueError):
+            pass
+    return _cache['files'] if _cache.get('schema_names') == schema_names else {}
+
+
+def _write_cache(schema_names: [str], files: {str: list}) -> None:
+    """Keeps the scan results for the next run"""
+    _cache.update({'schema_names': schema_names, 'files': files})
+    cache_file = config.schema_check_cache_file()
+    if cache_file:
+        # write to a new file first, as the checks of several pipelines run in parallel processes
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(cache_file)),
+                                             prefix=os.path.basename(cache_file) + '.', delete=False) as file:
+                json.dump(_cache, file)
+            os.replace(file.name, cache_file)
+        except OSError:
+            pass
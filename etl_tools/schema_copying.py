@@ -1,6 +1,11 @@
 """Machinery for copying whole schemas from one PostgreSQL database to another"""
 
+import hashlib
+import math
+import multiprocessing.util
+import re
 import shlex
+import uuid
 
 import mara_db.dbs
 import mara_db.postgresql
@@ -8,13 +13,26 @@ import mara_db.shell
 from mara_pipelines.commands import bash
 from mara_pipelines.commands.bash import RunBash
 from mara_pipelines.commands.sql import ExecuteSQL
+from mara_pipelines.logging import logger
 from mara_pipelines.pipelines import Pipeline, Task, ParallelTask, Command
 from mara_page import _
+from etl_tools import job_history, utils
+from etl_tools.adaptive_concurrency import AdaptiveConcurrency
+from etl_tools.copy_streaming import StreamBinaryCopy
 
 
 def add_schema_copying_to_pipeline(pipeline: Pipeline, schema_name,
                                    source_db_alias: str, target_db_alias: str,
-                                   max_number_of_parallel_tasks: int = 4):
+                                   max_number_of_parallel_tasks: int = 4, min_number_of_parallel_tasks: int = None,
+                                   split_tables_larger_than: float = None,
+                                   split_columns: {str: str} = None,
+                                   copy_method: str = 'psql', fdw_fetch_size: int = 10000,
+                                   default_index_settings: {str: str} = None,
+                                   index_settings: {str: {str: str}} = None,
+                                   load_mode: str = None, set_logged: bool = True,
+                                   incremental: bool = False, previous_schema_name: str = None,
+                                   fingerprint_method: str = 'checksum', resume_within_hours: float = None,
+                                   run_report: bool = True):
     """
     Adds schema copying to the end of a pipeline.
 
@@ -27,6 +45,33 @@ def add_schema_copying_to_pipeline(pipeline: Pipeline, schema_name,
         source_db_alias: The alias of the PostgreSQL database to copy from
         target_db_alias: The alias of the PostgreSQL database to copy to
         max_number_of_parallel_tasks: How many operations to run at parallel at max.
+        min_number_of_parallel_tasks: When set, then the number of parallel operations is adapted to the throughput
+                                      and load of the dbs, between this and `max_number_of_parallel_tasks`
+        split_tables_larger_than: Tables bigger than this (in MB) are copied in several parallel streams
+        split_columns: For some tables, a column that is used for splitting them with `util.compute_chunk`
+                       (instead of splitting by ctid ranges), e.g. `{'order': 'order_id'}`
+        copy_method: 'psql' for piping text COPY output through two psql processes, 'binary' for streaming
+                     binary COPY data between two connections inside the task process, 'fdw' for reading the source
+                     tables on the target db through `postgres_fdw`, 'auto' for 'fdw' when both dbs are on the same
+                     PostgreSQL server (and 'psql' otherwise)
+        fdw_fetch_size: How many rows `postgres_fdw` fetches from the source db at once
+        default_index_settings: Settings for building all indexes on the target db,
+                                e.g. `{'maintenance_work_mem': '1GB', 'max_parallel_maintenance_workers': 2}`
+        index_settings: Settings for building individual indexes,
+                        e.g. `{'order__order_id': {'maintenance_work_mem': '8GB'}}`
+        load_mode: None for loading into logged tables, 'unlogged' for loading into UNLOGGED tables,
+                   'freeze' for truncating tables and loading them with `COPY .. FREEZE` in one transaction
+        set_logged: Whether to switch tables back to LOGGED after loading them in 'unlogged' mode
+        incremental: When true, then tables that did not change since the last copy are not copied again
+        previous_schema_name: The schema in the target db that contains the last copy, default: `schema_name`
+                              (other schemas are left untouched, unchanged tables are copied from there)
+        fingerprint_method: How to detect changed tables, 'checksum' (a full scan of each table in the source db,
+                            before the copy starts) or 'statistics' (table statistics & file node, only for tables
+                            that are re-created when they change: the statistics are not transactional, they are
+                            reported with a delay and reset after a crash)
+        resume_within_hours: When set, then a copy that failed less than this many hours ago is continued
+                             (only the tables and indexes that were not completed are copied and built)
+        run_report: Whether to log throughput metrics and the critical path of the copy at the end
     """
     task_id = "copy_schema"
     description = f"Copies the {schema_name} schema to the {target_db_alias} db"
@@ -42,14 +87,81 @@ def add_schema_copying_to_pipeline(pipeline: Pipeline, schema_name,
         ParallelCopySchema(id=task_id, description=description, schema_name=schema_name,
                            source_db_alias=source_db_alias, target_db_alias=target_db_alias,
                            max_number_of_parallel_tasks=max_number_of_parallel_tasks,
-                           commands_before=commands[:-1], commands_after=commands[-1:]))
+                           min_number_of_parallel_tasks=min_number_of_parallel_tasks,
+                           split_tables_larger_than=split_tables_larger_than, split_columns=split_columns,
+                           copy_method=copy_method, fdw_fetch_size=fdw_fetch_size,
+                           default_index_settings=default_index_settings, index_settings=index_settings,
+                           load_mode=load_mode, set_logged=set_logged,
+                           incremental=incremental, previous_schema_name=previous_schema_name,
+                           fingerprint_method=fingerprint_method, resume_within_hours=resume_within_hours,
+                           run_report=run_report, commands_before=commands[:-1], commands_after=commands[-1:]))
 
 
 class ParallelCopySchema(ParallelTask):
     def __init__(self, id: str, description: str, max_number_of_parallel_tasks: int,
                  source_db_alias: str, target_db_alias: str, schema_name: str,
-                 commands_before: [Command] = None, commands_after: [Command] = None) -> None:
-        """In parallel copies a PostgreSQL database schema from one database to another."""
+                 split_tables_larger_than: float = None, split_columns: {str: str} = None,
+                 copy_method: str = 'psql', fdw_fetch_size: int = 10000,
+                 default_index_settings: {str: str} = None, index_settings: {str: {str: str}} = None,
+                 load_mode: str = None, set_logged: bool = True,
+                 incremental: bool = False, previous_schema_name: str = None, fingerprint_method: str = 'checksum',
+                 resume_within_hours: float = None, min_number_of_parallel_tasks: int = None,
+                 run_report: bool = True, commands_before: [Command] = None, commands_after: [Command] = None) -> None:
+        """
+        In parallel copies a PostgreSQL database schema from one database to another.
+
+        Tables bigger than `split_tables_larger_than` MB are split into several pieces that are copied in parallel
+        (and that are bin-packed together with all other tables). By default, pieces are ranges of physical
+        blocks (ctid ranges, only on PostgreSQL 14 and later, as older versions read each range with a full
+        table scan), for tables in `split_columns` the pieces are the chunks of `util.compute_chunk(<column>)`
+        in the source db.
+
+        With `copy_method='psql'`, table content is piped in text format through two psql processes.
+        With `copy_method='binary'`, it is streamed in binary format between two psycopg2 connections
+        inside the task process (see `etl_tools.copy_streaming`).
+        With `copy_method='fdw'`, the source schema is imported as `<schema_name>__source` into the target db with
+        `postgres_fdw` and tables are copied server-side with `INSERT .. SELECT` (split tables are split by ctid
+        ranges only, as `util.compute_chunk` can not be evaluated in the source db). `copy_method='auto'` uses
+        this when source and target db are different databases on the same PostgreSQL server.
+
+        The indexes of a table are built as soon as the table is copied. Copies of tables with big indexes run first.
+        `default_index_settings` and `index_settings` (per index name) are set in the session before building an index.
+
+        With `load_mode='unlogged'`, tables are created UNLOGGED on the target db so that the copy bypasses the WAL,
+        and (when `set_logged` is true) switched to LOGGED after loading and before building the indexes.
+        With `load_mode='freeze'`, each table is truncated and loaded with `COPY .. FREEZE` in the same transaction
+        so that the rows don't need to be frozen again by autovacuum (not possible for split tables).
+        In both modes, tables are analyzed after loading.
+
+        With `incremental=True`, a fingerprint of each copied table (structure and content) is stored in the
+        `util.schema_copy_fingerprint` table of the target db. Tables with the same fingerprint as in the last copy
+        (in `previous_schema_name`) are not copied again from the source db. When `previous_schema_name` is the
+        copied schema, then they are moved together with their indexes from the last copy to the new schema at the
+        end of the copy. Otherwise (e.g. when the last copy is the schema that is in use while the copy runs), they
+        are copied within the target db from `previous_schema_name`. Only plain tables without column defaults and
+        without columns of types from the copied schema are considered for that.
+
+        The durations of table copies and index builds are recorded in the mara db (see `etl_tools.job_history`).
+        Copies and index builds are distributed over tasks by their durations in the previous run (scaled by the
+        change in size), with an estimate from their size for new tables and indexes.
+
+        With `resume_within_hours`, completed table (piece) copies and index builds are recorded in the same
+        transaction in the `util.schema_copy_checkpoint` table of the target db. When the last copy failed less
+        than `resume_within_hours` hours ago, then the schema is not re-created and only the work that is not
+        recorded there is done again. The checkpoints are removed when the copy succeeds.
+
+        With `min_number_of_parallel_tasks`, the number of copies and index builds that run in parallel is adapted
+        between `min_number_of_parallel_tasks` and `max_number_of_parallel_tasks` to the throughput of the copy
+        and to the number of waiting sessions in the source and target db (see `etl_tools.adaptive_concurrency`).
+
+        With `run_report`, a last task logs a JSON report with rows, bytes, durations, throughput, lock wait and
+        queueing times of each table copy and index build, and the chain of jobs that determined the wall clock
+        time of the copy (see `etl_tools.job_history.run_report`).
+        """
+        assert copy_method in ('psql', 'binary', 'fdw', 'auto'), f'Unknown copy method "{copy_method}"'
+        assert not (copy_method == 'fdw' and load_mode == 'freeze'), 'COPY .. FREEZE is not possible with fdw'
+        assert load_mode in (None, 'unlogged', 'freeze'), f'Unknown load mode "{load_mode}"'
+        assert fingerprint_method in ('checksum', 'statistics'), f'Unknown fingerprint method "{fingerprint_method}"'
 
         ParallelTask.__init__(self, id=id, description=description,
                               max_number_of_parallel_tasks=max_number_of_parallel_tasks,
@@ -58,6 +170,24 @@ class ParallelCopySchema(ParallelTask):
         self.source_db_alias = source_db_alias
         self.target_db_alias = target_db_alias
         self.schema_name = schema_name
+        self.split_tables_larger_than = split_tables_larger_than
+        self.split_columns = split_columns or {}
+        self.copy_method = copy_method
+        self.fdw_fetch_size = fdw_fetch_size
+        self._resolved_copy_method = None
+        self.default_index_settings = default_index_settings or {}
+        self.index_settings = index_settings or {}
+        self.load_mode = load_mode
+        self.set_logged = set_logged
+        self.incremental = incremental
+        self.previous_schema_name = previous_schema_name or schema_name
+        self.fingerprint_method = fingerprint_method
+        self.resume_within_hours = resume_within_hours
+        self.min_number_of_parallel_tasks = min_number_of_parallel_tasks
+        self.run_report = run_report
+        self._run_id = None
+        self._report_jobs = {}
+        self._tables_copied_from_previous_schema = set()
 
     def add_parallel_tasks(self, sub_pipeline: Pipeline) -> None:
         source_db = mara_db.dbs.db(self.source_db_alias)
@@ -68,14 +198,34 @@ class ParallelCopySchema(ParallelTask):
         with mara_db.postgresql.postgres_cursor_context(self.source_db_alias) as cursor:
             pg_version = cursor.connection.server_version
 
+        if self.min_number_of_parallel_tasks:
+            sub_pipeline.max_number_of_parallel_tasks = AdaptiveConcurrency(
+                label=self.id, min_number_of_parallel_tasks=self.min_number_of_parallel_tasks,
+                max_number_of_parallel_tasks=self.max_number_of_parallel_tasks,
+                target_db_alias=self.target_db_alias, target_schema_name=self.schema_name,
+                other_db_aliases=[self.source_db_alias])
+
+        self._run_id = f'{self._job_id("run")}{uuid.uuid4().hex}' if self.run_report else None
+        self._report_jobs = {}
+
+        # the work of a failed copy that can be kept
+        completed_jobs = self._completed_jobs() if self.resume_within_hours else {}
+        resuming = 'ddl' in completed_jobs
+        if resuming:
+            logger.log(f'Resuming the copy of {self.schema_name} from {len(completed_jobs) - 1} completed jobs '
+                       f'({sum(row_count or 0 for row_count in completed_jobs.values())} rows copied)',
+                       format=logger.Format.ITALICS)
+
         ddl_task = Task(
             id='create_tables_and_functions',
-            description='Re-creates the schema, tables structure and functions on the target db',
-            commands=[
+            description='Keeps the schema, tables structure and functions of the last (failed) copy' if resuming
+            else 'Re-creates the schema, tables structure and functions on the target db',
+            commands=[] if resuming else [
                 # schema and table structure
                 bash.RunBash(
                     command="(echo 'DROP SCHEMA IF EXISTS " + self.schema_name + " CASCADE;';\\\n"
                             + "    pg_dump --username=" + source_db.user + " --host=" + source_db.host
+                            + (" --port=" + str(source_db.port) if source_db.port else '')
                             + " --schema=" + self.schema_name
                             + " --section=pre-data --no-owner --no-privileges " + source_db.database + ") \\\n"
                             + "  | " + mara_db.shell.query_command(self.target_db_alias,
@@ -93,76 +243,674 @@ WHERE pg_proc.pronamespace = pg_namespace.oid
                             + "  | " + mara_db.shell.copy_to_stdout_command(self.source_db_alias) + ' \\\n'
                             + "  | " + mara_db.shell.query_command(self.target_db_alias, echo_queries=False))
             ])
+        if self.resolved_copy_method() == 'fdw':
+            ddl_task.add_command(_CreateForeignSchema(schema_name=self.schema_name,
+                                                      source_db_alias=self.source_db_alias,
+                                                      target_db_alias=self.target_db_alias,
+                                                      fetch_size=self.fdw_fetch_size))
+        if self.load_mode == 'unlogged' and not resuming:
+            ddl_task.add_command(ExecuteSQL(sql_statement=f"""
+DO $$
+DECLARE table_name TEXT;
+BEGIN
+  FOR table_name IN SELECT relname
+                    FROM pg_class
+                    JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+                    WHERE nspname = '{self.schema_name}' AND relkind = 'r' AND relpersistence = 'p'
+  LOOP
+    EXECUTE 'ALTER TABLE {self.schema_name}.' || quote_ident(table_name) || ' SET UNLOGGED';
+  END LOOP;
+END
+$$;""", db_alias=self.target_db_alias, echo_queries=False))
+        if self.incremental:
+            if self.previous_schema_name == self.schema_name and not resuming:
+                # keep the last copy until unchanged tables are moved out of it. When the last copy failed, then
+                # the copy before is still in the __previous schema (and the failed one is dropped)
+                ddl_task.add_command(ExecuteSQL(sql_statement=f"""
+DO $$
+BEGIN
+  IF to_regclass('util.schema_copy_fingerprint') IS NOT NULL THEN
+    IF EXISTS (SELECT 1
+               FROM util.schema_copy_fingerprint
+               JOIN pg_class ON pg_class.oid = table_oid
+               JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+               WHERE nspname = '{self.schema_name}__previous') THEN
+      RETURN;
+    END IF;
+  END IF;
+
+  DROP SCHEMA IF EXISTS {self.schema_name}__previous CASCADE;
+  IF EXISTS (SELECT 1 FROM pg_namespace WHERE nspname = '{self.schema_name}') THEN
+    ALTER SCHEMA {self.schema_name} RENAME TO {self.schema_name}__previous;
+  END IF;
+END
+$$;""", db_alias=self.target_db_alias),
+                                     prepend=True)
+            ddl_task.add_command(ExecuteSQL(sql_statement="""
+CREATE TABLE IF NOT EXISTS util.schema_copy_fingerprint (
+    table_oid   OID PRIMARY KEY,
+    fingerprint TEXT        NOT NULL,
+    recorded_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);""", db_alias=self.target_db_alias, echo_queries=False))
+        if self.resume_within_hours and not resuming:
+            ddl_task.add_command(ExecuteSQL(sql_statement=f"""
+CREATE TABLE IF NOT EXISTS util.schema_copy_checkpoint (
+    schema_name  TEXT        NOT NULL,
+    job          TEXT        NOT NULL,
+    completed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    row_count    BIGINT,
+    PRIMARY KEY (schema_name, job)
+);
+
+DELETE FROM util.schema_copy_checkpoint WHERE schema_name = '{self.schema_name}';""",
+                                            db_alias=self.target_db_alias, echo_queries=False))
+            ddl_task.add_command(self._checkpoint_command('ddl'))
+        if self._run_id:
+            ddl_commands, ddl_task.commands = ddl_task.commands, []
+            for n, command in enumerate(ddl_commands):
+                ddl_task.add_command(self._record_job_run('ddl', str(n), None, command, record_history=False))
         sub_pipeline.add(ddl_task)
 
         # copy content of tables
         number_of_chunks = self.max_number_of_parallel_tasks * 3
         table_copy_chunks = {i: [] for i in range(0, number_of_chunks)}
-        current_size_per_table_copy_chunk = [0] * number_of_chunks
+        current_duration_per_table_copy_chunk = [0] * number_of_chunks
         table_types = {}
 
         with mara_db.postgresql.postgres_cursor_context(
                 self.source_db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            # cstore_fdw is optional on the source db, cstore tables with similar size take longer to copy
+            cursor.execute("SELECT to_regproc('cstore_table_size') IS NOT NULL")
+            foreign_table_size = ("cstore_table_size(nspname || '.' || relname) * 10" if cursor.fetchone()[0]
+                                  else 'pg_total_relation_size(pg_class.oid)')
             cursor.execute("""
 SELECT 
     pg_class.relname AS table,
     relkind,
     CASE WHEN relkind = 'f' 
-         THEN cstore_table_size(nspname || '.' || relname) * 10 -- cstore tables with similar size take longer to copy 
+         THEN """ + foreign_table_size + """
          ELSE  pg_total_relation_size(pg_class.oid)
-    END / 1000000.0 AS size
+    END / 1000000.0 AS size,
+    CASE WHEN relkind = 'r' 
+         THEN pg_relation_size(pg_class.oid) / current_setting('block_size')::INTEGER 
+    END AS number_of_blocks,
+    relkind = 'r' AND NOT relispartition
+      AND NOT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = pg_class.oid)
+      AND NOT EXISTS (SELECT 1 FROM pg_attrdef WHERE adrelid = pg_class.oid)
+      AND NOT EXISTS (SELECT 1
+                      FROM pg_attribute
+                      JOIN pg_type ON pg_type.oid = atttypid
+                      WHERE attrelid = pg_class.oid AND attnum > 0
+                            AND typnamespace = pg_namespace.oid) AS reusable
 FROM pg_class
 JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
 WHERE nspname = '""" + self.schema_name + """' AND relkind IN ('r', 'f') AND relhassubclass = 'f'
 ORDER BY size DESC""")
-            for table_name, type, size in cursor.fetchall():
-                smallest_chunk_index = min(range(len(current_size_per_table_copy_chunk)),
-                                           key=current_size_per_table_copy_chunk.__getitem__)
-                current_size_per_table_copy_chunk[smallest_chunk_index] += size
-                table_copy_chunks[smallest_chunk_index].append(table_name)
+            table_pieces = []
+            reusable_tables = []
+            for table_name, type, size, number_of_blocks, reusable in cursor.fetchall():
+                size = float(size)
                 table_types[table_name] = type
+                if reusable:
+                    reusable_tables.append(table_name)
+                conditions = self._split_conditions(table_name, type, size, number_of_blocks, pg_version)
+                for condition in conditions:
+                    table_pieces.append((table_name, condition, size / len(conditions)))
 
-            copy_tasks = []
-            for i, tables in table_copy_chunks.items():
-                if tables:
-                    task = Task(
-                        id=f'copy_tables_{i}',
-                        description='Copies table content to the frontend db',
-                        commands=[RunBash(
-                            command=f'echo {shlex.quote(f"COPY {self.schema_name}.{table_name} TO STDOUT")} \\\n'
-                                    + '  | ' + mara_db.shell.copy_to_stdout_command(self.source_db_alias) + ' \\\n'
-                                    + '  | ' + mara_db.shell.copy_from_stdin_command(self.target_db_alias,
-                                                                                     target_table=f'{self.schema_name}.{table_name}'))
-                            for table_name in tables])
-                    copy_tasks.append(task)
-                    sub_pipeline.add(task, upstreams=[ddl_task])
-
-            # create indexes
-            index_chunks = {i: [] for i in range(0, number_of_chunks)}
-            current_size_per_index_chunk = [0] * number_of_chunks
-
-            with mara_db.postgresql.postgres_cursor_context(self.source_db_alias) as cursor:
-                cursor.execute(""" 
-SELECT indexdef AS ddl, pg_total_relation_size(pg_class.oid) AS size
+            cursor.execute(""" 
+SELECT tablename, indexname, indexdef AS ddl, pg_total_relation_size(pg_class.oid) / 1000000.0 AS size
 FROM pg_class
 JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
 JOIN pg_indexes ON pg_indexes.indexname = pg_class.relname AND pg_indexes.schemaname = nspname
 WHERE nspname = '""" + self.schema_name + """' AND relkind = 'i'
 ORDER BY size DESC;""")
-                for ddl, size in cursor.fetchall():
-                    smallest_chunk_index = min(range(len(current_size_per_index_chunk)),
-                                               key=current_size_per_index_chunk.__getitem__)
-                    current_size_per_index_chunk[smallest_chunk_index] += size
-                    index_chunks[smallest_chunk_index].append(ddl)
-
-            for i, index_statements in index_chunks.items():
-                if index_statements:
-                    index_task = Task(id=f'add_indexes_{i}', description='Re-creates indexes on frontend db',
-                                      commands=[ExecuteSQL(sql_statement=statement, db_alias=self.target_db_alias)
-                                                for statement in index_statements])
-                    sub_pipeline.add(index_task, upstreams=copy_tasks)
+            indexes_per_table = {}
+            for table_name, index_name, ddl, size in cursor.fetchall():
+                indexes_per_table.setdefault(table_name, []).append((index_name, ddl, float(size)))
+
+        # in incremental mode, don't copy & index tables that did not change since the last copy
+        fingerprints = {}
+        unchanged_tables = []
+        if self.incremental:
+            fingerprints = self._fingerprints(reusable_tables)
+            previous_fingerprints = self._previous_fingerprints()
+            unchanged_tables = [table_name for table_name, fingerprint in fingerprints.items()
+                                if previous_fingerprints.get(table_name) == fingerprint]
+            if self.previous_schema_name == self.schema_name:
+                table_pieces = [piece for piece in table_pieces if piece[0] not in unchanged_tables]
+                for table_name in unchanged_tables:
+                    indexes_per_table.pop(table_name, None)
+            else:
+                # tables of a schema that is possibly in use are not moved, but copied within the target db
+                self._tables_copied_from_previous_schema = set(unchanged_tables)
+                table_pieces = ([piece for piece in table_pieces if piece[0] not in unchanged_tables]
+                                + [(table_name, None, sum(size for name, condition, size in table_pieces
+                                                          if name == table_name))
+                                   for table_name in unchanged_tables])
+                unchanged_tables = []
+
+        # don't copy again what was completed in the failed copy
+        copied_tables = list(dict.fromkeys(piece[0] for piece in table_pieces))
+        table_pieces = [piece for piece in table_pieces
+                        if self._checkpoint_job('copy', piece[0], piece[1]) not in completed_jobs]
+        indexes_per_table = {table_name: [index for index in indexes
+                                          if self._checkpoint_job('index', index[0]) not in completed_jobs]
+                             for table_name, indexes in indexes_per_table.items()}
+
+        # estimate durations of copies and index builds from previous runs, or from sizes when there is no history
+        table_sizes = {}
+        for table_name, condition, size in table_pieces:
+            table_sizes[table_name] = table_sizes.get(table_name, 0) + size
+        copy_durations = job_history.estimate_durations(
+            {self._job_id('copy', table_name): size for table_name, size in table_sizes.items()},
+            job_id_prefix=self._job_id('copy'))
+        index_durations = job_history.estimate_durations(
+            {self._job_id('index', index_name): size
+             for indexes in indexes_per_table.values() for index_name, ddl, size in indexes},
+            job_id_prefix=self._job_id('index'))
+        table_pieces = [(table_name, condition,
+                         size, copy_durations[self._job_id('copy', table_name)] * size / (table_sizes[table_name] or 1))
+                        for table_name, condition, size in table_pieces]
+        indexes_per_table = {table_name: [(index_name, ddl, size, index_durations[self._job_id('index', index_name)])
+                                          for index_name, ddl, size in indexes]
+                             for table_name, indexes in indexes_per_table.items()}
+
+        # the copy of a table with big indexes should finish early so that its index builds can start early
+        table_cost = {}
+        for table_name, indexes in indexes_per_table.items():
+            table_cost[table_name] = sum(duration for index_name, ddl, size, duration in indexes)
+        for table_name, condition, size, duration in table_pieces:
+            table_cost[table_name] = table_cost.get(table_name, 0) + duration
+
+        for table_name, condition, size, duration in sorted(table_pieces, key=lambda piece: piece[3], reverse=True):
+            smallest_chunk_index = min(range(len(current_duration_per_table_copy_chunk)),
+                                       key=current_duration_per_table_copy_chunk.__getitem__)
+            current_duration_per_table_copy_chunk[smallest_chunk_index] += duration
+            table_copy_chunks[smallest_chunk_index].append((table_name, condition, size))
+
+        copy_tasks = []
+        copy_tasks_per_table = {}
+        for i, pieces in sorted(table_copy_chunks.items(),
+                                key=lambda item: max([table_cost[piece[0]] for piece in item[1]] or [0]),
+                                reverse=True):
+            if pieces:
+                pieces = sorted(pieces, key=lambda piece: table_cost[piece[0]], reverse=True)
+                task = Task(id=f'copy_tables_{i}', description='Copies table content to the frontend db')
+                for table_name, condition, size in pieces:
+                    task.add_command(self._record_job_run('copy', table_name, size,
+                                                          self._copy_command(table_name, condition, resuming),
+                                                          relation_name=f'{self.schema_name}.{table_name}'))
+                copy_tasks.append(task)
+                for table_name, condition, size in pieces:
+                    copy_tasks_per_table.setdefault(table_name, []).append(task)
+                sub_pipeline.add(task, upstreams=[ddl_task])
+
+        # tables that were completely copied by the failed copy
+        for table_name in copied_tables:
+            copy_tasks_per_table.setdefault(table_name, [ddl_task])
+
+        if self.resolved_copy_method() == 'fdw':
+            drop_statement = (f'DROP SCHEMA IF EXISTS {self.schema_name}__source CASCADE;\n'
+                              + f'DROP SERVER IF EXISTS {self.schema_name}__source CASCADE;')
+            sub_pipeline.add(
+                Task(id='drop_foreign_schema', description='Removes the imported source schema',
+                     commands=[ExecuteSQL(sql_statement=drop_statement, db_alias=self.target_db_alias)]),
+                upstreams=copy_tasks or [ddl_task])
+            # the user mapping contains the password of the source db. When the copy fails (and the task above does
+            # not run), then the server is removed when the process that runs the pipeline exits
+            multiprocessing.util.Finalize(None, self._drop_foreign_schema, args=(drop_statement,), exitpriority=0)
+
+        # switch loaded tables back to logged & analyze them
+        if self.load_mode:
+            for table_name in copied_tables:
+                if self._checkpoint_job('post_load', table_name) in completed_jobs:
+                    continue
+                copy_tasks_of_table = copy_tasks_per_table[table_name]
+                post_load_task = Task(
+                    id='post_load_' + self._table_id(table_name),
+                    description=f'Prepares {self.schema_name}.{table_name} for building indexes and querying',
+                    commands=[ExecuteSQL(sql_statement=f'ALTER TABLE {self.schema_name}.{table_name} SET LOGGED;',
+                                         db_alias=self.target_db_alias)]
+                             if self.load_mode == 'unlogged' and self.set_logged else [])
+                post_load_task.add_command(ExecuteSQL(sql_statement=f'ANALYZE {self.schema_name}.{table_name};',
+                                                      db_alias=self.target_db_alias))
+                if self.resume_within_hours:
+                    post_load_task.add_command(self._checkpoint_command('post_load', table_name))
+                sub_pipeline.add(post_load_task, upstreams=copy_tasks_of_table)
+                copy_tasks_per_table[table_name] = [post_load_task]
+
+        # create indexes of each table as soon as the table is copied,
+        # tables with many big indexes are spread over several tasks
+        max_index_chunk_duration = sum(duration for indexes in indexes_per_table.values()
+                                       for index_name, ddl, size, duration in indexes) / number_of_chunks
+        index_tasks = []
+        for table_name, indexes in indexes_per_table.items():
+            if not indexes:
+                continue
+            number_of_index_chunks = min(len(indexes), max(1, math.ceil(
+                sum(duration for index_name, ddl, size, duration in indexes) / (max_index_chunk_duration or 1))))
+            index_chunks = [[] for i in range(number_of_index_chunks)]
+            current_duration_per_index_chunk = [0] * number_of_index_chunks
+            for index_name, ddl, size, duration in sorted(indexes, key=lambda index: index[3], reverse=True):
+                smallest_chunk_index = min(range(len(current_duration_per_index_chunk)),
+                                           key=current_duration_per_index_chunk.__getitem__)
+                current_duration_per_index_chunk[smallest_chunk_index] += duration
+                index_chunks[smallest_chunk_index].append((index_name, ddl, size))
+
+            task_id = 'add_indexes_' + self._table_id(table_name)
+            for i, index_chunk in enumerate(index_chunks):
+                index_tasks.append(
+                    (current_duration_per_index_chunk[i],
+                     Task(id=task_id + (f'_{i}' if number_of_index_chunks > 1 else ''),
+                          description=f'Re-creates indexes of {self.schema_name}.{table_name} on frontend db',
+                          commands=[command for index_name, ddl, size in index_chunk for command in [
+                              self._record_job_run(
+                                  'index', index_name, size,
+                                  ExecuteSQL(sql_statement=self._index_statement(index_name, ddl, resuming),
+                                             db_alias=self.target_db_alias),
+                                  relation_name=f'{self.schema_name}.{index_name}')]]),
+                     # indexes of tables that are not copied (e.g. of partitioned tables) wait for all copies
+                     copy_tasks_per_table.get(table_name, copy_tasks)))
+
+        for size, index_task, upstreams in sorted(index_tasks, key=lambda item: item[0], reverse=True):
+            sub_pipeline.add(index_task, upstreams=upstreams)
+
+        if self.incremental:
+            reuse_task = Task(id='reuse_unchanged_tables',
+                              description='Moves unchanged tables from the last copy and records table fingerprints',
+                              commands=[ExecuteSQL(sql_statement=self._reuse_tables_statement(unchanged_tables),
+                                                   db_alias=self.target_db_alias)] if unchanged_tables else [])
+            reuse_task.add_command(ExecuteSQL(sql_statement=self._record_fingerprints_statement(
+                {table_name: fingerprint for table_name, fingerprint in fingerprints.items()
+                 if table_name not in unchanged_tables}), db_alias=self.target_db_alias, echo_queries=False))
+            if self.previous_schema_name == self.schema_name:
+                reuse_task.add_command(ExecuteSQL(
+                    sql_statement=f'DROP SCHEMA IF EXISTS {self.schema_name}__previous CASCADE;',
+                    db_alias=self.target_db_alias))
+            other_nodes = [node for node in sub_pipeline.nodes.values()
+                           if node not in (sub_pipeline.initial_node, sub_pipeline.final_node)]
+            sub_pipeline.add(reuse_task, upstreams=other_nodes)
+
+        if self.resume_within_hours:
+            other_nodes = [node for node in sub_pipeline.nodes.values()
+                           if node not in (sub_pipeline.initial_node, sub_pipeline.final_node)]
+            sub_pipeline.add(
+                Task(id='remove_checkpoints', description='Removes the records of completed work of this copy',
+                     commands=[ExecuteSQL(sql_statement=f"DELETE FROM util.schema_copy_checkpoint "
+                                                        f"WHERE schema_name = '{self.schema_name}';",
+                                          db_alias=self.target_db_alias)]),
+                upstreams=other_nodes)
+
+        if self._run_id:
+            job_history.sample_lock_waits(self._run_id, sub_pipeline, self.path(), self.target_db_alias)
+            other_nodes = [node for node in sub_pipeline.nodes.values()
+                           if node not in (sub_pipeline.initial_node, sub_pipeline.final_node)]
+            sub_pipeline.add(
+                Task(id='report', description='Logs throughput metrics and the critical path of the copy',
+                     commands=[job_history.LogRunReport(
+                         run_id=self._run_id, jobs=self._report_jobs,
+                         upstream_tasks={node.id: [upstream.id for upstream in node.upstreams]
+                                         for node in other_nodes},
+                         db_alias=self.target_db_alias)]),
+                upstreams=other_nodes)
+
+    def _record_job_run(self, kind: str, name: str, size: float, command: Command,
+                        relation_name: str = None, record_history: bool = True) -> job_history.RecordJobRun:
+        """Wraps a command so that its duration is recorded (and reported at the end of the copy)"""
+        job_id = self._job_id(kind, name)
+        if self._run_id:
+            self._report_jobs[job_id] = (kind, name, relation_name)
+        return job_history.RecordJobRun(job_id=job_id, size=size, command=command, run_id=self._run_id,
+                                        record_history=record_history)
+
+    def _split_conditions(self, table_name: str, type: str, size: float, number_of_blocks: int,
+                          pg_version: int) -> [str]:
+        """Returns the where conditions of the pieces in which a table is copied (`[None]` for unsplit tables)"""
+        if not self.split_tables_larger_than or size <= self.split_tables_larger_than:
+            return [None]
+
+        if table_name in self.split_columns and self.resolved_copy_method() != 'fdw':
+            return [f'util.compute_chunk("{self.split_columns[table_name]}") = {chunk}'
+                    for chunk, in utils.chunk_parameter_function()]
+
+        if type != 'r' or not number_of_blocks:  # foreign (cstore) tables have no ctid
+            return [None]
+
+        if pg_version < 140000:  # no TID range scans, each piece would read the whole table
+            return [None]
+
+        number_of_pieces = min(math.ceil(size / self.split_tables_larger_than), self.max_number_of_parallel_tasks * 3,
+                               number_of_blocks)
+        if number_of_pieces < 2:
+            return [None]
+
+        boundaries = [number_of_blocks * i // number_of_pieces for i in range(1, number_of_pieces)]
+        return [' AND '.join(([f"ctid >= '({lower},0)'::TID"] if lower is not None else [])
+                             + ([f"ctid < '({upper},0)'::TID"] if upper is not None else []))
+                for lower, upper in zip([None] + boundaries, boundaries + [None])]
+
+    def _copy_source(self, table_name: str, condition: str = None) -> str:
+        """The argument for a `COPY .. TO STDOUT` command for a table (piece)"""
+        if condition:
+            return f'(SELECT * FROM {self.schema_name}.{table_name} WHERE {condition})'
+        else:
+            return f'{self.schema_name}.{table_name}'
+
+    def resolved_copy_method(self) -> str:
+        """The copy method that is used, with 'auto' resolved to 'fdw' or 'psql'"""
+        if not self._resolved_copy_method:
+            self._resolved_copy_method = self.copy_method
+            if self.copy_method == 'auto':
+                source_db = mara_db.dbs.db(self.source_db_alias)
+                target_db = mara_db.dbs.db(self.target_db_alias)
+                self._resolved_copy_method = 'psql'
+                if (self.load_mode != 'freeze'
+                        and (source_db.host or 'localhost', source_db.port or 5432)
+                        == (target_db.host or 'localhost', target_db.port or 5432)
+                        and source_db.database != target_db.database):
+                    with mara_db.postgresql.postgres_cursor_context(self.target_db_alias) as cursor:
+                        cursor.execute("SELECT exists(SELECT 1 FROM pg_available_extensions "
+                                       "WHERE name = 'postgres_fdw')")
+                        if cursor.fetchone()[0]:
+                            self._resolved_copy_method = 'fdw'
+        return self._resolved_copy_method
+
+    def _fingerprints(self, table_names: [str]) -> {str: str}:
+        """Computes for tables in the source db a hash that changes when their structure or content changes"""
+        import concurrent.futures
+
+        with mara_db.postgresql.postgres_cursor_context(self.source_db_alias) as cursor:
+            cursor.execute(f'''
+SELECT 
+    pg_class.relname,
+    concat_ws(' | ',
+      (SELECT string_agg(attname || ' ' || format_type(atttypid, atttypmod) || ' ' || attnotnull, ', ' ORDER BY attnum)
+       FROM pg_attribute
+       WHERE attrelid = pg_class.oid AND attnum > 0 AND NOT attisdropped),
+      (SELECT string_agg(pg_get_indexdef(indexrelid), ', ' ORDER BY pg_get_indexdef(indexrelid))
+       FROM pg_index
+       WHERE indrelid = pg_class.oid),
+      (SELECT string_agg(conname || ' ' || pg_get_constraintdef(pg_constraint.oid), ', ' ORDER BY conname)
+       FROM pg_constraint
+       WHERE conrelid = pg_class.oid),
+      concat_ws(', ', pg_relation_filenode(pg_class.oid), n_live_tup, n_tup_ins, n_tup_upd, n_tup_del))
+FROM pg_class
+JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+LEFT JOIN pg_stat_user_tables ON relid = pg_class.oid
+WHERE nspname = {'%s'} AND pg_class.relname = ANY({'%s'})''', (self.schema_name, table_names))
+            structures = dict(cursor.fetchall())
+
+        def content_checksum(table_name: str) -> str:
+            with mara_db.postgresql.postgres_cursor_context(self.source_db_alias) as cursor:
+                cursor.execute(f'''
+SELECT count(*) || ', ' || coalesce(sum(hashtext(t::TEXT)::BIGINT), 0)
+FROM {self.schema_name}.{table_name} t''')
+                return cursor.fetchone()[0]
+
+        if self.fingerprint_method == 'checksum':
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_number_of_parallel_tasks) as executor:
+                contents = dict(zip(structures.keys(), executor.map(content_checksum, structures.keys())))
+        else:
+            contents = {table_name: '' for table_name in structures.keys()}
+
+        return {table_name: hashlib.md5(f'{structure} | {contents[table_name]}'.encode()).hexdigest()
+                for table_name, structure in structures.items()}
+
+    def _previous_fingerprints(self) -> {str: str}:
+        """Reads the fingerprints of the tables of the last (complete) copy from the target db"""
+        with mara_db.postgresql.postgres_cursor_context(self.target_db_alias) as cursor:
+            cursor.execute("SELECT to_regclass('util.schema_copy_fingerprint') IS NOT NULL")
+            if not cursor.fetchone()[0]:
+                return {}
+            cursor.execute(f'''
+SELECT nspname, relname, fingerprint
+FROM util.schema_copy_fingerprint
+JOIN pg_class ON pg_class.oid = table_oid
+JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+WHERE nspname IN ({'%s'}, {'%s'})''', (self.previous_schema_name, f'{self.schema_name}__previous'))
+            fingerprints = {}
+            for schema_name, table_name, fingerprint in cursor.fetchall():
+                fingerprints.setdefault(schema_name, {})[table_name] = fingerprint
+
+        # after a failed (or while resuming a) copy, the last complete copy is still in the __previous schema
+        if self.previous_schema_name == self.schema_name and f'{self.schema_name}__previous' in fingerprints:
+            return fingerprints[f'{self.schema_name}__previous']
+        return fingerprints.get(self.previous_schema_name, {})
+
+    def _reuse_tables_statement(self, table_names: [str]) -> str:
+        """
+        A statement that replaces tables in the target schema with the tables of the last copy (in `__previous`).
+        Views that are dropped together with the replaced tables are re-created afterwards.
+        """
+        return f"""
+DO $$
+DECLARE v RECORD;
+BEGIN
+  CREATE TEMPORARY TABLE schema_copy_view ON COMMIT DROP AS
+    SELECT pg_class.oid, relname, relkind, pg_get_viewdef(pg_class.oid) AS definition
+    FROM pg_class
+    JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+    WHERE nspname = '{self.schema_name}' AND relkind IN ('v', 'm');
+
+  DROP TABLE {', '.join(f'{self.schema_name}.{table_name}' for table_name in table_names)} CASCADE;
+""" + ''.join(f"""
+  ALTER TABLE {self.schema_name}__previous.{table_name} SET SCHEMA {self.schema_name};"""
+                 for table_name in table_names) + f"""
+
+  FOR v IN SELECT * FROM schema_copy_view ORDER BY oid LOOP
+    IF to_regclass('{self.schema_name}.' || quote_ident(v.relname)) IS NULL THEN
+      EXECUTE 'CREATE ' || CASE WHEN v.relkind = 'm' THEN 'MATERIALIZED ' ELSE '' END 
+              || 'VIEW {self.schema_name}.' || quote_ident(v.relname) || ' AS ' || trim(v.definition, ' ;')
+              || CASE WHEN v.relkind = 'm' THEN ' WITH NO DATA' ELSE '' END;
+    END IF;
+  END LOOP;
+END
+$$;"""
+
+    def _record_fingerprints_statement(self, fingerprints: {str: str}) -> str:
+        """A statement that stores the fingerprints of copied tables in the target db"""
+        return (f"""
+INSERT INTO util.schema_copy_fingerprint (table_oid, fingerprint)
+VALUES {', '.join(f"('{self.schema_name}.{table_name}'::REGCLASS, '{fingerprint}')"
+                  for table_name, fingerprint in fingerprints.items())}
+ON CONFLICT (table_oid) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, recorded_at = now();
+""" if fingerprints else '') + """
+DELETE FROM util.schema_copy_fingerprint WHERE NOT EXISTS (SELECT 1 FROM pg_class WHERE oid = table_oid);"""
+
+    def _completed_jobs(self) -> {str: int}:
+        """The recorded jobs of a copy that failed less than `resume_within_hours` ago, with their copied rows"""
+        with mara_db.postgresql.postgres_cursor_context(self.target_db_alias) as cursor:
+            cursor.execute(f"SELECT to_regclass('util.schema_copy_checkpoint') IS NOT NULL "
+                           f"AND to_regnamespace({'%s'}) IS NOT NULL", (self.schema_name,))
+            if not cursor.fetchone()[0]:
+                return {}
+            cursor.execute(f'''
+SELECT job, row_count
+FROM util.schema_copy_checkpoint
+WHERE schema_name = {'%s'}
+  AND exists(SELECT 1
+             FROM util.schema_copy_checkpoint
+             WHERE schema_name = {'%s'} AND job = 'ddl'
+               AND completed_at > now() - {'%s'} * INTERVAL '1 hour')''',
+                           (self.schema_name, self.schema_name, self.resume_within_hours))
+            return dict(cursor.fetchall())
+
+    def _checkpoint_job(self, kind: str, name: str = '', condition: str = None) -> str:
+        """The identifier of a piece of work in the checkpoint table"""
+        return ':'.join(part for part in [kind, name, condition] if part)
+
+    def _checkpoint_statement(self, kind: str, name: str = '', condition: str = None) -> str:
+        """
+        A statement that records a completed piece of work in the checkpoint table. For copies, it runs in the
+        transaction of the copy and records the number of rows that the transaction inserted into the table
+        (the same count as the `COPY <n>` of psql or the result of `copy_binary`, which are not available in SQL)
+        """
+        job = self._checkpoint_job(kind, name, condition).replace("'", "''")
+        row_count = (f"pg_stat_get_xact_tuples_inserted('{self.schema_name}.{name}'::REGCLASS)" if kind == 'copy'
+                     else 'NULL')
+        return f"""INSERT INTO util.schema_copy_checkpoint (schema_name, job, row_count)
+VALUES ('{self.schema_name}', '{job}', {row_count})
+ON CONFLICT (schema_name, job) DO UPDATE SET completed_at = now(), row_count = EXCLUDED.row_count;"""
+
+    def _checkpoint_command(self, kind: str, name: str = '', condition: str = None) -> Command:
+        """A command that records a completed piece of work in the checkpoint table"""
+        return ExecuteSQL(sql_statement=self._checkpoint_statement(kind, name, condition),
+                          db_alias=self.target_db_alias, echo_queries=False)
+
+    def _drop_foreign_schema(self, drop_statement: str) -> None:
+        """Removes the imported source schema and the server (with the user mapping) from the target db"""
+        with mara_db.postgresql.postgres_cursor_context(self.target_db_alias) as cursor:
+            cursor.execute(drop_statement)
+
+    def _job_id(self, kind: str, name: str = '') -> str:
+        """The id under which the duration of copying a table or building an index is recorded"""
+        return f'copy_schema:{self.schema_name}:{kind}:{name}'
+
+    def _table_id(self, table_name: str) -> str:
+        """
+        A string for constructing the ids of tasks that work on a single table. A hash of the table name keeps the ids
+        of tables that only differ in case or special characters (or in a `_<n>` suffix) apart
+        """
+        return re.sub('[^a-z0-9_]', '_', table_name.lower()) + '_' + hashlib.md5(table_name.encode()).hexdigest()[:8]
+
+    def _index_statement(self, index_name: str, ddl: str, resuming: bool = False) -> str:
+        """
+        The ddl of an index, preceded by the configured settings for building it. With `resume_within_hours`, the
+        index is recorded in the checkpoint table in the same transaction (and a left over index is dropped first
+        when resuming).
+        """
+        settings = dict(self.default_index_settings)
+        settings.update(self.index_settings.get(index_name, {}))
+        statement = ''.join(f"SET {name} = '{value}';\n" for name, value in settings.items())
+        if not self.resume_within_hours:
+            return statement + ddl + ';'
+        return (statement + 'BEGIN;\n'
+                + (f'DROP INDEX IF EXISTS {self.schema_name}."{index_name}";\n' if resuming else '')
+                + ddl + ';\n' + self._checkpoint_statement('index', index_name) + '\nCOMMIT;')
+
+    def _copy_command(self, table_name: str, condition: str = None, resuming: bool = False) -> Command:
+        """
+        A command that copies the content of a table (piece) from the source to the target db. With
+        `resume_within_hours`, the copy is recorded in the checkpoint table in the same transaction, and when resuming,
+        rows of an earlier attempt are removed first (also in the same transaction).
+        """
+        freeze = self.load_mode == 'freeze' and not condition
+        statements_before, statements_after = [], []
+        if resuming and not freeze:  # freeze truncates anyway
+            if not condition:
+                statements_before.append(f'TRUNCATE {self.schema_name}.{table_name};')
+            elif not condition.startswith('ctid'):  # ctid ranges of the source don't identify rows on the target
+                statements_before.append(f'DELETE FROM {self.schema_name}.{table_name} WHERE {condition};')
+        if self.resume_within_hours:
+            statements_after.append(self._checkpoint_statement('copy', table_name, condition))
+
+        if self.resolved_copy_method() == 'fdw' or table_name in self._tables_copied_from_previous_schema:
+            source_schema_name = (self.previous_schema_name if table_name in self._tables_copied_from_previous_schema
+                                  else f'{self.schema_name}__source')
+            statement = (f'INSERT INTO {self.schema_name}.{table_name}\n'
+                         + f'SELECT * FROM {source_schema_name}.{table_name}'
+                         + (f'\nWHERE {condition}' if condition else '') + ';')
+            if statements_before or statements_after:
+                statement = '\n'.join(['BEGIN;'] + statements_before + [statement] + statements_after + ['COMMIT;'])
+            # through psql, so that the number of inserted rows is returned for the run report
+            return RunBash(command=f'echo {shlex.quote(statement)} \\\n'
+                                   + '  | ' + mara_db.shell.query_command(self.target_db_alias))
+        elif self.copy_method == 'binary':
+            return StreamBinaryCopy(source_db_alias=self.source_db_alias, target_db_alias=self.target_db_alias,
+                                    source=self._copy_source(table_name, condition),
+                                    target_table=f'{self.schema_name}.{table_name}', freeze=freeze,
+                                    sql_before='\n'.join(statements_before) or None,
+                                    sql_after='\n'.join(statements_after) or None)
+        elif freeze or statements_before or statements_after:
+            statements = (([f'TRUNCATE {self.schema_name}.{table_name}'] if freeze else []) + statements_before
+                          + [f'COPY {self.schema_name}.{table_name} FROM STDIN' + (' WITH (FREEZE)' if freeze else '')]
+                          + statements_after)
+            return RunBash(
+                command=f'echo {shlex.quote(f"COPY {self._copy_source(table_name, condition)} TO STDOUT")} \\\n'
+                        + '  | ' + mara_db.shell.copy_to_stdout_command(self.source_db_alias) + ' \\\n'
+                        + '  | ' + mara_db.shell.query_command(self.target_db_alias) + ' --single-transaction \\\n'
+                        + ' \\\n'.join(f'      --command={shlex.quote(statement)}' for statement in statements))
+        else:
+            return RunBash(
+                command=f'echo {shlex.quote(f"COPY {self._copy_source(table_name, condition)} TO STDOUT")} \\\n'
+                        + '  | ' + mara_db.shell.copy_to_stdout_command(self.source_db_alias) + ' \\\n'
+                        + '  | ' + mara_db.shell.copy_from_stdin_command(self.target_db_alias,
+                                                                         target_table=f'{self.schema_name}.{table_name}'))
 
     def html_doc_items(self) -> [(str, str)]:
         return [('schema', _.tt[self.schema_name]),
                 ('source db', _.tt[self.source_db_alias]),
-                ('target db', _.tt[self.target_db_alias])]
+                ('target db', _.tt[self.target_db_alias]),
+                ('split tables larger than', _.tt[f'{self.split_tables_larger_than} MB'
+                                                  if self.split_tables_larger_than else '']),
+                ('split columns', _.tt[repr(self.split_columns)]),
+                # not resolving 'auto' here, that would query the target db for each rendering of the page
+                ('copy method', _.tt[f'{self.copy_method} ({self._resolved_copy_method})'
+                                     if self.copy_method == 'auto' and self._resolved_copy_method
+                                     else self.copy_method]),
+                ('fdw fetch size', _.tt[str(self.fdw_fetch_size) if self.copy_method in ('fdw', 'auto') else '']),
+                ('default index settings', _.tt[repr(self.default_index_settings)]),
+                ('index settings', _.tt[repr(self.index_settings)]),
+                ('load mode', _.tt[self.load_mode or '']),
+                ('set logged', _.tt[repr(self.set_logged)]),
+                ('incremental', _.tt[repr(self.incremental)]),
+                ('previous schema', _.tt[self.previous_schema_name if self.incremental else '']),
+                ('fingerprint method', _.tt[self.fingerprint_method if self.incremental else '']),
+                ('resume within', _.tt[f'{self.resume_within_hours} hours' if self.resume_within_hours else '']),
+                ('number of parallel tasks',
+                 _.tt[f'adaptive, {self.min_number_of_parallel_tasks} - {self.max_number_of_parallel_tasks}'
+                      if self.min_number_of_parallel_tasks else str(self.max_number_of_parallel_tasks)]),
+                ('run report', _.tt[repr(self.run_report)]),
+                ('recorded copies', job_history.html_job_runs(self._job_id('copy'))),
+                ('recorded index builds', job_history.html_job_runs(self._job_id('index')))]
+
+
+class _CreateForeignSchema(Command):
+    def __init__(self, schema_name: str, source_db_alias: str, target_db_alias: str, fetch_size: int) -> None:
+        """
+        Imports a schema of the source db as `<schema_name>__source` into the target db with `postgres_fdw`.
+        Runs in-process so that the password of the source db does not end up in logs.
+
+        Args:
+            schema_name: The schema to import
+            source_db_alias: The db to import the schema from
+            target_db_alias: The db to import the schema into
+            fetch_size: How many rows `postgres_fdw` fetches at once
+        """
+        super().__init__()
+        self.schema_name = schema_name
+        self.source_db_alias = source_db_alias
+        self.target_db_alias = target_db_alias
+        self.fetch_size = fetch_size
+
+    def sql_statement(self) -> (str, [str]):
+        """The statement for creating the foreign schema and its parameters (connection options)"""
+        source_db = mara_db.dbs.db(self.source_db_alias)
+        server_options = {'host': source_db.host, 'port': source_db.port, 'dbname': source_db.database,
+                          'fetch_size': self.fetch_size}
+        user_options = {'user': source_db.user, 'password': source_db.password}
+        server_options, user_options = [{name: str(value) for name, value in options.items() if value is not None}
+                                        for options in (server_options, user_options)]
+        return (f"""
+CREATE EXTENSION IF NOT EXISTS postgres_fdw;
+DROP SERVER IF EXISTS {self.schema_name}__source CASCADE;
+CREATE SERVER {self.schema_name}__source FOREIGN DATA WRAPPER postgres_fdw
+  OPTIONS ({', '.join(f"{name} {'%s'}" for name in server_options)});
+CREATE USER MAPPING FOR CURRENT_USER SERVER {self.schema_name}__source
+  OPTIONS ({', '.join(f"{name} {'%s'}" for name in user_options)});
+DROP SCHEMA IF EXISTS {self.schema_name}__source CASCADE;
+CREATE SCHEMA {self.schema_name}__source;
+IMPORT FOREIGN SCHEMA {self.schema_name} FROM SERVER {self.schema_name}__source INTO {self.schema_name}__source;""",
+                list(server_options.values()) + list(user_options.values()))
+
+    def run(self) -> bool:
+        sql_statement, parameters = self.sql_statement()
+        with mara_db.postgresql.postgres_cursor_context(self.target_db_alias) as cursor:
+            cursor.execute(sql_statement, parameters)
+        return True
+
+    def html_doc_items(self) -> [(str, str)]:
+        sql_statement, parameters = self.sql_statement()
+        return [('db', _.tt[self.target_db_alias]),
+                ('sql statement', _.pre[sql_statement.strip()]),
+                ('fetch size', _.tt[str(self.fetch_size)])]
@@ -1,6 +1,75 @@
+import hashlib
+
+import mara_db.postgresql
+
 from etl_tools import config
 
 
 def chunk_parameter_function() -> [(str)]:
     """Returns all chunks. Meant to be used in chunking-based parallel tasks"""
-    return [(chunk,) for chunk in range(0, config.number_of_chunks())]
\ No newline at end of file
+    return [(chunk,) for chunk in range(0, config.number_of_chunks())]
+
+
+def definition_hash(*definition) -> str:
+    """Identifies everything that incrementally kept results per chunk depend on"""
+    return hashlib.md5(repr(definition).encode()).hexdigest()
+
+
+def chunks_to_compute(db_alias: str, chunks_table_name: str, definition_hash: str,
+                      changed_chunks_query: str = None) -> (bool, [int]):
+    """
+    Decides what an incremental computation with results per chunk has to do.
+
+    The table with the results per chunk is kept between runs. It carries the hash of its definition as comment,
+    which is removed before the chunks are updated (`invalidate_chunks_table_statement`) and only set again after
+    all chunks are merged (`validate_chunks_table_statement`), so that the chunks of a failed run are never taken
+    for up to date.
+
+    Args:
+        db_alias: The database of the chunks table
+        chunks_table_name: The table with the results per chunk, including schema
+        definition_hash: The current `definition_hash` of the computation
+        changed_chunks_query: A query that returns the chunks that changed since the last run. Default: all chunks
+
+    Returns:
+        Whether the chunks table can be updated in place (otherwise it needs to be created) and the chunks to compute
+    """
+    chunks = [chunk for chunk, in chunk_parameter_function()]
+    with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor:
+        cursor.execute(f"SELECT obj_description(to_regclass({'%s'}), 'pg_class')", (chunks_table_name,))
+        update_in_place = cursor.fetchone()[0] == definition_hash
+        if update_in_place and changed_chunks_query:
+            cursor.execute(changed_chunks_query)
+            chunks = [chunk for chunk, in cursor.fetchall()]
+    return update_in_place, chunks
+
+
+def chunks_table_persistence(incremental: bool) -> str:
+    """
+    The persistence of a table with results per chunk: in incremental mode, the results are kept between runs
+    and need to survive crashes, otherwise they are only needed during one run
+    """
+    return '' if incremental else 'UNLOGGED '
+
+
+def chunk_statement(chunks_table_name: str, chunk: int, statement: str, update_in_place: bool) -> str:
+    """Wraps a statement that inserts the results of a chunk so that it replaces older results of the chunk"""
+    if not update_in_place:
+        return statement
+    return f'''
+BEGIN;
+
+DELETE FROM {chunks_table_name} WHERE chunk = {chunk};
+{statement}
+COMMIT;
+'''
+
+
+def invalidate_chunks_table_statement(chunks_table_name: str) -> str:
+    """A statement that marks the results per chunk as incomplete (before chunks are updated)"""
+    return f'COMMENT ON TABLE {chunks_table_name} IS NULL;'
+
+
+def validate_chunks_table_statement(chunks_table_name: str, definition_hash: str) -> str:
+    """A statement that marks the results per chunk as complete (after all chunks are merged)"""
+    return f"COMMENT ON TABLE {chunks_table_name} IS '{definition_hash}';"
@@ -21,9 +21,13 @@ setup(
         'mara-pipelines>=3.0.0',
     ],
 
+    extras_require={
+        'numpy': ['numpy'],
+    },
+
     python_requires='>=3.6',
 
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
 
     author='Mara contributors',
     license='MIT',
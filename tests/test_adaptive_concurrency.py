@@ -0,0 +1,80 @@
+from unittest import mock
+
+import pytest
+
+from etl_tools import adaptive_concurrency
+from etl_tools.adaptive_concurrency import AdaptiveConcurrency
+
+MB = 1000000
+
+
+@pytest.fixture(autouse=True)
+def no_logging():
+    with mock.patch.object(adaptive_concurrency.logger, 'log'):
+        yield
+
+
+def decisions(concurrency: AdaptiveConcurrency, measurements: [(int, int, int)]) -> [int]:
+    """The limits after each sampling interval, for a sequence of (MB written, active, waiting sessions)"""
+    limits = []
+    with mock.patch.object(concurrency, '_measure') as measure, \
+            mock.patch.object(adaptive_concurrency.time, 'time') as time:
+        for i, (number_of_mb, active, waiting) in enumerate(measurements):
+            measure.return_value = (number_of_mb * MB, number_of_mb * 100, active, waiting)
+            time.return_value = i * 10.0
+            concurrency._decide()
+            limits.append(concurrency.limit)
+    return limits
+
+
+def new_concurrency(min_number_of_parallel_tasks: int, max_number_of_parallel_tasks: int):
+    return AdaptiveConcurrency(label='copy', min_number_of_parallel_tasks=min_number_of_parallel_tasks,
+                               max_number_of_parallel_tasks=max_number_of_parallel_tasks,
+                               target_db_alias='target', target_schema_name='s')
+
+
+def test_limit_follows_the_throughput():
+    concurrency = new_concurrency(2, 8)
+    assert concurrency.limit == 5
+
+    assert decisions(concurrency, [
+        (0, 4, 0),  # first sample
+        (100, 4, 0),  # probing
+        (250, 4, 0),  # throughput increased
+        (400, 4, 0),  # throughput unchanged: less load
+        (500, 4, 0),  # throughput decreased: turn around
+        (700, 4, 0),  # throughput increased
+    ]) == [5, 6, 7, 6, 7, 8]
+
+
+def test_limit_decreases_when_sessions_wait():
+    concurrency = new_concurrency(2, 8)
+
+    assert decisions(concurrency, [(0, 4, 0), (100, 4, 3), (300, 4, 3), (600, 4, 2)]) == [5, 4, 3, 2]
+
+
+def test_limit_stays_within_bounds():
+    concurrency = new_concurrency(1, 2)
+    assert concurrency.limit == 2
+
+    # at the upper bound, the next step goes down
+    assert decisions(concurrency, [(0, 1, 0), (100, 1, 0), (300, 1, 0)]) == [2, 2, 1]
+
+    concurrency = new_concurrency(3, 3)
+    assert decisions(concurrency, [(0, 4, 4), (100, 4, 4), (200, 4, 0)]) == [3, 3, 3]
+
+
+def test_behaves_like_an_int():
+    concurrency = new_concurrency(2, 8)
+
+    with mock.patch.object(concurrency, 'current_limit', return_value=5):
+        assert concurrency
+        assert 4 < concurrency and not 5 < concurrency
+        assert concurrency == 5 and concurrency != 4
+        assert list(range(10))[:concurrency] == [0, 1, 2, 3, 4]
+        assert int(concurrency) == 5
+
+
+def test_invalid_bounds():
+    with pytest.raises(AssertionError):
+        new_concurrency(3, 2)
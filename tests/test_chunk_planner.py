@@ -0,0 +1,59 @@
+import pytest
+
+from etl_tools.chunk_planner import _chunk_plan
+
+
+def test_uniform_distribution_is_split_into_ranges():
+    distribution = [(str(value), 0.125) for value in range(1, 9)]
+
+    plan = _chunk_plan('c', 'integer', 0, distribution, [], 4)
+
+    assert plan.conditions == [
+        '("c" < \'3\'::integer OR "c" IS NULL)',
+        '"c" >= \'3\'::integer AND "c" < \'5\'::integer',
+        '"c" >= \'5\'::integer AND "c" < \'7\'::integer',
+        '"c" >= \'7\'::integer']
+    assert plan.fractions == [0.25, 0.25, 0.25, 0.25]
+    assert plan.imbalance == 1.0
+
+
+def test_heavy_hitters_get_chunks_of_their_own():
+    frequencies = [('5', 0.5), ('2', 0.1)]
+    distribution = [('1', 0.1), ('2', 0.1), ('3', 0.1), ('4', 0.1), ('5', 0.5), ('6', 0.1)]
+
+    plan = _chunk_plan('c', 'integer', 0, distribution, frequencies, 3)
+
+    assert plan.conditions[0] == '"c" = \'5\'::integer'
+    assert plan.fractions[0] == 0.5
+    assert len(plan.conditions) == 3
+    assert all('NOT IN (\'5\'::integer)' in condition for condition in plan.conditions[1:])
+    # MCVs that are not heavy hitters count for the range they fall into
+    assert sum(plan.fractions) == pytest.approx(1.0)
+    assert plan.conditions[1].startswith('("c" < \'4\'::integer')
+    assert plan.fractions[1:] == pytest.approx([0.3, 0.2])
+
+
+def test_nulls():
+    distribution = [(str(value), 0.1) for value in range(1, 6)]
+
+    plan = _chunk_plan('c', 'integer', 0.5, distribution, [], 2)
+    assert plan.conditions == ['"c" IS NULL', 'TRUE']
+    assert plan.fractions == [0.5, pytest.approx(0.5)]
+
+    plan = _chunk_plan('c', 'integer', 0.1, distribution[1:], [], 2)
+    assert plan.conditions[0] == '("c" < \'4\'::integer OR "c" IS NULL)'
+    assert plan.fractions == pytest.approx([0.3, 0.2])
+
+
+def test_literals_are_never_quoted_wrongly():
+    plan = _chunk_plan('c', 'text', 0, [("a'b", 0.5), ('c', 0.5)], [("a'b", 0.5), ('c', 0.5)], 2)
+
+    assert plan.conditions[0] == '"c" = convert_from(decode(\'' + "a'b".encode().hex() + '\', \'hex\'), \'UTF8\')::text'
+    assert plan.conditions[1] == '"c" = \'c\'::text'
+
+
+def test_hash_imbalance():
+    plan = _chunk_plan('c', 'integer', 0, [('1', 0.6), ('2', 0.4)], [('1', 0.6)], 4)
+
+    assert plan.hash_max_fraction == pytest.approx(0.6 + 0.4 / 4)
+    assert plan.hash_imbalance == pytest.approx(0.7 * len(plan.conditions))
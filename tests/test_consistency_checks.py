@@ -0,0 +1,72 @@
+from decimal import Decimal
+
+import pytest
+
+from etl_tools.consistency_checks import (Aggregate, Assert, AssertAlmostEqual, AssertNotFound, AssertRelation,
+                                          Assertion, RunConsistencyChecks)
+
+
+def test_aggregates_of_a_table_are_computed_in_one_query():
+    orders = Aggregate('dim.order', 'count(*)')
+    future_orders = Aggregate('dim.order', 'count(*)', 'order_date > now()')
+    revenue = Aggregate('dim.order', 'sum(revenue)')
+    item_revenue = Aggregate('dim.order_item', 'sum(revenue)')
+    checks = RunConsistencyChecks([
+        AssertRelation('No future orders', future_orders, 0),
+        AssertRelation('Orders exist', Aggregate('dim.order', 'count(*)'), 0, '>'),
+        AssertAlmostEqual('Revenue matches', revenue, item_revenue, percentage=0.01),
+    ])
+
+    assert checks.queries() == [
+        ('SELECT count(*) FILTER (WHERE order_date > now()),\n'
+         '       count(*),\n'
+         '       sum(revenue)\n'
+         'FROM dim.order', [future_orders, orders, revenue]),
+        ('SELECT sum(revenue)\nFROM dim.order_item', [item_revenue])]
+
+
+def test_queries_are_run_once():
+    query = 'SELECT count(*) FROM dim.order'
+    rows_query = 'SELECT order_id FROM dim.order WHERE order_date > now();'
+    checks = RunConsistencyChecks([
+        AssertRelation('Orders exist', query, 0, '>'),
+        AssertRelation('Not too many orders', query, 1000000, '<'),
+        Assert('Orders have ids', 'SELECT bool_and(order_id IS NOT NULL) FROM dim.order'),
+        AssertNotFound('No orders from the future', rows_query),
+        AssertNotFound('Really no orders from the future', rows_query),
+    ])
+
+    queries = checks.queries()
+
+    assert [query for query, values in queries] == [
+        query,
+        'SELECT bool_and(order_id IS NOT NULL) FROM dim.order',
+        'SELECT * FROM (SELECT order_id FROM dim.order WHERE order_date > now()) q LIMIT 20']
+    # the rows of the last query are fetched, not a single value
+    assert queries[0][1] == [query] and queries[2][1] != [rows_query]
+
+
+@pytest.mark.parametrize('result1, result2, fails', [(100, 100.5, False),
+                                                     (100, 99.5, False),
+                                                     (100, 101, True),
+                                                     (-100, -102, True),
+                                                     (Decimal('100.0'), Decimal('100.9'), False),
+                                                     (0, 5, False),  # like util.assert_almost_equal
+                                                     (None, 100, True),
+                                                     (100, None, True)])
+def test_assert_almost_equal(result1, result2, fails):
+    assertion = AssertAlmostEqual('Revenue matches', 'SELECT 1', 'SELECT 2', percentage=0.01)
+
+    failure = assertion.failure({'SELECT 1': result1, 'SELECT 2': result2})
+
+    assert bool(failure) == fails
+    if fails:
+        assert failure.startswith(f'assertion failed: abs(({result2} - {result1}) / {result1}) < 0.01\n')
+
+
+def test_assertions_need_a_failure_method():
+    class AssertNothing(Assertion):
+        pass
+
+    with pytest.raises(TypeError):
+        AssertNothing('Nothing')
@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+
+from etl_tools.copy_streaming import _BoundedPipe
+
+
+def read_all(pipe: _BoundedPipe) -> [bytes]:
+    blocks = []
+    while True:
+        block = pipe.read()
+        if not block:
+            return blocks
+        blocks.append(block)
+
+
+def test_writes_are_collected_into_blocks():
+    pipe = _BoundedPipe(block_size=4, max_number_of_blocks=10)
+    for data in [b'ab', b'cd', b'efghij', b'k']:
+        pipe.write(data)
+    pipe.close_writer()
+
+    assert read_all(pipe) == [b'abcd', b'efghij', b'k']
+    assert pipe.number_of_bytes == 11
+    assert pipe.read() == b''
+
+
+def test_writer_blocks_until_the_reader_catches_up():
+    pipe = _BoundedPipe(block_size=1, max_number_of_blocks=2)
+    data = [bytes([i]) for i in range(100)]
+
+    def write():
+        for block in data:
+            pipe.write(block)
+        pipe.close_writer()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    assert read_all(pipe) == data
+    writer.join(timeout=5)
+    assert not writer.is_alive()
+
+
+def test_writer_exceptions_are_raised_in_the_reader():
+    pipe = _BoundedPipe(block_size=2, max_number_of_blocks=10)
+    pipe.write(b'abc')
+    pipe.write(b'd')
+    pipe.close_writer(ValueError('source failed'))
+
+    assert pipe.read() == b'abc'
+    with pytest.raises(ValueError, match='source failed'):
+        pipe.read()
+    assert pipe.read() == b''
+
+
+def test_aborted_reader_unblocks_the_writer():
+    pipe = _BoundedPipe(block_size=1, max_number_of_blocks=1)
+    pipe.write(b'a')
+    errors = []
+
+    def write():
+        try:
+            pipe.write(b'b')
+        except InterruptedError as e:
+            errors.append(e)
+            pipe.close_writer(exception=e)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    pipe.abort_reader()
+    writer.join(timeout=5)
+
+    assert not writer.is_alive()
+    assert len(errors) == 1
+    assert pipe.read() == b''
@@ -0,0 +1,44 @@
+from unittest import mock
+
+from mara_pipelines.commands.bash import RunBash
+
+from etl_tools import job_history
+
+
+def test_pack_balances_bins_longest_first():
+    bins = job_history.pack({'a': 10, 'b': 6, 'c': 5, 'd': 4, 'e': 1}, 2)
+
+    assert bins == [['a', 'd'], ['b', 'c', 'e']]
+
+
+def test_pack_omits_empty_bins():
+    assert job_history.pack({'a': 1, 'b': 2}, 4) == [['b'], ['a']]
+    assert job_history.pack({}, 3) == []
+
+
+def test_estimate_durations_scales_recorded_durations_by_size():
+    history = {'copy:s.a': (100.0, 20.0), 'copy:s.b': (300.0, 40.0)}
+    with mock.patch.object(job_history, 'job_runs', return_value=history):
+        durations = job_history.estimate_durations({'copy:s.a': 200.0, 'copy:s.b': None, 'copy:s.c': 50.0},
+                                                   'copy:s.')
+
+    assert durations['copy:s.a'] == 40.0
+    assert durations['copy:s.b'] == 40.0
+    # new jobs are estimated from the average time per MB of the other jobs
+    assert durations['copy:s.c'] == 50.0 * 60.0 / 400.0
+
+
+def test_estimate_durations_without_history():
+    with mock.patch.object(job_history, 'job_runs', return_value={}):
+        assert job_history.estimate_durations({'a': 3.0, 'b': None}, '') == {'a': 3.0, 'b': 0}
+
+
+def test_number_of_rows():
+    command = RunBash('true')
+
+    assert job_history.number_of_rows(command, ['SET', 'COPY 42']) == 42
+    assert job_history.number_of_rows(command, ['INSERT 0 7']) == 7
+    assert job_history.number_of_rows(command, True) is None
+
+    command.number_of_rows = 3
+    assert job_history.number_of_rows(command, ['COPY 42']) == 3
@@ -0,0 +1,74 @@
+import os
+from unittest import mock
+
+import pytest
+
+from etl_tools import config, schema_check
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(schema_check, '_cache', {})
+
+
+@pytest.fixture
+def directory(tmp_path):
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'a.sql').write_text('SELECT * FROM dim.customer;\nSELECT 1;\nSELECT * FROM dim_next.customer;\n')
+    (tmp_path / 'sub' / 'b.py').write_text('query = "SELECT * FROM dim.order"\n')
+    (tmp_path / 'sub' / '__init__.py').write_text('# dim.customer\n')
+    (tmp_path / 'README.md').write_text('dim.customer\n')
+    return tmp_path
+
+
+def test_matches_all_schemas_in_one_pass(directory):
+    matches = schema_check.scan_directories([directory, directory / 'sub'], ['dim', 'dim_next', 'tmp'])
+
+    assert matches == {
+        str(directory / 'a.sql'): {'dim': ['SELECT * FROM dim.customer;'],
+                                   'dim_next': ['SELECT * FROM dim_next.customer;']},
+        str(directory / 'sub' / 'b.py'): {'dim': ['query = "SELECT * FROM dim.order"']}}
+
+
+def test_overlapping_schema_names(tmp_path):
+    (tmp_path / 'a.sql').write_text('SELECT * FROM dim_next.customer;\n')
+
+    assert schema_check.scan_directories([tmp_path], ['next', 'dim_next']) == {
+        str(tmp_path / 'a.sql'): {'dim_next': ['SELECT * FROM dim_next.customer;'],
+                                  'next': ['SELECT * FROM dim_next.customer;']}}
+
+
+def test_unchanged_files_are_not_read_again(directory):
+    with mock.patch.object(schema_check, '_scan_file', wraps=schema_check._scan_file) as scan_file:
+        schema_check.scan_directories([directory], ['dim'])
+        assert scan_file.call_count == 2
+
+        scan_file.reset_mock()
+        schema_check.scan_directories([directory], ['dim'])
+        assert scan_file.call_count == 0
+
+        (directory / 'a.sql').write_text('SELECT 1;\n')
+        stat = os.stat(directory / 'a.sql')
+        os.utime(directory / 'a.sql', ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        assert schema_check.scan_directories([directory], ['dim']) == {
+            str(directory / 'sub' / 'b.py'): {'dim': ['query = "SELECT * FROM dim.order"']}}
+        assert scan_file.call_args_list == [mock.call(str(directory / 'a.sql'), mock.ANY)]
+
+        # results for other schema names are not re-used
+        scan_file.reset_mock()
+        schema_check.scan_directories([directory], ['dim', 'tmp'])
+        assert scan_file.call_count == 2
+
+
+def test_cache_file(directory, tmp_path_factory, monkeypatch):
+    cache_file = tmp_path_factory.mktemp('cache') / 'schema-check.json'
+    monkeypatch.setattr(config, 'schema_check_cache_file', lambda: str(cache_file))
+
+    matches = schema_check.scan_directories([directory], ['dim'])
+    assert cache_file.exists()
+    assert os.listdir(cache_file.parent) == ['schema-check.json']
+
+    monkeypatch.setattr(schema_check, '_cache', {})
+    with mock.patch.object(schema_check, '_scan_file') as scan_file:
+        assert schema_check.scan_directories([directory], ['dim']) == matches
+        assert scan_file.call_count == 0
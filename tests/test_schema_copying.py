@@ -0,0 +1,71 @@
+import re
+from unittest import mock
+
+import pytest
+
+from etl_tools.schema_copying import ParallelCopySchema
+
+
+def copy_schema(**kwargs) -> ParallelCopySchema:
+    return ParallelCopySchema(**dict(dict(id='copy', description='copy', max_number_of_parallel_tasks=2,
+                                          source_db_alias='source', target_db_alias='target', schema_name='s'),
+                                     **kwargs))
+
+
+@pytest.mark.parametrize('size', [None, 100.0, 200.0])
+def test_split_conditions_of_small_tables(size):
+    task = copy_schema(split_tables_larger_than=size)
+
+    assert task._split_conditions('t', 'r', 100.0, 1000, 160000) == [None]
+
+
+def test_split_conditions_by_ctid_ranges():
+    task = copy_schema(split_tables_larger_than=100.0)
+
+    assert task._split_conditions('t', 'r', 250.0, 1000, 160000) == [
+        "ctid < '(333,0)'::TID",
+        "ctid >= '(333,0)'::TID AND ctid < '(666,0)'::TID",
+        "ctid >= '(666,0)'::TID"]
+
+
+def test_split_conditions_limit_the_number_of_pieces():
+    task = copy_schema(split_tables_larger_than=1.0)
+
+    assert len(task._split_conditions('t', 'r', 1000.0, 1000, 160000)) == 2 * 3
+    assert len(task._split_conditions('t', 'r', 1000.0, 4, 160000)) == 4
+
+
+@pytest.mark.parametrize('type, number_of_blocks, pg_version', [('f', 1000, 160000),  # foreign table
+                                                                ('r', 0, 160000),  # no statistics
+                                                                ('r', 1000, 130000),  # no TID range scans
+                                                                ('r', 1, 160000)])
+def test_split_conditions_of_tables_that_are_not_split_by_ctid(type, number_of_blocks, pg_version):
+    task = copy_schema(split_tables_larger_than=100.0)
+
+    assert task._split_conditions('t', type, 250.0, number_of_blocks, pg_version) == [None]
+
+
+def test_split_conditions_by_split_column():
+    task = copy_schema(split_tables_larger_than=100.0, split_columns={'t': 'id'})
+
+    with mock.patch('etl_tools.config.number_of_chunks', return_value=3):
+        assert task._split_conditions('t', 'r', 250.0, 1000, 130000) == [
+            'util.compute_chunk("id") = 0', 'util.compute_chunk("id") = 1', 'util.compute_chunk("id") = 2']
+
+
+def test_split_conditions_by_ctid_ranges_with_fdw():
+    task = copy_schema(split_tables_larger_than=100.0, split_columns={'t': 'id'}, copy_method='fdw')
+
+    assert len(task._split_conditions('t', 'r', 250.0, 1000, 160000)) == 3
+
+
+def test_table_ids_are_valid_and_unique():
+    task = copy_schema()
+    table_names = ['order', 'Order', 'order_1', 'order-1', 'Order Item', 'order_item']
+
+    table_ids = [task._table_id(table_name) for table_name in table_names]
+
+    assert len(set(table_ids)) == len(table_names)
+    assert all(re.fullmatch('[a-z0-9_]+', table_id) for table_id in table_ids)
+    assert table_ids[0].startswith('order_') and table_ids[4].startswith('order_item_')
+    assert task._table_id('Order') == table_ids[1]
@@ -0,0 +1,37 @@
+from unittest import mock
+
+from etl_tools import utils
+
+
+def test_definition_hash():
+    assert utils.definition_hash('s', 't', ['a', 'b']) == utils.definition_hash('s', 't', ['a', 'b'])
+    assert utils.definition_hash('s', 't', ['a', 'b']) != utils.definition_hash('s', 't', ['b', 'a'])
+    assert utils.definition_hash('s', 't', None) != utils.definition_hash('s', 't')
+
+
+def test_chunk_statement():
+    statement = 'INSERT INTO s.t__chunks SELECT 3, count(*) FROM s.t;'
+
+    assert utils.chunk_statement('s.t__chunks', 3, statement, update_in_place=False) == statement
+    assert utils.chunk_statement('s.t__chunks', 3, statement, update_in_place=True).split('\n') == [
+        '', 'BEGIN;', '', 'DELETE FROM s.t__chunks WHERE chunk = 3;', statement, 'COMMIT;', '']
+
+
+def chunks_to_compute(comment: str, changed_chunks: [int] = None) -> (bool, [int]):
+    with mock.patch('mara_db.postgresql.postgres_cursor_context') as cursor_context, \
+            mock.patch('etl_tools.config.number_of_chunks', return_value=4):
+        cursor = cursor_context.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (comment,)
+        cursor.fetchall.return_value = [(chunk,) for chunk in changed_chunks or []]
+        return utils.chunks_to_compute('dwh', 's.t__chunks', 'abc',
+                                       'SELECT chunk FROM s.changes' if changed_chunks is not None else None)
+
+
+def test_chunks_to_compute():
+    # no chunks table, a different definition or a failed last run
+    assert chunks_to_compute(None, [1]) == (False, [0, 1, 2, 3])
+    assert chunks_to_compute('def', [1]) == (False, [0, 1, 2, 3])
+
+    assert chunks_to_compute('abc', [1, 3]) == (True, [1, 3])
+    assert chunks_to_compute('abc', []) == (True, [])
+    assert chunks_to_compute('abc') == (True, [0, 1, 2, 3])